@@ -0,0 +1,203 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019, TU Wien
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The binary module implements a flat, memory-mappable time series store.
+Each cell is written as one uncompressed float32 matrix of shape
+(gpi, time) per parameter together with a small JSON header. Parameters
+can be packed into int16 or float16 matrices, see :mod:`merra.packing`. A
+single time series is then one contiguous slice of the file that can be
+read through ``numpy.memmap`` without any parsing.
+
+Layout of a store::
+
+    store.json              global header (parameters, dtype, packing,
+                            time axis)
+    timestamps.npy          time axis shared by all cells
+    grid.nc                 grid definition, see pygeogrids.netcdf
+    0000.json               cell header (gpis, lons, lats)
+    0000_SFMC.bin           (gpi, time) matrix of parameter SFMC
+"""
+
+import os
+import json
+import numpy as np
+
+store_header_name = 'store.json'
+timestamps_name = 'timestamps.npy'
+cell_header_templ = '{cell:04d}.json'
+cell_data_templ = '{cell:04d}_{parameter}.bin'
+
+
+def write_store_header(path, parameters, timestamps, dtype='float32',
+                       attributes=None, packing=None):
+    """
+    Write the global header and the time axis of a binary store.
+
+    Parameters
+    ----------
+    path : string
+        root directory of the store
+    parameters : list
+        names of the stored parameters
+    timestamps : list or numpy.ndarray
+        timestamps of the time axis shared by all cells
+    dtype : string, optional
+        data type of the stored matrices
+    attributes : dict, optional
+        per parameter metadata, e.g. long_name and units
+    packing : dict, optional
+        packing of the parameters stored with another data type than
+        dtype, see :class:`merra.packing.Packer`
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    timestamps = np.asarray(timestamps, dtype='datetime64[s]')
+    np.save(os.path.join(path, timestamps_name), timestamps)
+
+    header = {'layout': 'gpi_time',
+              'dtype': np.dtype(dtype).str,
+              'n_time': int(timestamps.size),
+              'parameters': list(parameters),
+              'attributes': attributes or {},
+              'packing': packing or {}}
+    with open(os.path.join(path, store_header_name), 'w') as f:
+        json.dump(header, f, indent=2)
+
+
+def read_store_header(path):
+    """
+    Read the global header and the time axis of a binary store.
+
+    Parameters
+    ----------
+    path : string
+        root directory of the store
+
+    Returns
+    -------
+    header : dict
+        global header
+    timestamps : numpy.ndarray
+        time axis as datetime64[s] array
+    """
+    with open(os.path.join(path, store_header_name)) as f:
+        header = json.load(f)
+    timestamps = np.load(os.path.join(path, timestamps_name))
+    return header, timestamps
+
+
+def create_cell(path, cell, gpis, lons, lats, parameters, n_time,
+                dtype='float32', fill_value=np.nan):
+    """
+    Create the header and the (empty) data files of one cell.
+
+    Parameters
+    ----------
+    path : string
+        root directory of the store
+    cell : int
+        cell number
+    gpis, lons, lats : numpy.ndarray
+        grid points of the cell in storage order
+    parameters : list
+        names of the stored parameters
+    n_time : int
+        length of the time axis
+    dtype : string, optional
+        data type of the stored matrices
+    fill_value : float, optional
+        value the matrices are initialized with
+    """
+    header = {'cell': int(cell),
+              'gpis': np.asarray(gpis).tolist(),
+              'lons': np.asarray(lons).tolist(),
+              'lats': np.asarray(lats).tolist()}
+    with open(os.path.join(path, cell_header_templ.format(cell=cell)),
+              'w') as f:
+        json.dump(header, f)
+
+    for parameter in parameters:
+        data = np.memmap(
+            os.path.join(path, cell_data_templ.format(cell=cell,
+                                                      parameter=parameter)),
+            dtype=dtype, mode='w+', shape=(len(gpis), n_time))
+        data[:] = fill_value
+        data.flush()
+        del data
+
+
+def read_cell_header(path, cell):
+    """
+    Read the header of one cell.
+
+    Parameters
+    ----------
+    path : string
+        root directory of the store
+    cell : int
+        cell number
+
+    Returns
+    -------
+    header : dict
+        cell header with gpis, lons and lats as numpy arrays
+    """
+    with open(os.path.join(path, cell_header_templ.format(cell=cell))) as f:
+        header = json.load(f)
+    for key in ['gpis', 'lons', 'lats']:
+        header[key] = np.array(header[key])
+    return header
+
+
+def open_cell_data(path, cell, parameter, n_gpi, n_time, dtype='float32',
+                   mode='r'):
+    """
+    Memory map the (gpi, time) matrix of one cell and parameter.
+
+    Parameters
+    ----------
+    path : string
+        root directory of the store
+    cell : int
+        cell number
+    parameter : string
+        parameter name
+    n_gpi : int
+        number of grid points in the cell
+    n_time : int
+        length of the time axis
+    dtype : string, optional
+        data type of the stored matrix
+    mode : string, optional
+        mode of the memory map, 'r' for reading and 'r+' for writing
+
+    Returns
+    -------
+    data : numpy.memmap
+        memory mapped matrix of shape (n_gpi, n_time)
+    """
+    return np.memmap(
+        os.path.join(path, cell_data_templ.format(cell=cell,
+                                                  parameter=parameter)),
+        dtype=dtype, mode=mode, shape=(n_gpi, n_time))
@@ -23,27 +23,41 @@
 """
 The download module implements a command line script for downloading MERRA2
 reanalysis data from the NASA GESDISC repository.
+
+The URLs of the files are generated from the deterministic file names of
+the collections, the remote folders are only listed for days that are not
+found under the expected name. The datedown package is only imported when
+the download starts, so that the command line interface starts quickly.
 """
 
 import os
+import re
 import sys
 import glob
+import fnmatch
+import logging
 import argparse
+import posixpath
 from functools import partial
 
 from trollsift import parser
-from datetime import datetime
-from datedown.interface import mkdate
-from datedown.dates import daily
-from datedown.urlcreator import create_dt_url
-from datedown.fname_creator import create_dt_fpath
-from datedown.interface import download_by_dt
-from datedown.down import download
+from datetime import datetime, timedelta
+from merra.metrics import create_metrics
+from merra.products import (products, get_collection, fname_format,
+                            fname_template, daily_fname)
+from merra.reshuffle import mkdate
+
+logger = logging.getLogger(__name__)
+
+# global attribute with the OPeNDAP constraint of a downloaded subset
+subset_attribute = 'merra_subset'
+# suffix of the file next to a subset that repeats its constraint
+subset_suffix = '.subset'
 
 
 def folder_get_version_first_last(
         root,
-        fmt="MERRA2_{stream}.tavg1_2d_lnd_Nx.{time:%Y%m%d}.nc4",
+        fmt=None,
         subpaths=['{time:%Y}', '{time:%m}']):
     """
     Get product version and first and last product
@@ -54,7 +68,8 @@ def folder_get_version_first_last(
     root: string
         Root folder on local filesystem
     fmt: string, optional
-        formatting string
+        formatting string, by default the file names of all registered
+        collections are tried
     subpaths: list, optional
         format of the subdirectories under root.
     Returns
@@ -70,22 +85,35 @@ def folder_get_version_first_last(
     end = None
     version = None
     first_folder = get_first_folder(root, subpaths)
-    print('First folder', first_folder)
+    logger.debug('First folder %s', first_folder)
     last_folder = get_last_folder(root, subpaths)
-    print('Last folder', last_folder)
+    logger.debug('Last folder %s', last_folder)
+
+    if fmt is None:
+        fmts = [(fname_format(name), collection['product'])
+                for name, collection in products.items()]
+    else:
+        fmts = [(fmt, None)]
+        for collection in products.values():
+            if fname_format(collection['product']) == fmt:
+                fmts = [(fmt, collection['product'])]
 
     if first_folder is not None:
-        files = sorted(
-            glob.glob(
-                os.path.join(
-                    first_folder,
-                    parser.globify(fmt))))
-        # parse files according to formatting string ({stream} is ignored)
-        data = parser.parse(fmt, os.path.split(files[0])[1])
-        start = data['time']
-        version = 'M2T1NXLND.5.12.4'
+        for fmt, product in fmts:
+            files = sorted(
+                glob.glob(
+                    os.path.join(
+                        first_folder,
+                        parser.globify(fmt))))
+            if len(files) > 0:
+                # parse files according to formatting string
+                # ({stream} is ignored)
+                data = parser.parse(fmt, os.path.split(files[0])[1])
+                start = data['time']
+                version = product
+                break
 
-    if last_folder is not None:
+    if last_folder is not None and start is not None:
         files = sorted(
             glob.glob(
                 os.path.join(
@@ -220,8 +248,7 @@ def get_start_date(product):
         timestamp of start date
 
     """
-    dt_dict = {'M2T1NXLND.5.12.4': datetime(1980, 1, 1)}
-    return dt_dict[product]
+    return get_collection(product)[1]['start']
 
 
 def parse_args(args):
@@ -260,29 +287,74 @@ def parse_args(args):
         help=(
             "Enddate. Either in format YYYY-MM-DD or YYYY-MM-DDTHH:MM."
             "If not given then the current date is used."))
-    help_string = '\n'.join(['MERRA2 product to download.',
-                             'M2T1NXLND.5.12.4 available from {}'])
-    help_string = help_string.format(get_start_date('M2T1NXLND.5.12.4'))
+    help_string = '\n'.join(
+        ['MERRA2 product to download.'] +
+        ['{} ({}) available from {}'.format(
+            collection['product'], collection['description'],
+            collection['start']) for collection in products.values()])
 
     parser.add_argument(
         "--product",
-        choices=["M2T1NXLND.5.12.4"],
+        choices=[collection['product'] for collection in products.values()],
         default="M2T1NXLND.5.12.4",
         help=help_string)
     parser.add_argument("--username",
                         help='Username to use for download.')
     parser.add_argument("--password",
                         help='password to use for download.')
+    parser.add_argument(
+        "--parameters",
+        nargs='+',
+        help=(
+            "Download only these parameters of the files as OPeNDAP "
+            "subsets, e.g. SFMC RZMC.\nBy default the whole files are "
+            "downloaded."))
+    parser.add_argument(
+        "--hours",
+        nargs='+',
+        type=int,
+        help=(
+            "Evenly spaced hours of the day of the OPeNDAP subsets, e.g. "
+            "0 6 12 18."))
+    parser.add_argument(
+        "--bbox",
+        nargs=4,
+        type=float,
+        metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'),
+        help="Region of the OPeNDAP subsets.")
     parser.add_argument(
         "--n_proc",
         default=1,
         type=int,
         help='Number of parallel processes to use for downloading.')
+    parser.add_argument(
+        "--metrics_file",
+        help=(
+            "File the timing, throughput and progress metrics are "
+            "exported to."))
+    parser.add_argument(
+        "--metrics_format",
+        choices=['jsonl', 'prometheus'],
+        default='jsonl',
+        help=(
+            "Format of the metrics file. 'jsonl' appends one JSON line per "
+            "report, 'prometheus' writes a textfile for the node exporter."))
+    parser.add_argument(
+        "--log_level",
+        default='INFO',
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help="Logging level.")
     args = parser.parse_args(args)
     # set defaults that can not be handled by argparse
+    logging.basicConfig(level=args.log_level,
+                        format='%(asctime)s %(name)s %(levelname)s '
+                               '%(message)s')
 
     # Compare versions to prevent mixing data sets
-    version, first, last = folder_get_version_first_last(args.localroot)
+    version, first, last = folder_get_version_first_last(
+        args.localroot, fmt=fname_format(args.product))
+    if version is None:
+        version, first, last = folder_get_version_first_last(args.localroot)
     if args.product and version and (args.product != version):
         raise Exception(
             'Error: Found products of different '
@@ -302,39 +374,514 @@ def parse_args(args):
         if args.end is None:
             args.end = datetime.now()
 
-    prod_urls = {'M2T1NXLND.5.12.4':
-                 {'root': 'https://goldsmr4.gesdisc.eosdis.nasa.gov',
-                  'dirs': ['data', 'MERRA2', 'M2T1NXLND.5.12.4',
-                           '%Y', '%m']}}
+    logger.info("Downloading data from %s to %s into folder %s.",
+                args.start.isoformat(), args.end.isoformat(),
+                args.localroot)
+    return args
 
-    args.urlroot = prod_urls[args.product]['root']
-    args.urlsubdirs = prod_urls[args.product]['dirs']
-    args.localsubdirs = ['%Y', '%m']
 
-    print("Downloading data from {} to {} into folder {}.".format(
-        args.start.isoformat(), args.end.isoformat(), args.localroot))
-    return args
+def local_files(root, pattern='*.nc4'):
+    """
+    Size of all files below root matching the pattern.
+
+    Parameters
+    ----------
+    root : string
+        Root folder on local filesystem
+    pattern : string, optional
+        glob pattern of the files
+
+    Returns
+    -------
+    files : dict
+        file size in bytes for each path
+    """
+    files = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in fnmatch.filter(filenames, pattern):
+            path = os.path.join(dirpath, filename)
+            files[path] = os.path.getsize(path)
+    return files
+
+
+def instrument_download(down_func, root, metrics):
+    """
+    Wrap a download function to time it and count the downloaded files
+    and bytes below the local root.
+
+    Parameters
+    ----------
+    down_func : function
+        function taking a list of urls and a list of target paths
+    root : string
+        Root folder on local filesystem
+    metrics : merra.metrics.Metrics
+        metrics the download is recorded in
+
+    Returns
+    -------
+    wrapped : function
+        instrumented download function
+    """
+    def wrapped(urls, fnames):
+        before = local_files(root)
+        with metrics.timer('download'):
+            down_func(urls, fnames)
+        after = local_files(root)
+        new = [path for path in after if after[path] != before.get(path)]
+        metrics.count('files', len(new))
+        metrics.count('bytes', sum(after[path] for path in new))
+        metrics.progress(len(new))
+    return wrapped
+
+
+def remote_url(product, date, stream=None, url_root=None):
+    """
+    URL of the file of a day in the GES DISC datapool.
+
+    Parameters
+    ----------
+    product : string
+        short name or product name of the collection
+    date : datetime.datetime
+        day of the file
+    stream : string, optional
+        stream number, by default the one of the production period
+    url_root : string, optional
+        root of the datapool, by default the one of the collection
+
+    Returns
+    -------
+    url : string
+    """
+    collection = get_collection(product)[1]
+    if url_root is None:
+        url_root = collection['root']
+    return '/'.join([url_root, 'data', 'MERRA2',
+                     collection['product'], date.strftime('%Y'),
+                     date.strftime('%m'),
+                     daily_fname(product, date, stream=stream)])
+
+
+def _hyperslab(start, stop, stride=1):
+    """
+    OPeNDAP hyperslab of an index range with inclusive stop.
+    """
+    if stride == 1:
+        return '[{}:{}]'.format(start, stop)
+    return '[{}:{}:{}]'.format(start, stride, stop)
+
+
+def opendap_url(product, date, parameters, hours=None, bbox=None,
+                stream=None, url_root=None):
+    """
+    URL of the OPeNDAP service of GES DISC returning a netCDF4 subset of
+    the file of a day with only the given parameters, hours and region.
+    The subset can be read by :class:`merra.interface.MerraImageStack`.
+
+    Parameters
+    ----------
+    product : string
+        short name or product name of the collection
+    date : datetime.datetime
+        day of the file
+    parameters : list
+        parameters of the subset
+    hours : list of int, optional
+        evenly spaced hours of the day of the subset, all by default
+    bbox : tuple, optional
+        (min_lon, min_lat, max_lon, max_lat) of the subset, the whole
+        globe by default
+    stream : string, optional
+        stream number, by default the one of the production period
+    url_root : string, optional
+        root of the datapool, by default the one of the collection
+
+    Returns
+    -------
+    url : string
+    """
+    if hours is None:
+        hours = list(range(24))
+    hours = sorted(hours)
+    stride = hours[1] - hours[0] if len(hours) > 1 else 1
+    if hours != list(range(hours[0], hours[-1] + 1, stride)):
+        raise ValueError(
+            "The hours {} of an OPeNDAP subset must be evenly "
+            "spaced.".format(hours))
+    rows, cols = (0, 360), (0, 575)
+    if bbox is not None:
+        from merra.grid import bbox_window
+        lat_slice, lon_slice = bbox_window(bbox)
+        rows = (lat_slice.start, lat_slice.stop - 1)
+        cols = (lon_slice.start, lon_slice.stop - 1)
+
+    time = _hyperslab(hours[0], hours[-1], stride)
+    lat, lon = _hyperslab(*rows), _hyperslab(*cols)
+    constraint = ['{}{}{}{}'.format(parameter, time, lat, lon)
+                  for parameter in parameters]
+    constraint += ['time' + time, 'lat' + lat, 'lon' + lon]
+
+    collection = get_collection(product)[1]
+    if url_root is None:
+        url_root = collection['root']
+    return '/'.join([url_root, 'opendap', 'MERRA2', collection['product'],
+                     date.strftime('%Y'), date.strftime('%m'),
+                     daily_fname(product, date, stream=stream) +
+                     '.nc4?' + ','.join(constraint)])
+
+
+def file_subset(path):
+    """
+    OPeNDAP constraint of the subset a local file was downloaded as. It is
+    taken from the record next to the file, the file is only opened if
+    there is no record or the file is newer than its record.
+
+    Parameters
+    ----------
+    path : string
+        path of the local file
+
+    Returns
+    -------
+    constraint : string or None
+        constraint recorded by :func:`record_subset`, empty for whole
+        files, None for files that can not be opened as netCDF
+    """
+    record = path + subset_suffix
+    if (os.path.exists(record) and
+            os.path.getmtime(record) >= os.path.getmtime(path)):
+        with open(record) as f:
+            return f.read()
+
+    from netCDF4 import Dataset
+
+    try:
+        with Dataset(path) as dataset:
+            return str(getattr(dataset, subset_attribute, ''))
+    except (IOError, OSError):
+        return None
+
+
+def _is_subset(path, constraint):
+    """
+    True if a local file was downloaded as the subset of a constraint.
+    Files without a record are taken as whole files without opening them.
+    """
+    if not constraint and not os.path.exists(path + subset_suffix):
+        return True
+    return file_subset(path) == constraint
+
+
+def record_subset(path, constraint):
+    """
+    Record the OPeNDAP constraint of a downloaded subset as global
+    attribute of the file and in a file next to it, so that it is not
+    taken for another subset or the whole file. The record of a whole
+    file is removed.
+
+    Parameters
+    ----------
+    path : string
+        path of the downloaded subset
+    constraint : string
+        OPeNDAP constraint of the subset, empty for a whole file
+    """
+    record = path + subset_suffix
+    if not constraint:
+        if os.path.exists(record):
+            os.remove(record)
+        return
+
+    from netCDF4 import Dataset
+
+    with Dataset(path, 'a') as dataset:
+        dataset.setncattr(subset_attribute, constraint)
+    # written after the file, which is only opened again if it is newer
+    with open(record, 'w') as f:
+        f.write(constraint)
+
+
+def _record_subsets(tasks):
+    """
+    Record the constraint of the downloaded OPeNDAP subsets of tasks.
+    """
+    for url, target in tasks:
+        if os.path.exists(target):
+            record_subset(target, url.partition('?')[2])
+
+
+def local_path(root, product, date, stream=None):
+    """
+    Path of the file of a day below the local root.
+
+    Parameters
+    ----------
+    root : string
+        Root folder on local filesystem
+    product : string
+        short name or product name of the collection
+    date : datetime.datetime
+        day of the file
+    stream : string, optional
+        stream number, by default the one of the production period
+
+    Returns
+    -------
+    path : string
+    """
+    return os.path.join(root, date.strftime('%Y'), date.strftime('%m'),
+                        daily_fname(product, date, stream=stream))
+
+
+def download_tasks(product, start, end, root, skip_existing=True,
+                   url_root=None, parameters=None, hours=None, bbox=None):
+    """
+    Flat list of the URLs and target paths of the days between two dates,
+    without any request to the server. If parameters are given the URLs
+    are OPeNDAP requests of subsets of the files, see
+    :func:`opendap_url`.
+
+    Parameters
+    ----------
+    product : string
+        short name or product name of the collection
+    start : datetime.datetime
+        first day
+    end : datetime.datetime
+        last day
+    root : string
+        Root folder on local filesystem
+    skip_existing : boolean, optional
+        leave out days with a local file of any stream that was downloaded
+        as the same subset or whole file, see :func:`file_subset`. Other
+        files of the day and subsets that can not be opened are downloaded
+        again. Files are only opened for subsets without an up to date
+        record.
+    url_root : string, optional
+        root of the datapool, by default the one of the collection
+    parameters : list, optional
+        parameters of the subsets, by default the whole files are
+        downloaded
+    hours : list of int, optional
+        evenly spaced hours of the day of the subsets
+    bbox : tuple, optional
+        (min_lon, min_lat, max_lon, max_lat) of the subsets
+
+    Returns
+    -------
+    tasks : list
+        (url, target path) of each day
+    """
+    tasks = []
+    day = datetime(start.year, start.month, start.day)
+    while day <= end:
+        pattern = os.path.join(
+            root, day.strftime('%Y'), day.strftime('%m'),
+            fname_template(product).format(datetime=day.strftime('%Y%m%d')))
+        if parameters is None:
+            url = remote_url(product, day, url_root=url_root)
+        else:
+            url = opendap_url(product, day, parameters, hours=hours,
+                              bbox=bbox, url_root=url_root)
+        existing = glob.glob(pattern) if skip_existing else []
+        constraint = url.partition('?')[2]
+        if not any(_is_subset(path, constraint) for path in existing):
+            for path in existing:
+                logger.warning("%s is another subset of the day or can "
+                               "not be read, downloading it again.", path)
+            tasks.append((url, local_path(root, product, day)))
+        day += timedelta(days=1)
+    return tasks
+
+
+def list_remote_folder(url, username=None, password=None):
+    """
+    Names of the nc4 files in the HTML listing of a remote folder.
+
+    Parameters
+    ----------
+    url : string
+        URL of the folder
+    username : string, optional
+        Earthdata login
+    password : string, optional
+        password of the Earthdata login
+
+    Returns
+    -------
+    names : list
+        sorted file names
+    """
+    from urllib import request
+    from http.cookiejar import CookieJar
+
+    handlers = [request.HTTPCookieProcessor(CookieJar())]
+    if username is not None:
+        passwords = request.HTTPPasswordMgrWithDefaultRealm()
+        passwords.add_password(None, 'https://urs.earthdata.nasa.gov',
+                               username, password)
+        handlers.append(request.HTTPBasicAuthHandler(passwords))
+    with request.build_opener(*handlers).open(url) as response:
+        html = response.read().decode('utf-8', 'replace')
+    return sorted(set(posixpath.basename(href) for href in
+                      re.findall(r'href="([^"?#]+\.nc4)"', html)))
+
+
+def missing_tasks(tasks):
+    """
+    Tasks whose target file was not downloaded. Empty files, which wget
+    leaves for URLs that are not found, are removed.
+
+    Parameters
+    ----------
+    tasks : list
+        (url, target path) tuples
+
+    Returns
+    -------
+    missing : list
+        (url, target path) tuples of the missing files
+    """
+    missing = []
+    for url, target in tasks:
+        if os.path.exists(target) and os.path.getsize(target) == 0:
+            os.remove(target)
+        if not os.path.exists(target):
+            missing.append((url, target))
+    return missing
+
+
+def resolve_missing(tasks, username=None, password=None):
+    """
+    Look up the actual file names of days that were not found under the
+    expected name, e.g. of reprocessed days with stream 401. Every remote
+    folder is listed only once, the file name is replaced in the URLs of
+    whole files and of OPeNDAP subsets.
+
+    Parameters
+    ----------
+    tasks : list
+        (url, target path) tuples of the missing files
+    username : string, optional
+        Earthdata login
+    password : string, optional
+        password of the Earthdata login
+
+    Returns
+    -------
+    tasks : list
+        (url, target path) tuples with the listed file names, days that
+        are not in the listing are left out
+    """
+    listings = {}
+    resolved = []
+    for url, target in tasks:
+        path, separator, constraint = url.partition('?')
+        folder, name = path.rsplit('/', 1)
+        fname = os.path.basename(target)
+        # suffix of the response format of OPeNDAP
+        suffix = name[len(fname):]
+        if folder not in listings:
+            try:
+                listings[folder] = list_remote_folder(
+                    folder + '/', username=username, password=password)
+            except IOError as e:
+                logger.warning("Listing of %s failed: %s", folder, e)
+                listings[folder] = []
+        # any stream of the same collection and day
+        pattern = 'MERRA2_*.' + fname.split('.', 1)[1]
+        for listed in fnmatch.filter(listings[folder], pattern):
+            if listed != fname:
+                resolved.append(
+                    ('/'.join([folder, listed + suffix]) + separator +
+                     constraint,
+                     os.path.join(os.path.dirname(target), listed)))
+    return resolved
+
+
+def _day(target):
+    """
+    Date string of the file name of a target path.
+    """
+    return os.path.basename(target).split('.')[-2]
+
+
+def download_files(tasks, down_func, username=None, password=None):
+    """
+    Download a list of files, days that are not found are looked up in
+    the listing of their remote folder and downloaded under the listed
+    name.
+
+    Parameters
+    ----------
+    tasks : list
+        (url, target path) tuples
+    down_func : function
+        function taking a list of urls and a list of target paths
+    username : string, optional
+        Earthdata login for the listing of the remote folders
+    password : string, optional
+        password of the Earthdata login
+
+    Returns
+    -------
+    missing : list
+        (url, target path) tuples that could not be downloaded
+    """
+    if not tasks:
+        return []
+    down_func(*zip(*tasks))
+    missing = missing_tasks(tasks)
+    _record_subsets(task for task in tasks if task not in missing)
+    if missing:
+        logger.info("%d files not found, listing their folders.",
+                    len(missing))
+        resolved = resolve_missing(missing, username=username,
+                                   password=password)
+        resolved_days = set(_day(target) for _, target in resolved)
+        if resolved:
+            down_func(*zip(*resolved))
+        missing = [task for task in missing
+                   if _day(task[1]) not in resolved_days]
+        missing_resolved = missing_tasks(resolved)
+        _record_subsets(task for task in resolved
+                        if task not in missing_resolved)
+        missing += missing_resolved
+    for url, _ in missing:
+        logger.warning("%s could not be downloaded.", url)
+    return missing
 
 
 def main(args):
+    from datedown.down import download
+
     args = parse_args(args)
 
-    dts = list(daily(args.start, args.end))
-    fname = ""
-    url_create_fn = partial(create_dt_url, root=args.urlroot,
-                            fname=fname, subdirs=args.urlsubdirs)
-    fname_create_fn = partial(create_dt_fpath, root=args.localroot,
-                              fname=fname, subdirs=args.localsubdirs)
+    if args.parameters is None and (args.hours or args.bbox):
+        raise ValueError("--hours and --bbox need --parameters.")
+    tasks = download_tasks(args.product, args.start, args.end,
+                           args.localroot, parameters=args.parameters,
+                           hours=args.hours, bbox=args.bbox)
+    metrics = create_metrics('merra_download', total=len(tasks),
+                             metrics_file=args.metrics_file,
+                             metrics_format=args.metrics_format)
+    password = args.password
+    if password is not None:
+        password = "'" + password + "'"
     down_func = partial(download,
                         num_proc=args.n_proc,
                         username=args.username,
-                        password="'" + args.password + "'",
-                        recursive=True,
-                        filetypes=['nc4'])
-    download_by_dt(dts, url_create_fn,
-                   fname_create_fn, down_func,
-                   recursive=True)
+                        password=password)
+    download_files(tasks,
+                   instrument_download(down_func, args.localroot, metrics),
+                   username=args.username, password=args.password)
+    metrics.close()
 
 
 def run():
-    main(sys.argv[1:])
\ No newline at end of file
+    main(sys.argv[1:])
+
+
+if __name__ == '__main__':
+    run()
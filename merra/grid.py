@@ -22,29 +22,282 @@
 
 """
 The grid module implements the asymmetrical GMAO 0.5 x 0.625 grid
-used in MERRA2 as a pygeogrids BasicGrid instance.
+used in MERRA2 as a pygeogrids CellGrid instance. The grid arrays can be
+published once into shared memory or memory mapped files so that worker
+processes attach to them instead of building their own copy.
 """
 
+import os
+import sys
 import numpy as np
-from pygeogrids.grids import BasicGrid
+from pygeogrids.grids import CellGrid, lonlat2cell
+
+# environment variable with the name of the published grid, if set
+# create_merra_cell_grid attaches to it
+shared_grid_env = 'MERRA_SHARED_GRID'
+
+# (lat, lon) shape and resolution of the MERRA2 grid
+grid_shape = (361, 576)
+lat_res = 0.5
+lon_res = 0.625
+
+# name and type of the published grid arrays
+shared_arrays = [('lon', np.float64), ('lat', np.float64),
+                 ('cell', np.int32)]
 
 
 def create_merra_cell_grid():
     """
     Function creates the asymmetrical GMAO 0.5 x 0.625 grid as a
-    BasicGrid instance.
+    MerraCellGrid instance. If the environment variable MERRA_SHARED_GRID is set
+    the arrays of the published grid are used.
 
     Returns
     -------
-    BasicGrid instance
+    MerraCellGrid instance
     """
-    # define horizontal and vertical resolution of asymmetrical grid
-    lon_res = 0.625
-    lat_res = 0.5
+    name = os.environ.get(shared_grid_env)
+    if name:
+        return attach_merra_grid(name)
 
     # create 361 (lat) x 576 (lon) mesh grid
     lon, lat = np.meshgrid(
         np.arange(-180, 180, lon_res),
         np.arange(-90, 90 + lat_res / 2, lat_res)
     )
-    return BasicGrid(lon.flatten(), lat.flatten()).to_cell_grid(cellsize=5.)
+    lon, lat = lon.flatten(), lat.flatten()
+    return MerraCellGrid(lon, lat, lonlat2cell(lon, lat, cellsize=5.))
+
+
+class MerraCellGrid(CellGrid):
+    """
+    CellGrid of the regular MERRA2 grid. The nearest grid point is found
+    from the row and column of the coordinates instead of a KD-tree, so the
+    grid can be shared between processes without every process building
+    its own tree.
+
+    Parameters
+    ----------
+    lon : numpy.ndarray
+        longitudes of the grid points, row by row
+    lat : numpy.ndarray
+        latitudes of the grid points, row by row
+    cells : numpy.ndarray
+        cell of every grid point
+    """
+
+    def __init__(self, lon, lat, cells):
+        super(MerraCellGrid, self).__init__(lon, lat, cells,
+                                            shape=grid_shape)
+
+    def find_k_nearest_gpi(self, lon, lat, max_dist=np.inf, k=1):
+        """
+        Find the nearest grid point, see
+        pygeogrids.grids.BasicGrid.find_k_nearest_gpi. Only k=1 is computed
+        from the row and column, more neighbours are searched in the
+        KD-tree.
+
+        Returns
+        -------
+        gpi : numpy.ndarray
+            grid point indices
+        dist : numpy.ndarray
+            distance of the grid points to lon, lat in spherical cartesian
+            coordinates, like the KD-tree search
+        """
+        if k != 1:
+            return super(MerraCellGrid, self).find_k_nearest_gpi(
+                lon, lat, max_dist=max_dist, k=k)
+
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64)).ravel()
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64)).ravel()
+        # the nearest column is the same in every row, the nearest point is
+        # in one of the two rows around the latitude
+        col = np.round(((lon + 180) % 360) / lon_res).astype(np.int64)
+        col = col % grid_shape[1]
+        row = np.clip(np.floor((lat + 90) / lat_res), 0,
+                      grid_shape[0] - 2).astype(np.int64)
+
+        xyz = np.array(self.geodatum.toECEF(lon, lat))
+        gpi, dist = None, None
+        for candidate_row in (row, row + 1):
+            candidate = candidate_row * grid_shape[1] + col
+            grid_xyz = np.array(self.geodatum.toECEF(
+                self.arrlon[candidate], self.arrlat[candidate]))
+            candidate_dist = np.sqrt(np.sum((xyz - grid_xyz) ** 2, axis=0))
+            if gpi is None:
+                gpi, dist = candidate, candidate_dist
+            else:
+                closer = candidate_dist < dist
+                gpi = np.where(closer, candidate, gpi)
+                dist = np.where(closer, candidate_dist, dist)
+
+        mask = dist > max_dist
+        gpi = gpi.astype(np.int32)
+        gpi[mask] = np.iinfo(np.int32).max
+        dist[mask] = np.inf
+        return gpi, dist
+
+
+def bbox_window(bbox):
+    """
+    Index window of the (lat, lon) arrays of the MERRA2 files containing
+    all grid points within a bounding box.
+
+    Parameters
+    ----------
+    bbox : tuple
+        (min_lon, min_lat, max_lon, max_lat)
+
+    Returns
+    -------
+    lat_slice, lon_slice : slice
+        rows and columns of the window
+    """
+    # tolerance of grid points on the bounds
+    eps = 1e-6
+
+    min_lon, min_lat, max_lon, max_lat = bbox
+    lat_slice = slice(
+        max(int(np.ceil((min_lat + 90) / lat_res - eps)), 0),
+        min(int(np.floor((max_lat + 90) / lat_res + eps)) + 1, 361))
+    lon_slice = slice(
+        max(int(np.ceil((min_lon + 180) / lon_res - eps)), 0),
+        min(int(np.floor((max_lon + 180) / lon_res + eps)) + 1, 576))
+    return lat_slice, lon_slice
+
+
+class SharedGrid(object):
+    """
+    Handle of the MERRA2 grid arrays published with
+    :func:`publish_merra_grid`. Used as context manager it sets
+    MERRA_SHARED_GRID for the processes started within and releases the
+    arrays on exit.
+
+    Parameters
+    ----------
+    name : string
+        name of the shared memory block or folder of the memory mapped
+        files
+    shm : multiprocessing.shared_memory.SharedMemory, optional
+        shared memory block owned by this process
+    """
+
+    def __init__(self, name, shm=None):
+        self.name = name
+        self.shm = shm
+        self._env = None
+
+    def __enter__(self):
+        self._env = os.environ.get(shared_grid_env)
+        os.environ[shared_grid_env] = self.name
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._env is None:
+            os.environ.pop(shared_grid_env, None)
+        else:
+            os.environ[shared_grid_env] = self._env
+        self.close()
+
+    def close(self):
+        """
+        Release the shared memory block. Memory mapped files are kept.
+        """
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+def publish_merra_grid(path=None):
+    """
+    Publish the arrays of the MERRA2 grid for other processes.
+
+    Parameters
+    ----------
+    path : string, optional
+        folder the arrays are written to as .npy files that are memory
+        mapped by the attaching processes. By default the arrays are put
+        into a multiprocessing.shared_memory block (Python 3.8 or later),
+        which is only safe to attach from processes started by
+        multiprocessing before Python 3.13 as the resource tracker of other
+        processes unlinks the block when they exit.
+
+    Returns
+    -------
+    shared : SharedGrid
+        handle with the name to attach to
+    """
+    grid = create_merra_cell_grid()
+    arrays = [grid.arrlon, grid.arrlat, grid.arrcell]
+
+    if path is not None:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for (name, dtype), array in zip(shared_arrays, arrays):
+            np.save(os.path.join(path, name + '.npy'),
+                    np.asarray(array, dtype=dtype))
+        return SharedGrid(path)
+
+    # shared memory needs Python 3.8, the files work on any version
+    from multiprocessing import shared_memory
+
+    n = grid.n_gpi
+    shm = shared_memory.SharedMemory(
+        create=True, size=sum(np.dtype(dtype).itemsize * n
+                              for _, dtype in shared_arrays))
+    for array, shared in zip(arrays, _shared_views(shm.buf, n)):
+        shared[:] = array
+    return SharedGrid(shm.name, shm=shm)
+
+
+def _shared_views(buf, n):
+    """
+    Arrays of the published grid in a shared memory buffer.
+    """
+    views = []
+    offset = 0
+    for _, dtype in shared_arrays:
+        views.append(np.ndarray((n,), dtype=dtype, buffer=buf,
+                                offset=offset))
+        offset += np.dtype(dtype).itemsize * n
+    return views
+
+
+def attach_merra_grid(name):
+    """
+    Create the MERRA2 grid on the read-only arrays published by another
+    process.
+
+    Parameters
+    ----------
+    name : string
+        name of the shared memory block or folder of the memory mapped
+        files, see :func:`publish_merra_grid`
+
+    Returns
+    -------
+    MerraCellGrid instance
+    """
+    if os.path.isdir(name):
+        lon, lat, cell = [np.load(os.path.join(name, array + '.npy'),
+                                  mmap_mode='r')
+                          for array, _ in shared_arrays]
+        return MerraCellGrid(lon, lat, cell)
+
+    from multiprocessing import shared_memory
+
+    if sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        shm = shared_memory.SharedMemory(name=name)
+    n = shm.size // sum(np.dtype(dtype).itemsize
+                        for _, dtype in shared_arrays)
+    lon, lat, cell = _shared_views(shm.buf, n)
+    for array in (lon, lat, cell):
+        array.flags.writeable = False
+    grid = MerraCellGrid(lon, lat, cell)
+    # the block stays mapped as long as the grid exists
+    grid.shared_memory = shm
+    return grid
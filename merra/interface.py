@@ -26,11 +26,27 @@ images, image stacks and time series in the native netCDF4 format.
 """
 
 import os
+import re
+import queue
+import fnmatch
+import logging
+import threading
+import multiprocessing
 import numpy as np
+import pandas as pd
 
-from datetime import timedelta
-from netCDF4 import Dataset
-from merra.grid import create_merra_cell_grid
+from collections import OrderedDict
+from netCDF4 import Dataset, date2num, num2date
+from merra import binary
+from merra import remote
+from merra.grid import create_merra_cell_grid, bbox_window, grid_shape
+from merra.metrics import Metrics
+from merra.packing import Packer
+from merra.profiling import stage
+from merra.stats import open_stats
+from merra.products import (fname_template, get_collection,
+                            split_parameters)
+from merra.transpose import group_by_day
 
 import pygeogrids
 from pygeobase.io_base import ImageBase, MultiTemporalImageBase
@@ -38,6 +54,14 @@ from pygeobase.object_base import Image
 from pygeogrids.netcdf import load_grid
 from pynetcf.time_series import GriddedNcOrthoMultiTs
 
+logger = logging.getLogger(__name__)
+
+# fill value of the MERRA2 files
+merra_fill_value = 1e15
+
+# backends reading the MERRA2 files, see MerraImage
+backends = ['netcdf4', 'h5py', 'references']
+
 
 class MerraImage(ImageBase):
     """
@@ -57,16 +81,58 @@ class MerraImage(ImageBase):
     array_1d: boolean, optional
         if set then the data is read into 1D arrays.
         Needed for some legacy code.
+    grid: pygeogrids.grids.CellGrid, optional
+        MERRA2 grid, can be shared between images to avoid creating it
+        for every file. Created if not given.
+    backend: string, optional
+        'netcdf4' opens local files with the netCDF4 library, 'h5py'
+        opens local files or URLs (e.g. s3://bucket/file.nc4) through
+        fsspec and only fetches the chunks that are read, see
+        :mod:`merra.remote`. 'references' reads the chunks directly at
+        the offsets in the reference file of the file, without the HDF5
+        library, see :mod:`merra.references`.
+    storage_options: dict, optional
+        options of the fsspec file system of the h5py backend, e.g.
+        endpoint_url and credentials of an S3 compatible gateway
+    cache_dir: string, optional
+        folder the blocks fetched by the h5py backend are cached in
+    bbox: tuple, optional
+        (min_lon, min_lat, max_lon, max_lat), only the window of the
+        files containing the bounding box is read. The images keep their
+        shape, grid points outside of the window have the fill value.
+    index_path: string, optional
+        root of the reference files of the references backend, by default
+        the reference file is next to the file
+    fill_value: float, optional
+        value the _FillValue of the files is replaced with, also used for
+        grid points outside of the bbox window. Default: NaN. If None the
+        fill value of the files (1e15) is kept.
     """
 
-    def __init__(self, filename, mode='r', parameter='SFMC', array_1d=False):
+    def __init__(self, filename, mode='r', parameter='SFMC', array_1d=False,
+                 grid=None, backend='netcdf4', storage_options=None,
+                 cache_dir=None, bbox=None, index_path=None,
+                 fill_value=np.nan):
         super(MerraImage, self).__init__(filename, mode=mode)
+        if backend not in backends:
+            raise ValueError("Backend {} is not one of {}".format(
+                backend, backends))
+        self.backend = backend
+        self.storage_options = storage_options
+        self.cache_dir = cache_dir
+        self.index_path = index_path
+        self.window = None
+        if bbox is not None:
+            self.window = bbox_window(bbox)
 
         if not isinstance(parameter, list):
             parameter = [parameter]
         self.parameters = parameter
-        self.fill_values = np.repeat(1e15, 361 * 576)
-        self.grid = create_merra_cell_grid()
+        self.fill_value = fill_value
+        if grid is None:
+            with stage('grid'):
+                grid = create_merra_cell_grid()
+        self.grid = grid
         self.array_1d = array_1d
         self.filename = filename
 
@@ -76,18 +142,30 @@ class MerraImage(ImageBase):
 
         Returns
         -------
-        dataset : netCDF4.Dataset object
+        dataset : netCDF4.Dataset, merra.remote.H5Dataset or
+            merra.references.ReferenceDataset object
         """
+        if self.backend == 'h5py':
+            from merra.remote import H5Dataset
+            return H5Dataset(self.filename,
+                             storage_options=self.storage_options,
+                             cache_dir=self.cache_dir)
+        if self.backend == 'references':
+            from merra.references import ReferenceDataset, reference_filename
+            return ReferenceDataset(
+                reference_filename(self.filename, self.index_path),
+                filename=self.filename,
+                storage_options=self.storage_options)
         try:
             dataset = Dataset(self.filename)
+            # fill values are replaced in place by _read_hours
+            dataset.set_auto_maskandscale(False)
             if dataset.data_model in ('NETCDF4', 'NETCDF4_CLASSIC'):
-                print(
-                    "Successfully opened file '{}'.\n".format(
-                        dataset.Filename))
+                logger.debug("Successfully opened file '%s'.",
+                             self.filename)
                 return dataset
         except IOError as e:
-            print(e)
-            print(" ".join([self.filename, "can not be opened."]))
+            logger.error("%s can not be opened: %s", self.filename, e)
             raise e
 
     def read(self, timestamp):
@@ -104,14 +182,15 @@ class MerraImage(ImageBase):
         Image : object
             pygeobase.object_base.Image object
         """
-        print("Reading file: {}".format(self.filename))
+        logger.debug("Reading file: %s", self.filename)
 
         # return selected parameters and metadata for an image
         return_img = {}
         return_metadata = {}
 
         # open dataset
-        dataset = self.open_file()
+        with stage('open'):
+            dataset = self.open_file()
 
         # build parameter list
         param_names = []
@@ -131,21 +210,19 @@ class MerraImage(ImageBase):
                         param_metadata.update(
                             {attr_name: getattr(variable, attr_name)})
 
-                # retrieve data as 3D-array
-                param_stack = dataset.variables[parameter][:]
-
                 # only retrieve the image at the given timestamp
-                param_data = param_stack[timestamp.hour]
-
-                if not isinstance(param_data, np.ma.masked_array):
-                    param_data = param_data.flatten()
-                else:
-                    # masked array to 1d nd-array
-                    param_data = np.ma.getdata(param_data).flatten()
+                try:
+                    param_data = self._read_hours(
+                        variable, [timestamp.hour],
+                        subset=_file_subset(dataset, variable))[0]
+                except IOError:
+                    dataset.close()
+                    raise
 
                 # update data and metadata dicts depending on declared params
-                return_img.update(
-                    {parameter: param_data[self.grid.activegpis]})
+                with stage('index'):
+                    return_img.update(
+                        {parameter: param_data[self.grid.activegpis]})
                 return_metadata.update({parameter: param_metadata})
 
                 # Check for corrupt files
@@ -153,13 +230,15 @@ class MerraImage(ImageBase):
                     return_img[parameter]
                 except KeyError:
                     path, file_name = os.path.split(self.filename)
-                    print(
-                        '%s in %s is corrupt - filling image with NaN values' %
-                        (parameter, file_name))
+                    logger.warning(
+                        '%s in %s is corrupt - filling image with NaN values',
+                        parameter, file_name)
                     return_img[parameter] = np.empty(
                         self.grid.n_gpi).fill(np.nan)
                     return_metadata['corrupt_parameters'].append()
 
+        dataset.close()
+
         if self.array_1d:
             return Image(self.grid.activearrlon,
                          self.grid.activearrlat,
@@ -169,17 +248,152 @@ class MerraImage(ImageBase):
         else:
             # iterate trough return_img dict and reshape nd-array to 361 x 576
             # matrix
-            for key in return_img:
-                print(key)
-                return_img[key] = np.flipud(
-                    return_img[key].reshape((361, 576)))
+            with stage('flipud'):
+                for key in return_img:
+                    return_img[key] = np.flipud(
+                        return_img[key].reshape((361, 576)))
+                lon = np.flipud(self.grid.activearrlon.reshape((361, 576)))
+                lat = np.flipud(self.grid.activearrlat.reshape((361, 576)))
 
             # return Image object for called parameters
-            return Image(np.flipud(self.grid.activearrlon.reshape((361, 576))),
-                         np.flipud(self.grid.activearrlat.reshape((361, 576))),
-                         return_img,
-                         return_metadata,
-                         timestamp)
+            return Image(lon, lat, return_img, return_metadata, timestamp)
+
+    def read_block(self, hours, metrics=None):
+        """
+        Reads several hourly images of the file at once as a block. Only
+        the requested hours are read from the file and the file is opened
+        only once.
+
+        Parameters
+        ----------
+        hours : list of int
+            hours of the day (index along the time axis of the file)
+        metrics : merra.metrics.Metrics, optional
+            if given the open, read and decode stages are timed and the
+            number of images and bytes are counted
+
+        Returns
+        -------
+        data : dict
+            (hour, gpi) array of each parameter, the gpis are in the order
+            of the 1D images
+        metadata : dict
+            long_name and units of each parameter
+        """
+        data = {}
+        metadata = {}
+
+        if metrics is None:
+            metrics = Metrics()
+
+        with metrics.timer('open'), stage('open'):
+            dataset = self.open_file()
+        try:
+            for parameter in self.parameters:
+                variable = dataset.variables[parameter]
+                metadata[parameter] = {
+                    attr_name: getattr(variable, attr_name)
+                    for attr_name in variable.ncattrs()
+                    if attr_name in ['long_name', 'units']}
+
+                param_block = self._read_hours(
+                    variable, list(hours), metrics=metrics,
+                    subset=_file_subset(dataset, variable))
+                with metrics.timer('decode'), stage('index'):
+                    data[parameter] = param_block[:, self.grid.activegpis]
+                metrics.count('bytes', data[parameter].nbytes)
+            if self.backend != 'netcdf4':
+                metrics.count('fetched_bytes', dataset.bytes_fetched)
+        finally:
+            dataset.close()
+        metrics.count('images', len(hours))
+
+        return data, metadata
+
+    def _read_hours(self, variable, hours, metrics=None, subset=None):
+        """
+        Read hours of a variable within the window as (hour, gpi) array of
+        the whole grid.
+
+        Parameters
+        ----------
+        variable : netCDF4.Variable or merra.remote.H5Variable
+            (time, lat, lon) variable
+        hours : list of int
+            hours of the day in ascending order
+        metrics : merra.metrics.Metrics, optional
+            metrics the read and decode stages are recorded in
+        subset : tuple, optional
+            hours, first row and first column of the variable if the file
+            is a subset, see :func:`_file_subset`
+
+        Returns
+        -------
+        data : numpy.ndarray
+            (hour, gpi) array, fill value outside of the window
+        """
+        if metrics is None:
+            metrics = Metrics()
+
+        file_fill_value = _file_fill_value(variable)
+        fill_value = self.fill_value
+        if fill_value is None:
+            fill_value = file_fill_value
+
+        if subset is not None:
+            return self._read_subset(variable, hours, subset, fill_value,
+                                     file_fill_value, metrics)
+
+        if self.window is None:
+            with metrics.timer('read'), stage('decompress'):
+                block = variable[hours]
+            with metrics.timer('decode'), stage('mask'):
+                block[block == file_fill_value] = fill_value
+                return block.reshape((len(hours), -1))
+
+        lat_slice, lon_slice = self.window
+        with metrics.timer('read'), stage('decompress'):
+            block = variable[hours, lat_slice, lon_slice]
+        with metrics.timer('decode'), stage('mask'):
+            block[block == file_fill_value] = fill_value
+            data = np.full((len(hours),) + tuple(variable.shape[1:]),
+                           fill_value, dtype=variable.dtype)
+            data[:, lat_slice, lon_slice] = block
+            return data.reshape((len(hours), -1))
+
+    def _read_subset(self, variable, hours, subset, fill_value,
+                     file_fill_value, metrics):
+        """
+        Read hours of a variable of a subsetted file within the window and
+        place them into the whole grid.
+        """
+        file_hours, row, col = subset
+        index = np.searchsorted(file_hours, hours)
+        if (index >= file_hours.size).any() or \
+                (file_hours[np.minimum(index, file_hours.size - 1)] !=
+                 hours).any():
+            raise IOError("Hours {} are not in the subset {}".format(
+                hours, self.filename))
+
+        lat_slice, lon_slice = self.window or (slice(0, grid_shape[0]),
+                                               slice(0, grid_shape[1]))
+        rows = slice(max(lat_slice.start, row),
+                     min(lat_slice.stop, row + variable.shape[1]))
+        cols = slice(max(lon_slice.start, col),
+                     min(lon_slice.stop, col + variable.shape[2]))
+        data = np.full((len(hours),) + grid_shape, fill_value,
+                       dtype=variable.dtype)
+        if rows.start >= rows.stop or cols.start >= cols.stop:
+            return data.reshape((len(hours), -1))
+
+        with metrics.timer('read'), stage('decompress'):
+            block = variable[index.tolist(),
+                             rows.start - row:rows.stop - row,
+                             cols.start - col:cols.stop - col]
+        with metrics.timer('decode'), stage('mask'):
+            block[block == file_fill_value] = fill_value
+            data[:, rows, cols] = block
+            return data.reshape((len(hours), -1))
 
     def write(self, image, **kwargs):
         """
@@ -206,6 +420,129 @@ class MerraImage(ImageBase):
         pass
 
 
+def _file_subset(dataset, variable):
+    """
+    Hours, first row and first column of a variable of a file that is a
+    temporal or spatial subset of a MERRA2 file, e.g. downloaded with
+    ``merra_download --parameters``.
+
+    Parameters
+    ----------
+    dataset : netCDF4.Dataset
+        dataset of the file
+    variable : netCDF4.Variable
+        (time, lat, lon) variable of the dataset
+
+    Returns
+    -------
+    subset : tuple
+        hours of the day along the time axis, row of the first latitude and
+        column of the first longitude within the whole grid, None if the
+        variable covers the whole day and grid
+    """
+    if tuple(variable.shape) == (24,) + grid_shape:
+        return None
+    # minutes since 00:30 of the day
+    minutes = np.asarray(dataset.variables['time'][:])
+    lat = dataset.variables['lat'][:1]
+    lon = dataset.variables['lon'][:1]
+    return ((minutes // 60).astype(int),
+            int(round((float(lat[0]) + 90) / 0.5)),
+            int(round((float(lon[0]) + 180) / 0.625)))
+
+
+def _file_fill_value(variable):
+    """
+    Fill value of a variable in its own dtype, 1e15 of the MERRA2 files if
+    the variable has none.
+    """
+    for name in ['_FillValue', 'missing_value']:
+        value = getattr(variable, name, None)
+        if value is not None:
+            return variable.dtype.type(value)
+    return variable.dtype.type(merra_fill_value)
+
+
+def image_timestamps(start_date, end_date, hours):
+    """
+    Timestamps of the hourly images between two dates as numpy array.
+
+    Parameters
+    ----------
+    start_date: datetime.datetime
+        start of date range, images before this time are excluded
+    end_date: datetime.datetime
+        end of date range. A date without time (midnight) includes all
+        images of that day, otherwise images after this time are excluded.
+    hours: list of int
+        hours of the day of the images, the images are centered at half
+        past the hour
+
+    Returns
+    -------
+    timestamps : numpy.ndarray
+        datetime64[m] array of the timestamps in ascending order
+    """
+    start = np.datetime64(start_date, 'm')
+    end = np.datetime64(end_date, 'm')
+    if end == end.astype('datetime64[D]'):
+        end = end + np.timedelta64(1, 'D') - np.timedelta64(1, 'm')
+    days = np.arange(start.astype('datetime64[D]'),
+                     end.astype('datetime64[D]') + np.timedelta64(1, 'D'))
+    offsets = (np.unique(hours) * 60 + 30).astype('timedelta64[m]')
+    timestamps = (days.astype('datetime64[m]')[:, np.newaxis] +
+                  offsets[np.newaxis, :]).ravel()
+    return timestamps[(timestamps >= start) & (timestamps <= end)]
+
+
+def available_days(data_path, collection, start_date, end_date,
+                   storage_options=None):
+    """
+    Days with a file of a collection in the YYYY/MM folders, each month
+    folder is listed once.
+
+    Parameters
+    ----------
+    data_path : string
+        root path of the collection
+    collection : string
+        short name or product name of the collection
+    start_date: datetime.datetime
+        start of date range
+    end_date: datetime.datetime
+        end of date range
+    storage_options : dict, optional
+        options of the fsspec file system if data_path is an URL
+
+    Returns
+    -------
+    days : numpy.ndarray
+        datetime64[D] array of the days with a file
+    """
+    pattern = re.compile(fnmatch.translate(
+        fname_template(collection).format(datetime='????????')))
+    months = np.arange(np.datetime64(start_date, 'M'),
+                       np.datetime64(end_date, 'M') + np.timedelta64(1, 'M'))
+    days = []
+    for month in months.tolist():
+        if remote.is_remote(data_path):
+            filenames = remote.listdir('/'.join(
+                [data_path.rstrip('/'), month.strftime('%Y'),
+                 month.strftime('%m')]), storage_options)
+        else:
+            folder = os.path.join(data_path, month.strftime('%Y'),
+                                  month.strftime('%m'))
+            if not os.path.isdir(folder):
+                continue
+            filenames = os.listdir(folder)
+        for filename in filenames:
+            if pattern.match(filename):
+                date = filename.split('.')[-2]
+                days.append('{}-{}-{}'.format(date[:4], date[4:6],
+                                              date[6:]))
+    return np.unique(np.array(days, dtype='datetime64[D]'))
+
+
 class MerraImageStack(MultiTemporalImageBase):
     """
     Class for reading the hourly merra2 data. Read image stack between
@@ -213,14 +550,18 @@ class MerraImageStack(MultiTemporalImageBase):
     """
 
     def __init__(self, data_path, parameter='SFMC',
-                 temporal_sampling=6, array_1d=False):
+                 temporal_sampling=6, array_1d=False, collection='lnd',
+                 grid=None, hours=None, available_only=False,
+                 backend='netcdf4', storage_options=None, cache_dir=None,
+                 bbox=None, index_path=None, fill_value=np.nan):
         """
         Initialize MerraImageStack object with a given path.
 
         Parameters
         ----------
         data_path : string
-            path to the nc files
+            path to the nc files, or URL of the folder (e.g.
+            s3://bucket/M2T1NXLND.5.12.4) for the h5py backend
         parameter : string or list, optional
             one or list of parameters to read, see MERRA2 documentation
             for more information
@@ -234,18 +575,67 @@ class MerraImageStack(MultiTemporalImageBase):
         array_1d: boolean, optional
             if set then the data is read into 1D arrays.
             Needed for some legacy code.
+        collection: string, optional
+            short name (e.g. lnd, slv, flx, rad) or product name of the
+            collection, see :mod:`merra.products`
+        grid: pygeogrids.grids.CellGrid, optional
+            MERRA2 grid shared by all images, created if not given
+        hours: list of int, optional
+            hours of the day of the images in the stack, e.g. [3, 9, 15,
+            21]. Overrides temporal_sampling.
+        available_only: boolean, optional
+            only return timestamps of days with a file, by default the
+            timestamps of all days are returned
+        backend: string, optional
+            'netcdf4', 'h5py' or 'references', see :class:`MerraImage`
+        storage_options: dict, optional
+            options of the fsspec file system of the h5py backend
+        cache_dir: string, optional
+            folder the blocks fetched by the h5py backend are cached in
+        bbox: tuple, optional
+            (min_lon, min_lat, max_lon, max_lat), only the window of the
+            files containing the bounding box is read
+        index_path: string, optional
+            root of the reference files of the references backend
+        fill_value: float, optional
+            value the fill value of the files is replaced with, NaN by
+            default, None keeps the fill value of the files
         """
+        if remote.is_remote(data_path) and backend == 'netcdf4':
+            raise ValueError(
+                "Reading from {} needs the h5py or references "
+                "backend".format(data_path))
         # temporal sampling parameter
         self.temporal_sampling = temporal_sampling
+        if hours is None:
+            hours = list(range(0, 24, temporal_sampling))
+        self.hours = sorted(hours)
+        self.available_only = available_only
+        self.data_path = data_path
+        self.collection = collection
+        self.storage_options = storage_options
+        self.fill_value = fill_value
+
+        if grid is None:
+            with stage('grid'):
+                grid = create_merra_cell_grid()
+        self.grid = grid
 
         ioclass_kws = {'parameter': parameter,
-                       'array_1d': array_1d}
+                       'array_1d': array_1d,
+                       'grid': grid,
+                       'backend': backend,
+                       'storage_options': storage_options,
+                       'cache_dir': cache_dir,
+                       'bbox': bbox,
+                       'index_path': index_path,
+                       'fill_value': fill_value}
 
         # define sub paths of root folder
         sub_path = ['%Y', '%m']
 
         # define fn template for 1h data
-        fn_template = "MERRA2_*.tavg1_2d_lnd_Nx.{datetime}.nc4"
+        fn_template = fname_template(collection)
 
         super(MerraImageStack, self).__init__(path=data_path,
                                               ioclass=MerraImage,
@@ -270,61 +660,1524 @@ class MerraImageStack(MultiTemporalImageBase):
         Returns
         -------
         timestamps : list
-            list of datetime objects of each available image between
-            start_date and end_date
+            list of datetime objects of each image between start_date and
+            end_date, see :meth:`timestamp_array`
+        """
+        return self.timestamp_array(start_date, end_date).tolist()
+
+    @property
+    def missing_value(self):
+        """
+        Value of missing data in the images, the fill_value or the fill
+        value of the files if it is kept.
         """
-        # get every nth element where n is specified by "temporal_sampling"
-        hours = list(range(24))
-        img_offsets = np.array([timedelta(hours=i, minutes=30)
-                                for i in hours[::self.temporal_sampling]])
+        if self.fill_value is None:
+            return merra_fill_value
+        return self.fill_value
 
-        timestamps = []
-        diff = end_date - start_date
-        for i in range(diff.days + 1):
-            daily_dates = start_date + timedelta(days=i) + img_offsets
-            timestamps.extend(daily_dates.tolist())
+    def timestamp_array(self, start_date, end_date):
+        """
+        Timestamps of the images of the stack between two dates.
+
+        Parameters
+        ----------
+        start_date: datetime.datetime
+            start of date range, images before this time are excluded
+        end_date: datetime.datetime
+            end of date range. A date without time includes all images of
+            that day, otherwise images after this time are excluded.
 
+        Returns
+        -------
+        timestamps : numpy.ndarray
+            datetime64[m] array of the timestamps, only of days with a
+            local file if available_only is set
+        """
+        timestamps = image_timestamps(start_date, end_date, self.hours)
+        if self.available_only:
+            days = available_days(self.data_path, self.collection,
+                                  start_date, end_date,
+                                  storage_options=self.storage_options)
+            timestamps = timestamps[np.isin(
+                timestamps.astype('datetime64[D]'), days)]
         return timestamps
 
+    def _build_filename(self, timestamp, custom_templ=None, str_param=None):
+        """
+        Search the file of a timestamp, timed as the glob stage if
+        profiling is enabled.
+        """
+        with stage('glob'):
+            return super(MerraImageStack, self)._build_filename(
+                timestamp, custom_templ=custom_templ, str_param=str_param)
 
-class MerraTs(GriddedNcOrthoMultiTs):
+    def _search_files(self, timestamp, custom_templ=None, str_param=None,
+                      custom_datetime_format=None):
+        """
+        Search the files of a timestamp, in the folder of an URL with the
+        fsspec file system of the protocol.
+        """
+        if not remote.is_remote(self.path):
+            return super(MerraImageStack, self)._search_files(
+                timestamp, custom_templ=custom_templ, str_param=str_param,
+                custom_datetime_format=custom_datetime_format)
+        fname_templ = (custom_templ or self.fname_templ).format(
+            **{self.dtime_placeholder:
+               custom_datetime_format or self.datetime_format})
+        if str_param is not None:
+            fname_templ = fname_templ.format(**str_param)
+        parts = [self.path.rstrip('/')]
+        parts += [timestamp.strftime(s) for s in self.subpath_templ or []]
+        parts.append(timestamp.strftime(fname_templ))
+        return remote.glob('/'.join(parts), self.storage_options)
+
+    def read(self, timestamp, **kwargs):
+        """
+        Read the image of a timestamp, timed as the stack_read stage if
+        profiling is enabled.
+
+        Parameters
+        ----------
+        timestamp : datetime.datetime
+            exact timestamp of the image
+
+        Returns
+        -------
+        Image : object
+            pygeobase.object_base.Image object
+        """
+        with stage('stack_read'):
+            return super(MerraImageStack, self).read(timestamp, **kwargs)
+
+    def read_block(self, day, hours, metrics=None):
+        """
+        Read several hourly images of one day file at once.
+
+        Parameters
+        ----------
+        day : datetime.datetime
+            day of the file
+        hours : list of int
+            hours of the day to read
+        metrics : merra.metrics.Metrics, optional
+            metrics the reading stages are recorded in
+
+        Returns
+        -------
+        data : dict
+            (hour, gpi) array of each parameter
+        metadata : dict
+            long_name and units of each parameter
+        """
+        filename = self._build_filename(day)
+        img = self.ioclass(filename, **self.ioclass_kws)
+        return img.read_block(hours, metrics=metrics)
+
+    def iter_arrays(self, start_date, end_date, read_ahead=0, metrics=None):
+        """
+        Stream the data of all images between two dates without creating
+        Image objects, see :func:`stream_images`.
+
+        Parameters
+        ----------
+        start_date: datetime.datetime
+            start of date range
+        end_date: datetime.datetime
+            end of date range
+        read_ahead: int, optional
+            number of day files read ahead in a background thread, 0 reads
+            in the calling thread
+        metrics : merra.metrics.Metrics, optional
+            metrics the reading stages are recorded in
+
+        Yields
+        ------
+        timestamp : datetime.datetime
+            timestamp of the image
+        data : dict
+            1D array of each parameter, the grid points are in the order of
+            grid.activegpis
+        """
+        return stream_images(self, start_date, end_date,
+                             read_ahead=read_ahead, metrics=metrics)
+
+    def map_images(self, func, start_date, end_date, n_proc=1, shape=None,
+                   dtype=None):
+        """
+        Apply a function to all images between two dates in a process
+        pool, see :func:`map_images`.
+
+        Parameters
+        ----------
+        func : function
+            function of (timestamp, data) returning an array of the same
+            shape and type for every image
+        start_date: datetime.datetime
+            start of date range
+        end_date: datetime.datetime
+            end of date range
+        n_proc : int, optional
+            number of worker processes
+        shape : tuple, optional
+            shape of the result of func
+        dtype : numpy.dtype, optional
+            data type of the result of func
+
+        Returns
+        -------
+        timestamps : list
+            timestamps of the images that could be read
+        results : numpy.ndarray
+            results of func stacked along the first axis in timestamp order
+        """
+        return map_images(self, func, start_date, end_date, n_proc=n_proc,
+                          shape=shape, dtype=dtype)
+
+
+class MerraMultiImageStack(object):
     """
-    Read MERRA2 time series data under a given path.
+    Read parameters of several MERRA2 collections (e.g. land, single-level
+    and surface flux diagnostics) for the same timestamp in one pass. All
+    collections share one grid.
     """
 
-    def __init__(self, ts_path=None, grid_path=None, **kwargs):
+    def __init__(self, data_paths, parameter, temporal_sampling=6,
+                 array_1d=False, hours=None, available_only=False,
+                 backend='netcdf4', storage_options=None, cache_dir=None,
+                 bbox=None, index_path=None, fill_value=np.nan):
         """
-        Initialize MerraTs object with path to data repository. Use to read
-        time series data at a given location.
+        Initialize MerraMultiImageStack object with the paths of the
+        collections.
 
         Parameters
         ----------
-        ts_path : string
-            path to the nc file directory
-        grid_path : string
-            path to grid.nc file
+        data_paths : dict
+            path to the nc files of each collection, with the short name
+            or product name of the collection as key
+        parameter : dict or list
+            list of parameters of each collection or a list of parameters
+            of the form collection:parameter, e.g. ['SFMC', 'slv:T2M'].
+            Parameters without collection belong to the lnd collection.
+        temporal_sampling: int in range (1, 24)
+            When stacking, get an image every n hours where
+            n = temporal_sampling.
+        array_1d: boolean, optional
+            if set then the data is read into 1D arrays.
+        hours: list of int, optional
+            hours of the day of the images, overrides temporal_sampling
+        available_only: boolean, optional
+            only return timestamps of days with a file of every collection
+        backend: string, optional
+            'netcdf4', 'h5py' or 'references', see :class:`MerraImage`
+        storage_options: dict, optional
+            options of the fsspec file system of the h5py backend
+        cache_dir: string, optional
+            folder the blocks fetched by the h5py backend are cached in
+        bbox: tuple, optional
+            (min_lon, min_lat, max_lon, max_lat), only the window of the
+            files containing the bounding box is read
+        index_path: string, optional
+            root of the reference files of the references backend
+        fill_value: float, optional
+            value the fill value of the files is replaced with, NaN by
+            default, None keeps the fill value of the files
+        """
+        self.temporal_sampling = temporal_sampling
+        self.fill_value = fill_value
+        self.grid = create_merra_cell_grid()
 
-        Optional keyword arguments that are passed to the Gridded Base:
-        ---------------------------------------------------------------------
-        parameters : list, optional (default: None)
-            Specific variable names to read, if None are selected,
-            all are read.
-        ioclass_kws: dict
+        data_paths = {get_collection(name)[0]: path
+                      for name, path in data_paths.items()}
+        grouped = split_parameters(parameter)
+        names = [name for params in grouped.values() for name in params]
+        if len(names) != len(set(names)):
+            raise ValueError(
+                "Parameter names must be unique over all collections.")
 
-        Optional keyword arguments to pass to OrthoMultiTs class:
-        ---------------------------------------------------------------------
-            read_bulk : boolean, optional (default:False)
-                if set to True the data of all locations is read into memory,
-                and subsequent calls to read_ts read from the cache and not
-                from disk this makes reading complete files faster
-            read_dates : boolean, optional (default:False)
-                if false dates will not be read automatically but only on
-                specific request useable for bulk reading because currently
-                the netCDF num2date routine is very slow for big datasets.
+        self.stacks = OrderedDict()
+        for collection, params in grouped.items():
+            if collection not in data_paths:
+                raise ValueError(
+                    "No data path given for collection {}".format(
+                        collection))
+            self.stacks[collection] = MerraImageStack(
+                data_paths[collection], parameter=params,
+                temporal_sampling=temporal_sampling, array_1d=array_1d,
+                collection=collection, grid=self.grid, hours=hours,
+                available_only=available_only, backend=backend,
+                storage_options=storage_options, cache_dir=cache_dir,
+                bbox=bbox, index_path=index_path, fill_value=fill_value)
+
+    def tstamps_for_daterange(self, start_date, end_date):
         """
+        Return timestamps for a given date range.
 
-        if grid_path is None:
-            grid_path = os.path.join(ts_path, "grid.nc")
+        Parameters
+        ----------
+        start_date: datetime.datetime
+            start of date range
+        end_date: datetime.datetime
+            end of date range
 
-        grid = pygeogrids.netcdf.load_grid(grid_path)
-        super(MerraTs, self).__init__(ts_path, grid, **kwargs)
\ No newline at end of file
+        Returns
+        -------
+        timestamps : list
+            list of datetime objects of each image between start_date and
+            end_date
+        """
+        return self.timestamp_array(start_date, end_date).tolist()
+
+    @property
+    def missing_value(self):
+        """
+        Value of missing data in the images, the fill_value or the fill
+        value of the files if it is kept.
+        """
+        if self.fill_value is None:
+            return merra_fill_value
+        return self.fill_value
+
+    def timestamp_array(self, start_date, end_date):
+        """
+        Timestamps of the images between two dates, see
+        :meth:`MerraImageStack.timestamp_array`. With available_only only
+        days with a file of every collection are returned.
+
+        Parameters
+        ----------
+        start_date: datetime.datetime
+            start of date range
+        end_date: datetime.datetime
+            end of date range
+
+        Returns
+        -------
+        timestamps : numpy.ndarray
+            datetime64[m] array of the timestamps
+        """
+        stacks = list(self.stacks.values())
+        timestamps = stacks[0].timestamp_array(start_date, end_date)
+        for stack in stacks[1:]:
+            timestamps = np.intersect1d(
+                timestamps, stack.timestamp_array(start_date, end_date))
+        return timestamps
+
+    def read(self, timestamp, **kwargs):
+        """
+        Read the parameters of all collections at a timestamp.
+
+        Parameters
+        ----------
+        timestamp : datetime.datetime
+            exact timestamp of the image
+
+        Returns
+        -------
+        Image : object
+            pygeobase.object_base.Image object with the parameters of all
+            collections
+        """
+        data = {}
+        metadata = {}
+        for stack in self.stacks.values():
+            image = stack.read(timestamp, **kwargs)
+            data.update(image.data)
+            metadata.update(image.metadata)
+        return Image(image.lon, image.lat, data, metadata, timestamp)
+
+    def read_block(self, day, hours, metrics=None):
+        """
+        Read several hourly images of one day from all collections.
+
+        Parameters
+        ----------
+        day : datetime.datetime
+            day of the files
+        hours : list of int
+            hours of the day to read
+        metrics : merra.metrics.Metrics, optional
+            metrics the reading stages are recorded in
+
+        Returns
+        -------
+        data : dict
+            (hour, gpi) array of each parameter
+        metadata : dict
+            long_name and units of each parameter
+        """
+        data = {}
+        metadata = {}
+        for stack in self.stacks.values():
+            stack_data, stack_metadata = stack.read_block(day, hours,
+                                                          metrics=metrics)
+            data.update(stack_data)
+            metadata.update(stack_metadata)
+        return data, metadata
+
+    def iter_images(self, start_date, end_date, **kwargs):
+        """
+        Iterate over the images of all collections between two dates.
+
+        Parameters
+        ----------
+        start_date: datetime.datetime
+            start of date range
+        end_date: datetime.datetime
+            end of date range
+
+        Yields
+        ------
+        Image : object
+            pygeobase.object_base.Image object
+        """
+        for timestamp in self.tstamps_for_daterange(start_date, end_date):
+            yield self.read(timestamp, **kwargs)
+
+    def iter_arrays(self, start_date, end_date, read_ahead=0, metrics=None):
+        """
+        Stream the data of all images between two dates without creating
+        Image objects, see :func:`stream_images`.
+
+        Parameters
+        ----------
+        start_date: datetime.datetime
+            start of date range
+        end_date: datetime.datetime
+            end of date range
+        read_ahead: int, optional
+            number of day files read ahead in a background thread, 0 reads
+            in the calling thread
+        metrics : merra.metrics.Metrics, optional
+            metrics the reading stages are recorded in
+
+        Yields
+        ------
+        timestamp : datetime.datetime
+            timestamp of the image
+        data : dict
+            1D array of each parameter, the grid points are in the order of
+            grid.activegpis
+        """
+        return stream_images(self, start_date, end_date,
+                             read_ahead=read_ahead, metrics=metrics)
+
+    def close(self):
+        """
+        Close the open files of all collections.
+        """
+        for stack in self.stacks.values():
+            stack.close()
+
+    def map_images(self, func, start_date, end_date, n_proc=1, shape=None,
+                   dtype=None):
+        """
+        Apply a function to all images between two dates in a process
+        pool, see :func:`map_images`.
+
+        Parameters
+        ----------
+        func : function
+            function of (timestamp, data) returning an array of the same
+            shape and type for every image
+        start_date: datetime.datetime
+            start of date range
+        end_date: datetime.datetime
+            end of date range
+        n_proc : int, optional
+            number of worker processes
+        shape : tuple, optional
+            shape of the result of func
+        dtype : numpy.dtype, optional
+            data type of the result of func
+
+        Returns
+        -------
+        timestamps : list
+            timestamps of the images that could be read
+        results : numpy.ndarray
+            results of func stacked along the first axis in timestamp order
+        """
+        return map_images(self, func, start_date, end_date, n_proc=n_proc,
+                          shape=shape, dtype=dtype)
+
+
+def _read_days(dataset, days, metrics):
+    """
+    Read the images of each day as one block, days that can not be read
+    are skipped.
+
+    Parameters
+    ----------
+    dataset : MerraImageStack or MerraMultiImageStack
+        image stack to read
+    days : list
+        (day, [(position, timestamp), ...]) tuples, see
+        :func:`merra.transpose.group_by_day`
+    metrics : merra.metrics.Metrics
+        metrics the reading stages are recorded in
+
+    Yields
+    ------
+    timestamps : list
+        timestamps of the day
+    data : dict
+        (time, gpi) array of each parameter
+    """
+    for day, day_timestamps in days:
+        timestamps = [timestamp for _, timestamp in day_timestamps]
+        try:
+            data, _ = dataset.read_block(
+                day, [timestamp.hour for timestamp in timestamps],
+                metrics=metrics)
+        except IOError as e:
+            logger.warning(e)
+            continue
+        yield timestamps, data
+
+
+def _read_ahead(blocks, read_ahead):
+    """
+    Read blocks in a background thread, at most read_ahead blocks are
+    kept in memory besides the one being consumed.
+
+    Parameters
+    ----------
+    blocks : generator
+        generator reading the blocks
+    read_ahead : int
+        maximum number of blocks read in advance
+
+    Yields
+    ------
+    block : object
+        the blocks of the generator in the same order
+    """
+    buffer = queue.Queue(maxsize=read_ahead)
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        # give up if the consumer has stopped
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for block in blocks:
+                if not put((block, None)):
+                    return
+        except Exception as e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    thread = threading.Thread(target=produce, name='merra-read-ahead')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            block, error = buffer.get()
+            if block is done:
+                if error is not None:
+                    raise error
+                return
+            yield block
+    finally:
+        # stop the reader if the consumer stops early
+        stop.set()
+        thread.join()
+
+
+def stream_images(dataset, start_date, end_date, read_ahead=0,
+                  metrics=None):
+    """
+    Stream the data of all images between two dates as arrays. Every day
+    file is read once as a block and the images are returned as views of
+    the block, no Image objects, coordinate arrays or metadata are created
+    per image. The coordinates of the arrays are the shared
+    grid.activearrlon and grid.activearrlat of the image stack. Memory use
+    is bounded by read_ahead + 1 days of data.
+
+    Parameters
+    ----------
+    dataset : MerraImageStack or MerraMultiImageStack
+        image stack to read
+    start_date: datetime.datetime
+        start of date range
+    end_date: datetime.datetime
+        end of date range
+    read_ahead: int, optional
+        number of day files read ahead in a background thread, 0 reads
+        in the calling thread
+    metrics : merra.metrics.Metrics, optional
+        metrics the reading stages are recorded in
+
+    Yields
+    ------
+    timestamp : datetime.datetime
+        timestamp of the image
+    data : dict
+        1D array of each parameter, the grid points are in the order of
+        grid.activegpis
+    """
+    if metrics is None:
+        metrics = Metrics()
+    days = list(group_by_day(
+        dataset.timestamp_array(start_date, end_date)).items())
+
+    blocks = _read_days(dataset, days, metrics)
+    if read_ahead > 0:
+        blocks = _read_ahead(blocks, read_ahead)
+
+    for timestamps, data in blocks:
+        for i, timestamp in enumerate(timestamps):
+            yield timestamp, {parameter: block[i]
+                              for parameter, block in data.items()}
+
+
+def _apply_day(dataset, func, day, items):
+    """
+    Read the images of one day and apply func to every image.
+
+    Parameters
+    ----------
+    dataset : MerraImageStack or MerraMultiImageStack
+        image stack to read
+    func : function
+        function of (timestamp, data)
+    day : datetime.datetime
+        day of the file
+    items : list
+        (row, timestamp) of each image of the day
+
+    Returns
+    -------
+    results : list
+        (row, result) of every image, empty if the day could not be read
+    """
+    try:
+        data, _ = dataset.read_block(
+            day, [timestamp.hour for _, timestamp in items])
+    except IOError as e:
+        logger.warning(e)
+        return []
+    return [(row, func(timestamp, {parameter: block[i]
+                                   for parameter, block in data.items()}))
+            for i, (row, timestamp) in enumerate(items)]
+
+
+def _map_day(dataset, func, out, day, items):
+    """
+    Read the images of one day and write the result of func for every
+    image into its row of out.
+
+    Parameters
+    ----------
+    dataset : MerraImageStack or MerraMultiImageStack
+        image stack to read
+    func : function
+        function of (timestamp, data)
+    out : numpy.ndarray
+        results of all images
+    day : datetime.datetime
+        day of the file
+    items : list
+        (row, timestamp) of each image of the day
+
+    Returns
+    -------
+    rows : list
+        rows that were written, empty if the day could not be read
+    """
+    rows = []
+    for row, result in _apply_day(dataset, func, day, items):
+        out[row] = result
+        rows.append(row)
+    return rows
+
+
+# image stack, function and shared result array of a map_images worker
+_worker_state = None
+
+
+def _init_map_worker(dataset, func, name, shape, dtype):
+    """
+    Attach a worker of map_images to the shared result array.
+    """
+    from multiprocessing import shared_memory
+
+    global _worker_state
+    shm = shared_memory.SharedMemory(name=name)
+    out = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _worker_state = (dataset, func, out, shm)
+
+
+def _map_worker(task):
+    """
+    Process one day file in a worker of map_images.
+    """
+    dataset, func, out, _ = _worker_state
+    return _map_day(dataset, func, out, *task)
+
+
+def map_images(dataset, func, start_date, end_date, n_proc=1, shape=None,
+               dtype=None):
+    """
+    Apply a function to all images between two dates. The day files are
+    distributed over a pool of n_proc processes which open their files
+    themselves and write the results into a shared memory array, so only
+    the days and the row numbers are sent between the processes.
+
+    Parameters
+    ----------
+    dataset : MerraImageStack or MerraMultiImageStack
+        image stack to read
+    func : function
+        function of (timestamp, data), data being a dict of the 1D image
+        of each parameter, returning an array of the same shape and type
+        for every image. Must be a module level function if the
+        processes are not forked.
+    start_date: datetime.datetime
+        start of date range
+    end_date: datetime.datetime
+        end of date range
+    n_proc : int, optional
+        number of worker processes, 1 processes the images in the calling
+        process. The results of a pool are shared through
+        multiprocessing.shared_memory, which needs Python 3.8.
+    shape : tuple, optional
+        shape of the result of func, determined from the first image if
+        shape or dtype are not given
+    dtype : numpy.dtype, optional
+        data type of the result of func
+
+    Returns
+    -------
+    timestamps : list
+        timestamps of the images that could be read
+    results : numpy.ndarray
+        results of func stacked along the first axis in timestamp order
+    """
+    timestamps = dataset.timestamp_array(start_date, end_date)
+    days = list(group_by_day(timestamps).items())
+
+    # results of the first day if it is read to find the shape and type
+    first = []
+    if shape is None or dtype is None:
+        while days and not first:
+            first = _apply_day(dataset, func, *days.pop(0))
+        if not first:
+            return [], np.empty((0,))
+        result = np.asarray(first[0][1])
+        shape, dtype = result.shape, result.dtype
+    shape = (len(timestamps),) + tuple(shape)
+    dtype = np.dtype(dtype)
+
+    if n_proc == 1:
+        out = np.empty(shape, dtype=dtype)
+        for row, result in first:
+            out[row] = result
+        rows = [row for row, _ in first] + [
+            row for day, items in days
+            for row in _map_day(dataset, func, out, day, items)]
+        rows = sorted(rows)
+        return timestamps[rows].tolist(), out[rows]
+
+    # shared memory needs Python 3.8, only imported for process pools
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(
+        create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    try:
+        out = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        for row, result in first:
+            out[row] = result
+        rows = [row for row, _ in first]
+        # forked workers must not share the files opened by the stack
+        dataset.close()
+        pool = multiprocessing.Pool(
+            n_proc, initializer=_init_map_worker,
+            initargs=(dataset, func, shm.name, shape, dtype))
+        try:
+            rows += [row for day_rows in pool.imap_unordered(_map_worker,
+                                                             days)
+                     for row in day_rows]
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        rows = sorted(rows)
+        results = out[rows]
+        del out
+    finally:
+        shm.close()
+        shm.unlink()
+    return timestamps[rows].tolist(), results
+
+
+def _find_gpi(grid, args):
+    """
+    Grid point of the arguments of the time series readers, either a grid
+    point index or longitude and latitude.
+    """
+    if len(args) == 1:
+        return args[0]
+    return grid.find_nearest_gpi(args[0], args[1])[0]
+
+
+def _contiguous_runs(rows):
+    """
+    Slices of the runs of consecutive indices in sorted indices.
+
+    Parameters
+    ----------
+    rows : numpy.ndarray
+        sorted unique indices
+
+    Returns
+    -------
+    runs : list
+        slice of every run
+    """
+    breaks = np.nonzero(np.diff(rows) != 1)[0] + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.concatenate([breaks, [rows.size]])
+    return [slice(int(rows[start]), int(rows[end - 1]) + 1)
+            for start, end in zip(starts, ends)]
+
+
+def _time_slice(times, start=None, end=None, stride=None):
+    """
+    Index range of the time steps between start and end, both included,
+    found by binary search in the sorted time axis.
+
+    Parameters
+    ----------
+    times : numpy.ndarray
+        sorted time axis
+    start, end : scalar, optional
+        first and last time step in the units of times, open if None
+    stride : int, optional
+        read only every n-th time step of the window
+
+    Returns
+    -------
+    window : slice
+        index range of the time axis
+    """
+    if stride is not None and stride < 1:
+        raise ValueError("stride must be a positive integer")
+    first = 0
+    if start is not None:
+        first = int(np.searchsorted(times, start, side='left'))
+    last = times.size
+    if end is not None:
+        last = int(np.searchsorted(times, end, side='right'))
+    return slice(first, last, stride)
+
+
+# time series reader, function, parameters and period of a map_cells worker
+_cell_worker_state = None
+
+
+def _init_cell_worker(reader, func, parameters, period):
+    """
+    Keep the reader and function of a map_cells worker.
+    """
+    global _cell_worker_state
+    _cell_worker_state = (reader, func, parameters, period)
+
+
+def _cell_worker(cell):
+    """
+    Apply the function of map_cells to one cell in a worker.
+    """
+    reader, func, parameters, period = _cell_worker_state
+    return _map_cell(reader, func, cell, parameters, period)
+
+
+def _map_cell(reader, func, cell, parameters, period):
+    """
+    Read a cell and apply the function of map_cells to it, None if the
+    cell could not be read.
+    """
+    cell_data = reader.read_cell(cell, parameters=parameters, period=period)
+    if cell_data is None:
+        return None
+    return cell, func(cell, *cell_data)
+
+
+class MerraTs(GriddedNcOrthoMultiTs):
+    """
+    Read MERRA2 time series data under a given path. Parameters packed into
+    int16 by ``reshuffle`` are unpacked with their scale_factor and
+    add_offset on reading.
+    """
+
+    def __init__(self, ts_path=None, grid_path=None, **kwargs):
+        """
+        Initialize MerraTs object with path to data repository. Use to read
+        time series data at a given location.
+
+        Parameters
+        ----------
+        ts_path : string
+            path to the nc file directory
+        grid_path : string
+            path to grid.nc file
+
+        Optional keyword arguments that are passed to the Gridded Base:
+        ---------------------------------------------------------------------
+        parameters : list, optional (default: None)
+            Specific variable names to read, if None are selected,
+            all are read.
+        ioclass_kws: dict
+
+        Optional keyword arguments to pass to OrthoMultiTs class:
+        ---------------------------------------------------------------------
+            read_bulk : boolean, optional (default:False)
+                if set to True the data of all locations is read into memory,
+                and subsequent calls to read_ts read from the cache and not
+                from disk this makes reading complete files faster
+            read_dates : boolean, optional (default:False)
+                if false dates will not be read automatically but only on
+                specific request useable for bulk reading because currently
+                the netCDF num2date routine is very slow for big datasets.
+        """
+
+        if grid_path is None:
+            grid_path = os.path.join(ts_path, "grid.nc")
+
+        grid = pygeogrids.netcdf.load_grid(grid_path)
+        super(MerraTs, self).__init__(ts_path, grid, **kwargs)
+        self.ts_path = ts_path
+        # kept open, close() is called for every change of the cell
+        self.stats = None
+        # (cell, units, values) of the last time axis read
+        self._time_axis = None
+        # (cell, rows, gpis) of the locations of the last cell read
+        self._locations = None
+        # lat and lon axes of the grid and (row, col) of the grid points
+        self._grid_index = None
+
+    def __getstate__(self):
+        """
+        The open cell file and statistics are not copied to other
+        processes, they are opened again by the copy.
+        """
+        state = self.__dict__.copy()
+        state.update(fid=None, previous_cell=None, stats=None,
+                     _time_axis=None, _locations=None)
+        return state
+
+    def _close_files(self):
+        """
+        Close the open cell file and the statistics, they are opened again
+        by the next read.
+        """
+        self.close()
+        self.previous_cell = None
+        self._time_axis = None
+        self._locations = None
+        if self.stats is not None:
+            self.stats.close()
+            self.stats = None
+
+    def _read_time_axis(self, cell):
+        """
+        Raw time axis of the open cell file, kept until another cell is
+        read with a time window.
+
+        Parameters
+        ----------
+        cell : int
+            cell number of the open file
+
+        Returns
+        -------
+        units : string
+            units of the time variable
+        times : numpy.ndarray
+            time stamps in these units
+        """
+        if self._time_axis is None or self._time_axis[0] != cell:
+            variable = self.fid.dataset.variables[self.fid.time_var]
+            self._time_axis = (cell, variable.units,
+                               np.asarray(variable[:], dtype=np.float64))
+        return self._time_axis[1:]
+
+    def _read_locations(self, cell):
+        """
+        Grid points stored in the open cell file, kept until another cell
+        is read.
+
+        Parameters
+        ----------
+        cell : int
+            cell number of the open file
+
+        Returns
+        -------
+        rows : numpy.ndarray or slice
+            rows of the location dimension that are in use
+        gpis : numpy.ndarray
+            grid points of these rows
+        """
+        if self._locations is None or self._locations[0] != cell:
+            loc_ids = self.fid.dataset.variables['location_id'][:]
+            rows = np.nonzero(~np.ma.getmaskarray(loc_ids))[0]
+            gpis = np.ma.getdata(loc_ids)[rows]
+            if rows.size == loc_ids.size:
+                rows = slice(None)
+            self._locations = (cell, rows, gpis)
+        return self._locations[1:]
+
+    def _location_rows(self, cell, gpis):
+        """
+        Rows of grid points in the open cell file.
+
+        Parameters
+        ----------
+        cell : int
+            cell number of the open file
+        gpis : numpy.ndarray
+            grid points of the cell
+
+        Returns
+        -------
+        rows : numpy.ndarray
+            row of each grid point
+        """
+        rows, cell_gpis = self._read_locations(cell)
+        if isinstance(rows, slice):
+            rows = np.arange(cell_gpis.size)
+        order = np.argsort(cell_gpis)
+        pos = np.searchsorted(cell_gpis, gpis, sorter=order)
+        pos = order[np.minimum(pos, order.size - 1)]
+        found = cell_gpis[pos] == gpis
+        if not np.all(found):
+            raise IOError(
+                "Grid points {} not found in cell {}".format(
+                    np.asarray(gpis)[~found], cell))
+        return rows[pos]
+
+    def _ts_variables(self):
+        """
+        Names of the (location, time) variables of the open cell file.
+        """
+        return [name for name, variable in
+                self.fid.dataset.variables.items()
+                if variable.dimensions == ('locations', 'time')]
+
+    def _time_window(self, cell, start=None, end=None, stride=None):
+        """
+        Index range and time stamps of a time window of the open cell file.
+
+        Parameters
+        ----------
+        cell : int
+            cell number of the open file
+        start, end : datetime, optional
+            first and last time stamp of the window, both included
+        stride : int, optional
+            every n-th time step of the window
+
+        Returns
+        -------
+        window : slice
+            index range of the time axis
+        index : pandas.DatetimeIndex
+            time stamps of the window
+        """
+        units, times = self._read_time_axis(cell)
+        bounds = [None if date is None else
+                  date2num(pd.Timestamp(date).to_pydatetime(), units,
+                           calendar='standard')
+                  for date in (start, end)]
+        window = _time_slice(times, bounds[0], bounds[1], stride)
+        dates = num2date(times[window], units=units, calendar='standard',
+                         only_use_cftime_datetimes=False,
+                         only_use_python_datetimes=True)
+        return window, pd.DatetimeIndex(dates.astype('datetime64[ns]'))
+
+    def _read_gp(self, gpi, period=None, start=None, end=None, stride=None,
+                 **kwargs):
+        """
+        Read the time series of a grid point. If a period, start, end or
+        stride is given only this window of the time series is read from
+        the cell file instead of the whole time series.
+
+        Parameters
+        ----------
+        gpi : int
+            grid point index
+        period : list, optional
+            [start, end] of the time series, same as start and end
+        start, end : datetime, optional
+            first and last time stamp to read, both included
+        stride : int, optional
+            read only every n-th time step of the window
+
+        Returns
+        -------
+        ts : pandas.DataFrame
+            time series of the selected parameters
+        """
+        if period is not None:
+            start, end = period
+        if start is None and end is None and stride is None:
+            return super(MerraTs, self)._read_gp(gpi, **kwargs)
+        if self.mode in ['w', 'a']:
+            raise IOError("trying to read file is in write/append mode")
+        if not self._open(gpi):
+            return None
+
+        cell = self.grid.gpi2cell(gpi)
+        window, index = self._time_window(cell, start, end, stride)
+        parameters = self.parameters
+        if parameters is None:
+            parameters = self._ts_variables()
+        row = self._location_rows(cell, np.array([gpi]))[0]
+        data = {parameter: self.fid.dataset.variables[parameter][row, window]
+                for parameter in parameters}
+
+        ts = pd.DataFrame(data, index=index)
+        if self.dtypes is not None:
+            for column in self.dtypes:
+                if column in ts.columns:
+                    ts[column] = ts[column].astype(self.dtypes[column])
+        if self.scale_factors is not None:
+            for column in self.scale_factors:
+                if column in ts.columns:
+                    ts[column] *= self.scale_factors[column]
+        if self.offsets is not None:
+            for column in self.offsets:
+                if column in ts.columns:
+                    ts[column] += self.offsets[column]
+        return ts
+
+    def _grid_rowcol(self, gpis):
+        """
+        Row and column of grid points in the (lat, lon) axes of the grid.
+        The axes are those of a 2D grid, or the unique coordinates of the
+        grid points otherwise, and computed once.
+
+        Parameters
+        ----------
+        gpis : numpy.ndarray
+            grid points of the grid
+
+        Returns
+        -------
+        rows, cols : numpy.ndarray
+            row and column of every grid point
+        lat, lon : numpy.ndarray
+            ascending latitudes and longitudes of the grid
+        """
+        if self._grid_index is None:
+            grid = self.grid
+            if len(grid.shape) == 2:
+                lat, lon = grid.lat2d[:, 0], grid.lon2d[0]
+                rows, cols = grid.gpi2rowcol(grid.activegpis)
+            else:
+                lat, rows = np.unique(grid.activearrlat, return_inverse=True)
+                lon, cols = np.unique(grid.activearrlon, return_inverse=True)
+            order = np.argsort(grid.activegpis)
+            self._grid_index = (grid.activegpis[order], rows[order],
+                                cols[order], lat, lon)
+        sorted_gpis, rows, cols, lat, lon = self._grid_index
+        position = np.searchsorted(sorted_gpis, gpis)
+        return rows[position], cols[position], lat, lon
+
+    def read_cube(self, bbox, start=None, end=None, parameters=None,
+                  stride=None, as_xarray=False):
+        """
+        Read all grid points within a bounding box for a time window as
+        (time, lat, lon) cube. Each cell file is read once, only the rows
+        of the grid points in the box, in runs of consecutive rows, and the
+        time steps of the window are read and scattered into the cube at
+        the row and column of the grid points in the grid.
+
+        Parameters
+        ----------
+        bbox : tuple
+            (min_lon, min_lat, max_lon, max_lat)
+        start, end : datetime, optional
+            first and last time stamp to read, both included
+        parameters : list, optional
+            parameters to read, by default the parameters of the reader
+        stride : int, optional
+            read only every n-th time step of the window
+        as_xarray : boolean, optional
+            return a xarray.Dataset, needs the ``cube`` extra
+
+        Returns
+        -------
+        data : dict
+            (time, lat, lon) float32 array of every parameter, NaN where
+            no grid point is stored
+        index : pandas.DatetimeIndex
+            time stamps of the cube
+        lat, lon : numpy.ndarray
+            ascending latitudes and longitudes of the cube
+        cube : xarray.Dataset
+            instead of the arrays if as_xarray is True
+        """
+        min_lon, min_lat, max_lon, max_lat = bbox
+        gpis = self.grid.get_bbox_grid_points(
+            latmin=min_lat, latmax=max_lat, lonmin=min_lon, lonmax=max_lon)
+        if gpis.size == 0:
+            raise ValueError("No grid points within {}".format(bbox))
+        # (row, col) of every grid point in the cube
+        rows, cols, lat, lon = self._grid_rowcol(gpis)
+        lat = lat[rows.min():rows.max() + 1]
+        lon = lon[cols.min():cols.max() + 1]
+        rows, cols = rows - rows.min(), cols - cols.min()
+        cells = self.grid.gpi2cell(gpis)
+
+        if parameters is None:
+            parameters = self.parameters
+        data = None
+        index = None
+        attrs = {}
+        for cell in np.unique(cells):
+            in_cell = np.nonzero(cells == cell)[0]
+            if not self._open(gpis[in_cell[0]]):
+                continue
+            window, cell_index = self._time_window(cell, start, end, stride)
+            if index is None:
+                index = cell_index
+            elif not index.equals(cell_index):
+                raise ValueError(
+                    "Time axis of cell {} differs".format(cell))
+            if parameters is None:
+                parameters = self._ts_variables()
+            if data is None:
+                shape = (index.size, lat.size, lon.size)
+                data = {parameter: np.full(shape, np.nan, dtype=np.float32)
+                        for parameter in parameters}
+
+            loc_rows = self._location_rows(cell, gpis[in_cell])
+            order = np.argsort(loc_rows)
+            in_cell = in_cell[order]
+            runs = _contiguous_runs(loc_rows[order])
+            for parameter in parameters:
+                variable = self.fid.dataset.variables[parameter]
+                values = np.concatenate(
+                    [np.ma.filled(variable[run, window].astype(np.float32),
+                                  np.nan) for run in runs])
+                data[parameter][:, rows[in_cell], cols[in_cell]] = values.T
+                if parameter not in attrs:
+                    attrs[parameter] = {
+                        name: variable.getncattr(name)
+                        for name in ['units', 'long_name']
+                        if name in variable.ncattrs()}
+
+        if data is None:
+            raise IOError("No cell files within {}".format(bbox))
+        if not as_xarray:
+            return data, index, lat, lon
+
+        import xarray as xr
+        return xr.Dataset(
+            {parameter: (('time', 'lat', 'lon'), data[parameter],
+                         attrs[parameter]) for parameter in parameters},
+            coords={'time': index, 'lat': lat, 'lon': lon})
+
+    def read_cell(self, cell, parameters=None, period=None):
+        """
+        Read the time series of all grid points of a cell with one read of
+        every parameter.
+
+        Parameters
+        ----------
+        cell : int
+            cell number
+        parameters : list, optional
+            parameters to read, by default the parameters of the reader
+        period : list, optional
+            [start, end] of the time series, both included
+
+        Returns
+        -------
+        gpis : numpy.ndarray
+            grid points in the order of the cell file
+        lons, lats : numpy.ndarray
+            coordinates of the grid points
+        time : pandas.DatetimeIndex
+            time stamps of the rows of the arrays
+        data : dict
+            (time, gpi) float32 array of every parameter, NaN where no
+            value is stored
+        """
+        if self.mode in ['w', 'a']:
+            raise IOError("trying to read file is in write/append mode")
+        cell_gpis = self.grid.grid_points_for_cell(cell)[0]
+        if cell_gpis.size == 0 or not self._open(cell_gpis[0]):
+            return None
+
+        start, end = (None, None) if period is None else period
+        window, index = self._time_window(cell, start, end)
+        rows, gpis = self._read_locations(cell)
+        lons, lats = self.grid.gpi2lonlat(gpis)
+
+        if parameters is None:
+            parameters = self.parameters
+        if parameters is None:
+            parameters = self._ts_variables()
+        data = {}
+        for parameter in parameters:
+            values = self.fid.dataset.variables[parameter][rows, window]
+            data[parameter] = np.ma.filled(values.astype(np.float32),
+                                           np.nan).T
+        return gpis, lons, lats, index, data
+
+    def iter_cells(self, parameters=None, period=None):
+        """
+        Iterate over the cells of the store in storage order. Each cell
+        file is opened once and only one cell is kept in memory.
+
+        Parameters
+        ----------
+        parameters : list, optional
+            parameters to read, by default the parameters of the reader
+        period : list, optional
+            [start, end] of the time series, both included
+
+        Yields
+        ------
+        cell : int
+            cell number
+        gpis, lons, lats, time, data
+            grid points, coordinates, time stamps and data of the cell, see
+            :meth:`read_cell`
+        """
+        for cell in self.grid.get_cells():
+            cell_data = self.read_cell(cell, parameters=parameters,
+                                       period=period)
+            if cell_data is not None:
+                yield (cell,) + cell_data
+
+    def map_cells(self, func, parameters=None, period=None, n_proc=1):
+        """
+        Apply a function to every cell of the store. The cells are
+        distributed over a pool of n_proc processes, each reading its cells
+        with a copy of the reader.
+
+        Parameters
+        ----------
+        func : function
+            function of (cell, gpis, lons, lats, time, data), see
+            :meth:`iter_cells`. Must be a module level function if the
+            processes are not forked.
+        parameters : list, optional
+            parameters to read, by default the parameters of the reader
+        period : list, optional
+            [start, end] of the time series, both included
+        n_proc : int, optional
+            number of worker processes, 1 processes the cells in the
+            calling process
+
+        Returns
+        -------
+        cells : list
+            cells that could be read, in storage order
+        results : list
+            result of func for each of these cells
+        """
+        cells = self.grid.get_cells()
+        if n_proc == 1:
+            results = [_map_cell(self, func, cell, parameters, period)
+                       for cell in cells]
+        else:
+            # forked workers must not share the open cell file
+            self._close_files()
+            pool = multiprocessing.Pool(
+                n_proc, initializer=_init_cell_worker,
+                initargs=(self, func, parameters, period))
+            try:
+                results = list(pool.imap(_cell_worker, cells))
+            except BaseException:
+                pool.terminate()
+                raise
+            else:
+                pool.close()
+            finally:
+                pool.join()
+        results = [result for result in results if result is not None]
+        return ([cell for cell, _ in results],
+                [result for _, result in results])
+
+    def read_anomalies(self, *args, climatology=True, start=None, end=None,
+                       stride=None):
+        """
+        Read the anomalies of the time series of a grid point against the
+        statistics stored by ``reshuffle`` with ``statistics=True``.
+
+        Parameters
+        ----------
+        args : int or (float, float)
+            either a grid point index or longitude and latitude of the
+            location, the nearest grid point is read in this case
+        climatology : boolean, optional
+            subtract the day of year climatology, otherwise the mean of
+            the whole time series
+        start, end : datetime, optional
+            first and last time stamp to read, both included
+        stride : int, optional
+            read only every n-th time step of the window
+
+        Returns
+        -------
+        anomalies : pandas.DataFrame
+            anomalies of the parameters with statistics
+        """
+        gpi = _find_gpi(self.grid, args)
+        if self.stats is None:
+            self.stats = open_stats(self.ts_path)
+        ts = self.read(gpi, start=start, end=end, stride=stride)
+        return self.stats.anomalies(gpi, ts, climatology=climatology)
+
+
+class MerraBinaryTs(object):
+    """
+    Read MERRA2 time series from the flat binary store written by
+    ``reshuffle`` with ``out_format='binary'``. The cell files are memory
+    mapped, so reading a time series is one contiguous slice of the file.
+    """
+
+    def __init__(self, ts_path, grid_path=None, parameters=None):
+        """
+        Initialize MerraBinaryTs object with path to the store.
+
+        Parameters
+        ----------
+        ts_path : string
+            path to the binary store
+        grid_path : string, optional
+            path to grid.nc file, by default the one in ts_path
+        parameters : list, optional
+            parameters to read, if None all stored parameters are read
+        """
+        if grid_path is None:
+            grid_path = os.path.join(ts_path, "grid.nc")
+
+        self.path = ts_path
+        self.grid = pygeogrids.netcdf.load_grid(grid_path)
+        self.header, timestamps = binary.read_store_header(ts_path)
+        self.index = pd.DatetimeIndex(timestamps)
+        if parameters is None:
+            parameters = self.header['parameters']
+        self.parameters = parameters
+        self.packer = Packer(self.header.get('packing'))
+        self._cells = {}
+        self.stats = None
+
+    def _open_cell(self, cell):
+        """
+        Memory map all parameters of a cell, cells are kept open.
+
+        Parameters
+        ----------
+        cell : int
+            cell number
+
+        Returns
+        -------
+        gpi_index : dict
+            lookup of the row of each gpi in the cell
+        data : dict
+            memory mapped (gpi, time) matrix for each parameter
+        """
+        if cell not in self._cells:
+            header = binary.read_cell_header(self.path, cell)
+            gpi_index = dict(zip(header['gpis'].tolist(),
+                                 range(header['gpis'].size)))
+            data = {}
+            for parameter in self.parameters:
+                dtype = self.header['dtype']
+                if parameter in self.packer.packing:
+                    dtype = self.packer.dtype(parameter)
+                data[parameter] = binary.open_cell_data(
+                    self.path, cell, parameter, header['gpis'].size,
+                    self.header['n_time'], dtype=dtype)
+            self._cells[cell] = (gpi_index, data)
+        return self._cells[cell]
+
+    def read(self, *args, start=None, end=None, stride=None):
+        """
+        Read the time series of a grid point.
+
+        Parameters
+        ----------
+        args : int or (float, float)
+            either a grid point index or longitude and latitude of the
+            location, the nearest grid point is read in this case
+        start, end : datetime, optional
+            first and last time stamp to read, both included, only this
+            window is read from the memory mapped files
+        stride : int, optional
+            read only every n-th time step of the window
+
+        Returns
+        -------
+        ts : pandas.DataFrame
+            time series of the selected parameters
+        """
+        gpi = _find_gpi(self.grid, args)
+        gpi_index, data = self._open_cell(self.grid.gpi2cell(gpi))
+        row = gpi_index[gpi]
+        bounds = [None if date is None else pd.Timestamp(date).asm8
+                  for date in (start, end)]
+        window = _time_slice(self.index.values, bounds[0], bounds[1], stride)
+        return pd.DataFrame({parameter: self.packer.unpack(
+                                 parameter, data[parameter][row, window])
+                             for parameter in self.parameters},
+                            index=self.index[window])
+
+    def read_anomalies(self, *args, climatology=True, start=None, end=None,
+                       stride=None):
+        """
+        Read the anomalies of the time series of a grid point against the
+        statistics stored by ``reshuffle`` with ``statistics=True``.
+
+        Parameters
+        ----------
+        args : int or (float, float)
+            either a grid point index or longitude and latitude of the
+            location, the nearest grid point is read in this case
+        climatology : boolean, optional
+            subtract the day of year climatology, otherwise the mean of
+            the whole time series
+        start, end : datetime, optional
+            first and last time stamp to read, both included
+        stride : int, optional
+            read only every n-th time step of the window
+
+        Returns
+        -------
+        anomalies : pandas.DataFrame
+            anomalies of the parameters with statistics
+        """
+        gpi = _find_gpi(self.grid, args)
+        if self.stats is None:
+            self.stats = open_stats(self.path)
+        ts = self.read(gpi, start=start, end=end, stride=stride)
+        return self.stats.anomalies(gpi, ts, climatology=climatology)
+
+    def close(self):
+        """
+        Release all memory mapped cells and the statistics.
+        """
+        self._cells = {}
+        if self.stats is not None:
+            self.stats.close()
+            self.stats = None
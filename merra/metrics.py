@@ -0,0 +1,266 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019, TU Wien
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The metrics module implements a small instrumentation layer for long running
+conversions and downloads: per stage timers, counters, throughput and an
+estimated time of arrival. Snapshots of the metrics are passed to pluggable
+sinks which export them as JSON lines or as a Prometheus textfile.
+"""
+
+import os
+import json
+import time
+import logging
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    """
+    Collect timers, counters and progress of a run.
+
+    Parameters
+    ----------
+    name : string, optional
+        name of the run, used as prefix of the exported metrics
+    total : int, optional
+        total number of work units (e.g. images), needed for the ETA
+    sinks : list, optional
+        sinks with a write(snapshot) method the metrics are exported to
+    interval : float, optional
+        minimum number of seconds between two progress reports
+    """
+
+    def __init__(self, name='merra', total=None, sinks=None, interval=30.):
+        self.name = name
+        self.total = total
+        self.sinks = sinks or []
+        self.interval = interval
+        self.timers = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.done = 0
+        self.start_time = time.time()
+        self.last_report = self.start_time
+        # the report of the completed run was written
+        self.final_reported = False
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Context manager adding the runtime of the block to a stage.
+
+        Parameters
+        ----------
+        stage : string
+            name of the stage, e.g. open, read, decode, transpose, write
+        """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[stage] += time.perf_counter() - t0
+            self.calls[stage] += 1
+
+    def count(self, counter, n=1):
+        """
+        Increase a counter.
+
+        Parameters
+        ----------
+        counter : string
+            name of the counter, e.g. images, bytes, cells
+        n : int, optional
+            increment
+        """
+        self.counters[counter] += n
+
+    def progress(self, n=1):
+        """
+        Mark work units as done and report if the reporting interval has
+        passed or the run is complete.
+
+        Parameters
+        ----------
+        n : int, optional
+            number of finished work units
+        """
+        self.done += n
+        now = time.time()
+        complete = self.total is not None and self.done >= self.total
+        if complete and not self.final_reported:
+            self.report()
+            self.final_reported = True
+        elif now - self.last_report >= self.interval:
+            self.report()
+
+    def eta(self):
+        """
+        Estimated number of seconds until all work units are done.
+
+        Returns
+        -------
+        eta : float or None
+            None if the total is unknown or nothing is done yet
+        """
+        if self.total is None or self.done == 0:
+            return None
+        elapsed = time.time() - self.start_time
+        return elapsed / self.done * max(self.total - self.done, 0)
+
+    def snapshot(self):
+        """
+        Current state of all metrics.
+
+        Returns
+        -------
+        snapshot : dict
+            elapsed time, progress, ETA, throughput, timers and counters
+        """
+        elapsed = time.time() - self.start_time
+        throughput = {counter: value / elapsed if elapsed > 0 else 0.
+                      for counter, value in self.counters.items()}
+        return {'name': self.name,
+                'time': time.time(),
+                'elapsed': elapsed,
+                'done': self.done,
+                'total': self.total,
+                'eta': self.eta(),
+                'stages': {stage: {'seconds': self.timers[stage],
+                                   'calls': self.calls[stage]}
+                           for stage in self.timers},
+                'counters': dict(self.counters),
+                'throughput': throughput}
+
+    def report(self):
+        """
+        Log the progress and export a snapshot to all sinks.
+        """
+        self.last_report = time.time()
+        snapshot = self.snapshot()
+        if snapshot['eta'] is None:
+            eta = 'unknown'
+        else:
+            eta = '{:.0f}s'.format(snapshot['eta'])
+        stages = ', '.join('{}={:.1f}s'.format(stage, value['seconds'])
+                           for stage, value in snapshot['stages'].items())
+        logger.info('%s: %s/%s done after %.0fs, ETA %s (%s)', self.name,
+                    self.done, self.total, snapshot['elapsed'], eta, stages)
+        for sink in self.sinks:
+            sink.write(snapshot)
+
+    def close(self):
+        """
+        Write the final report, unless it was written when the run was
+        completed.
+        """
+        if not self.final_reported:
+            self.report()
+            self.final_reported = True
+
+
+class JsonLinesSink(object):
+    """
+    Append every snapshot as one JSON line to a file.
+
+    Parameters
+    ----------
+    filename : string
+        path of the JSON lines file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def write(self, snapshot):
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(snapshot) + '\n')
+
+
+class PrometheusSink(object):
+    """
+    Write the latest snapshot as a Prometheus textfile, e.g. for the
+    textfile collector of the node exporter. The file is replaced
+    atomically.
+
+    Parameters
+    ----------
+    filename : string
+        path of the textfile, should end with .prom
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def write(self, snapshot):
+        name = snapshot['name']
+        lines = ['{}_elapsed_seconds {}'.format(name, snapshot['elapsed']),
+                 '{}_done_total {}'.format(name, snapshot['done'])]
+        if snapshot['total'] is not None:
+            lines.append('{}_todo_total {}'.format(name, snapshot['total']))
+        if snapshot['eta'] is not None:
+            lines.append('{}_eta_seconds {}'.format(name, snapshot['eta']))
+        for stage, value in sorted(snapshot['stages'].items()):
+            lines.append('{}_stage_seconds_total{{stage="{}"}} {}'.format(
+                name, stage, value['seconds']))
+            lines.append('{}_stage_calls_total{{stage="{}"}} {}'.format(
+                name, stage, value['calls']))
+        for counter, value in sorted(snapshot['counters'].items()):
+            lines.append('{}_{}_total {}'.format(name, counter, value))
+
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_filename, self.filename)
+
+
+def create_metrics(name, total=None, metrics_file=None,
+                   metrics_format='jsonl'):
+    """
+    Create a Metrics object with the sink selected on the command line.
+
+    Parameters
+    ----------
+    name : string
+        name of the run
+    total : int, optional
+        total number of work units
+    metrics_file : string, optional
+        file the metrics are exported to, no export if not given
+    metrics_format : string, optional
+        'jsonl' or 'prometheus'
+
+    Returns
+    -------
+    metrics : Metrics
+    """
+    sinks = []
+    if metrics_file is not None:
+        if metrics_format == 'prometheus':
+            sinks.append(PrometheusSink(metrics_file))
+        else:
+            sinks.append(JsonLinesSink(metrics_file))
+    return Metrics(name=name, total=total, sinks=sinks)
@@ -0,0 +1,319 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019, TU Wien
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The packing module implements the reduced precision storage of time series.
+Parameters are either packed into 16 bit integers with CF scale_factor and
+add_offset or stored as float16, which halves the size of the files compared
+to float32. The range of the packed integers is taken from an explicit
+configuration, the ranges in default_ranges or the first buffer of data.
+"""
+
+import numpy as np
+
+from collections import OrderedDict
+
+# fill value of packed integers, not part of the packed range
+int16_fill_value = np.int16(-32768)
+int16_max = 32767
+
+# physical range of parameters that are packed into int16 without an
+# explicit range
+default_ranges = OrderedDict([
+    ('SFMC', (0., 1.)),
+    ('RZMC', (0., 1.)),
+    ('GWETPROF', (0., 1.)),
+    ('GWETROOT', (0., 1.)),
+    ('GWETTOP', (0., 1.)),
+    ('TSURF', (150., 350.))])
+
+dtypes = ['int16', 'float16']
+
+
+def parse_packing(packing):
+    """
+    Parse the packing of parameters as given on the command line.
+
+    Parameters
+    ----------
+    packing : list of strings
+        PARAMETER:DTYPE or PARAMETER:int16:MIN:MAX per parameter, or
+        'default' to pack all parameters of default_ranges into int16
+
+    Returns
+    -------
+    packing : OrderedDict
+        packing specification of each parameter, see :class:`Packer`
+    """
+    specs = OrderedDict()
+    for entry in packing:
+        if entry == 'default':
+            for parameter, valid_range in default_ranges.items():
+                specs[parameter] = {'dtype': 'int16',
+                                    'valid_range': valid_range}
+            continue
+        fields = entry.split(':')
+        if len(fields) not in (2, 4):
+            raise ValueError(
+                "Packing {} is not of the form PARAMETER:DTYPE or "
+                "PARAMETER:int16:MIN:MAX".format(entry))
+        spec = {'dtype': fields[1]}
+        if len(fields) == 4:
+            spec['valid_range'] = (float(fields[2]), float(fields[3]))
+        specs[fields[0]] = spec
+    return specs
+
+
+def is_sentinel(missing_value):
+    """
+    True if missing data is marked by a value besides NaN, which is always
+    treated as missing.
+
+    Parameters
+    ----------
+    missing_value : float or None
+        value of missing data
+
+    Returns
+    -------
+    sentinel : boolean
+    """
+    return missing_value is not None and not np.isnan(missing_value)
+
+
+def int16_scaling(valid_range):
+    """
+    Scale factor and offset mapping a range onto the int16 values
+    -32767 to 32767.
+
+    Parameters
+    ----------
+    valid_range : tuple
+        (min, max) of the packed values
+
+    Returns
+    -------
+    scale_factor, add_offset : numpy.float32
+    """
+    vmin, vmax = valid_range
+    if not vmax > vmin:
+        raise ValueError("Invalid packing range {}".format(valid_range))
+    scale_factor = np.float32((vmax - vmin) / (2. * int16_max))
+    add_offset = np.float32((vmax + vmin) / 2.)
+    return scale_factor, add_offset
+
+
+class Packer(object):
+    """
+    Pack parameters for storage and unpack them on reading.
+
+    Parameters
+    ----------
+    packing : dict
+        Packing of each parameter as dict with the keys
+
+        - dtype : 'int16' or 'float16'
+        - valid_range : (min, max), optional for int16, taken from
+          default_ranges or the first data by default
+        - scale_factor, add_offset : packing of int16, set by :meth:`fit`
+
+        Parameters without packing are stored as float32.
+    margin : float, optional
+        Fraction of the range found in the first data that is added on both
+        sides of a range taken from data.
+    missing_value : float, optional
+        Value of missing data in the images, the missing_value of the image
+        stack. NaN is always missing. Missing data of packed parameters is
+        unpacked as NaN.
+    """
+
+    def __init__(self, packing=None, margin=0.1, missing_value=np.nan):
+        self.packing = OrderedDict()
+        self.margin = margin
+        self.missing_value = missing_value
+        for parameter, spec in (packing or {}).items():
+            if not isinstance(spec, dict):
+                spec = {'dtype': spec}
+            spec = dict(spec)
+            if spec['dtype'] not in dtypes:
+                raise ValueError(
+                    "Packing dtype {} of {} is not one of {}".format(
+                        spec['dtype'], parameter, dtypes))
+            if (spec['dtype'] == 'int16' and 'valid_range' not in spec and
+                    parameter in default_ranges):
+                spec['valid_range'] = default_ranges[parameter]
+            if 'scale_factor' in spec:
+                spec['scale_factor'] = np.float32(spec['scale_factor'])
+                spec['add_offset'] = np.float32(spec['add_offset'])
+            elif 'valid_range' in spec:
+                spec['valid_range'] = tuple(
+                    float(v) for v in spec['valid_range'])
+                spec['scale_factor'], spec['add_offset'] = \
+                    int16_scaling(spec['valid_range'])
+            self.packing[parameter] = spec
+
+    @property
+    def fitted(self):
+        """
+        True if the scaling of all int16 parameters is known.
+        """
+        return all('scale_factor' in spec for spec in self.packing.values()
+                   if spec['dtype'] == 'int16')
+
+    def fit(self, data):
+        """
+        Set the range of int16 parameters without a range to the range of
+        the data plus margin.
+
+        Parameters
+        ----------
+        data : dict
+            array of each parameter, e.g. the first buffer of a conversion
+        """
+        for parameter, spec in self.packing.items():
+            if (spec['dtype'] != 'int16' or 'scale_factor' in spec or
+                    parameter not in data):
+                continue
+            values = np.asarray(data[parameter])
+            values = values[~self._missing(values)]
+            if values.size == 0:
+                raise ValueError(
+                    "No valid values of {} to detect the packing range, "
+                    "give the range explicitly.".format(parameter))
+            vmin, vmax = values.min(), values.max()
+            # constant data still needs a non empty range
+            extent = ((vmax - vmin) or abs(vmax) or 1.) * self.margin
+            spec['valid_range'] = (float(vmin - extent), float(vmax + extent))
+            spec['scale_factor'], spec['add_offset'] = \
+                int16_scaling(spec['valid_range'])
+
+    def _missing(self, data):
+        """
+        Mask of the missing values in float data.
+        """
+        missing = ~np.isfinite(data)
+        if is_sentinel(self.missing_value):
+            missing |= (data.astype(np.float32, copy=False) ==
+                        np.float32(self.missing_value))
+        return missing
+
+    def dtype(self, parameter):
+        """
+        Storage data type of a parameter.
+        """
+        if parameter in self.packing:
+            return np.dtype(self.packing[parameter]['dtype'])
+        return np.dtype('float32')
+
+    def fill_value(self, parameter):
+        """
+        Value of missing data in the storage data type.
+        """
+        if self.dtype(parameter) == np.int16:
+            return int16_fill_value
+        return self.dtype(parameter).type(np.nan)
+
+    def attributes(self, parameter):
+        """
+        CF attributes describing the packing of a parameter, netCDF4
+        unpacks variables with these attributes on reading.
+        """
+        spec = self.packing.get(parameter)
+        if spec is None or spec['dtype'] != 'int16':
+            return {}
+        return {'_FillValue': int16_fill_value,
+                'scale_factor': spec['scale_factor'],
+                'add_offset': spec['add_offset']}
+
+    def pack(self, parameter, data):
+        """
+        Pack float data of a parameter. Values outside of the range of
+        int16 parameters are clipped, missing values are stored as fill
+        value.
+
+        Parameters
+        ----------
+        parameter : string
+            parameter name
+        data : numpy.ndarray
+            float data
+
+        Returns
+        -------
+        packed : numpy.ndarray
+            data in the storage data type
+        """
+        spec = self.packing.get(parameter)
+        if spec is None:
+            return np.asarray(data, dtype=np.float32)
+
+        missing = self._missing(data)
+        if spec['dtype'] == 'float16':
+            return np.where(missing, np.nan, data).astype(np.float16)
+
+        packed = np.subtract(data, spec['add_offset'], dtype=np.float32)
+        packed /= spec['scale_factor']
+        np.rint(packed, out=packed)
+        np.clip(packed, -int16_max, int16_max, out=packed)
+        packed[missing] = 0
+        packed = packed.astype(np.int16)
+        packed[missing] = int16_fill_value
+        return packed
+
+    def unpack(self, parameter, data):
+        """
+        Unpack stored data of a parameter into float32, fill values
+        become NaN.
+
+        Parameters
+        ----------
+        parameter : string
+            parameter name
+        data : numpy.ndarray
+            data in the storage data type
+
+        Returns
+        -------
+        data : numpy.ndarray
+            float32 data
+        """
+        spec = self.packing.get(parameter)
+        if spec is None or spec['dtype'] == 'float16':
+            return np.array(data, dtype=np.float32)
+
+        data = np.asarray(data)
+        unpacked = data.astype(np.float32)
+        unpacked *= spec['scale_factor']
+        unpacked += spec['add_offset']
+        unpacked[data == int16_fill_value] = np.nan
+        return unpacked
+
+    def to_dict(self):
+        """
+        Packing of all parameters as JSON serializable dict.
+        """
+        specs = {}
+        for parameter, spec in self.packing.items():
+            specs[parameter] = {
+                key: (float(value) if isinstance(value, np.floating)
+                      else value) for key, value in spec.items()}
+        return specs
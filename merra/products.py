@@ -0,0 +1,201 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019, TU Wien
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The products module implements the registry of the supported MERRA2
+collections. It defines the file names, the remote location and the first
+available date of every collection and drives both the download and the
+reading of the data.
+"""
+
+from datetime import datetime
+from collections import OrderedDict
+
+# short name of the collection as key
+products = OrderedDict([
+    ('lnd', {'product': 'M2T1NXLND.5.12.4',
+             'collection': 'tavg1_2d_lnd_Nx',
+             'description': 'Land Surface Diagnostics',
+             'root': 'https://goldsmr4.gesdisc.eosdis.nasa.gov',
+             'start': datetime(1980, 1, 1)}),
+    ('slv', {'product': 'M2T1NXSLV.5.12.4',
+             'collection': 'tavg1_2d_slv_Nx',
+             'description': 'Single-Level Diagnostics',
+             'root': 'https://goldsmr4.gesdisc.eosdis.nasa.gov',
+             'start': datetime(1980, 1, 1)}),
+    ('flx', {'product': 'M2T1NXFLX.5.12.4',
+             'collection': 'tavg1_2d_flx_Nx',
+             'description': 'Surface Flux Diagnostics',
+             'root': 'https://goldsmr4.gesdisc.eosdis.nasa.gov',
+             'start': datetime(1980, 1, 1)}),
+    ('rad', {'product': 'M2T1NXRAD.5.12.4',
+             'collection': 'tavg1_2d_rad_Nx',
+             'description': 'Radiation Diagnostics',
+             'root': 'https://goldsmr4.gesdisc.eosdis.nasa.gov',
+             'start': datetime(1980, 1, 1)})])
+
+default_collection = 'lnd'
+
+# first day of the production streams, the stream number is part of the
+# file names. Days that were reprocessed later (e.g. stream 401) are found
+# by listing the remote folder.
+streams = [(datetime(1980, 1, 1), '100'),
+           (datetime(1992, 1, 1), '200'),
+           (datetime(2001, 1, 1), '300'),
+           (datetime(2011, 1, 1), '400')]
+
+
+def get_collection(name):
+    """
+    Look up a collection by its short name (e.g. lnd) or product
+    name (e.g. M2T1NXLND.5.12.4).
+
+    Parameters
+    ----------
+    name : string
+        short name or product name
+
+    Returns
+    -------
+    short_name : string
+        short name of the collection
+    collection : dict
+        registry entry of the collection
+    """
+    if name in products:
+        return name, products[name]
+    for short_name, collection in products.items():
+        if collection['product'] == name:
+            return short_name, collection
+    raise ValueError("Unknown MERRA2 collection {}, available are {}".format(
+        name, ', '.join(products.keys())))
+
+
+def fname_template(name):
+    """
+    File name template of a collection with a wildcard for the stream
+    number as used by :py:class:`merra.interface.MerraImageStack`.
+
+    Parameters
+    ----------
+    name : string
+        short name or product name
+
+    Returns
+    -------
+    template : string
+    """
+    return "MERRA2_*.{}.{{datetime}}.nc4".format(
+        get_collection(name)[1]['collection'])
+
+
+def fname_format(name):
+    """
+    trollsift format string of the file names of a collection.
+
+    Parameters
+    ----------
+    name : string
+        short name or product name
+
+    Returns
+    -------
+    format : string
+    """
+    return "MERRA2_{{stream}}.{}.{{time:%Y%m%d}}.nc4".format(
+        get_collection(name)[1]['collection'])
+
+
+def stream_number(date):
+    """
+    Number of the production stream of a day.
+
+    Parameters
+    ----------
+    date : datetime.datetime
+        day of the file
+
+    Returns
+    -------
+    stream : string
+        e.g. '400' from 2011 on
+    """
+    stream = streams[0][1]
+    for start, number in streams:
+        if date >= start:
+            stream = number
+    return stream
+
+
+def daily_fname(name, date, stream=None):
+    """
+    File name of a day of a collection.
+
+    Parameters
+    ----------
+    name : string
+        short name or product name
+    date : datetime.datetime
+        day of the file
+    stream : string, optional
+        stream number, by default the one of the production period
+
+    Returns
+    -------
+    fname : string
+        e.g. MERRA2_400.tavg1_2d_lnd_Nx.20181001.nc4
+    """
+    if stream is None:
+        stream = stream_number(date)
+    return "MERRA2_{}.{}.{}.nc4".format(
+        stream, get_collection(name)[1]['collection'],
+        date.strftime('%Y%m%d'))
+
+
+def split_parameters(parameters):
+    """
+    Group parameters of the form collection:parameter by collection.
+    Parameters without a collection belong to the default collection.
+
+    Parameters
+    ----------
+    parameters : list or dict
+        list of (prefixed) parameter names or already grouped parameters
+
+    Returns
+    -------
+    grouped : OrderedDict
+        list of parameters for each collection short name
+    """
+    if isinstance(parameters, dict):
+        return OrderedDict((get_collection(name)[0], list(params))
+                           for name, params in parameters.items())
+
+    grouped = OrderedDict()
+    for parameter in parameters:
+        if ':' in parameter:
+            name, parameter = parameter.split(':', 1)
+            name = get_collection(name)[0]
+        else:
+            name = default_collection
+        grouped.setdefault(name, []).append(parameter)
+    return grouped
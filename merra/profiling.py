@@ -0,0 +1,269 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019, TU Wien
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The profiling module implements an opt-in profiler recording a latency
+histogram for the internal stages of reading MERRA2 images, e.g. filename
+search, opening the netCDF file, decompression, masked array handling,
+indexing and flipping.
+
+Profiling is enabled either for a block of code::
+
+    from merra.profiling import profile
+
+    with profile():
+        img_stack.read(timestamp)
+
+or for the whole process by setting the environment variable
+``MERRA_PROFILE=1``, in which case the summary is printed to stderr at exit.
+When profiling is disabled, :func:`stage` returns a shared no-op context
+manager so the instrumented code pays only one function call per stage.
+"""
+
+import os
+import sys
+import time
+import atexit
+import numpy as np
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# upper edges of the histogram bins in seconds, from 1 microsecond to
+# 100 seconds with 10 bins per decade
+bin_edges = np.logspace(-6, 2, 81)
+
+_profiler = None
+
+
+class StageHistogram(object):
+    """
+    Latency histogram of one stage.
+    """
+
+    def __init__(self):
+        self.counts = np.zeros(bin_edges.size + 1, dtype=np.int64)
+        self.calls = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, seconds):
+        """
+        Add one measurement.
+
+        Parameters
+        ----------
+        seconds : float
+            duration of the call
+        """
+        self.counts[np.searchsorted(bin_edges, seconds)] += 1
+        self.calls += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """
+        Approximate quantile as the upper edge of the histogram bin.
+
+        Parameters
+        ----------
+        q : float
+            quantile between 0 and 1
+
+        Returns
+        -------
+        seconds : float
+        """
+        if self.calls == 0:
+            return np.nan
+        position = np.searchsorted(np.cumsum(self.counts), q * self.calls)
+        if position >= bin_edges.size:
+            return self.max
+        return min(bin_edges[position], self.max)
+
+
+class Profiler(object):
+    """
+    Collection of the latency histograms of all stages.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    def record(self, name, seconds):
+        """
+        Add a measurement of a stage.
+
+        Parameters
+        ----------
+        name : string
+            name of the stage
+        seconds : float
+            duration of the call
+        """
+        if name not in self.stages:
+            self.stages[name] = StageHistogram()
+        self.stages[name].record(seconds)
+
+    def summary(self):
+        """
+        Summary table of all stages.
+
+        Returns
+        -------
+        table : string
+            calls, total, mean, approximate median, 90th and 99th percentile
+            and maximum latency of each stage in milliseconds
+        """
+        header = ('stage', 'calls', 'total_ms', 'mean_ms', 'p50_ms',
+                  'p90_ms', 'p99_ms', 'max_ms')
+        rows = [header]
+        for name, hist in self.stages.items():
+            rows.append((name, str(hist.calls),
+                         '{:.3f}'.format(hist.total * 1e3),
+                         '{:.3f}'.format(hist.total / hist.calls * 1e3),
+                         '{:.3f}'.format(hist.quantile(0.5) * 1e3),
+                         '{:.3f}'.format(hist.quantile(0.9) * 1e3),
+                         '{:.3f}'.format(hist.quantile(0.99) * 1e3),
+                         '{:.3f}'.format(hist.max * 1e3)))
+        widths = [max(len(row[i]) for row in rows)
+                  for i in range(len(header))]
+        lines = [' '.join(value.rjust(width) if i else value.ljust(width)
+                          for i, (value, width) in
+                          enumerate(zip(row, widths)))
+                 for row in rows]
+        return '\n'.join(lines)
+
+
+class _StageTimer(object):
+
+    __slots__ = ('profiler', 'name', 't0')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(self.name, time.perf_counter() - self.t0)
+
+
+class _NullTimer(object):
+
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+def stage(name):
+    """
+    Context manager timing a stage if profiling is enabled.
+
+    Parameters
+    ----------
+    name : string
+        name of the stage
+
+    Returns
+    -------
+    timer : context manager
+    """
+    if _profiler is None:
+        return _null_timer
+    return _StageTimer(_profiler, name)
+
+
+def enable():
+    """
+    Enable profiling.
+
+    Returns
+    -------
+    profiler : Profiler
+        the active profiler
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+    return _profiler
+
+
+def disable():
+    """
+    Disable profiling.
+
+    Returns
+    -------
+    profiler : Profiler or None
+        the profiler that was active
+    """
+    global _profiler
+    profiler = _profiler
+    _profiler = None
+    return profiler
+
+
+@contextmanager
+def profile(stream=sys.stderr):
+    """
+    Profile the stages executed within the block and write the summary
+    table when leaving it.
+
+    Parameters
+    ----------
+    stream : file-like, optional
+        stream the summary is written to, None to not write it
+
+    Yields
+    ------
+    profiler : Profiler
+    """
+    global _profiler
+    previous = _profiler
+    profiler = _profiler = Profiler()
+    try:
+        yield profiler
+    finally:
+        _profiler = previous
+        if stream is not None:
+            stream.write(profiler.summary() + '\n')
+
+
+def _summary_at_exit():
+    profiler = disable()
+    if profiler is not None and profiler.stages:
+        sys.stderr.write(profiler.summary() + '\n')
+
+
+if os.environ.get('MERRA_PROFILE', '') not in ('', '0'):
+    enable()
+    atexit.register(_summary_at_exit)
@@ -0,0 +1,609 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019, TU Wien
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The references module implements a chunk offset index of the MERRA2
+archive. The archive is scanned once and the byte offset and size of every
+compressed chunk of each file and variable are stored as kerchunk style
+reference JSON next to the file or in a separate index folder. Reading
+through the references seeks to the chunks of the requested hours,
+variables and window and decompresses them directly, without opening the
+file with the HDF5 library.
+
+USAGE in terminal:
+merra_index [-h] [--index_path INDEX_PATH] [--n_proc N_PROC]
+            dataset_root
+"""
+
+import os
+import sys
+import json
+import zlib
+import glob
+import logging
+import argparse
+import functools
+import itertools
+import multiprocessing
+import numpy as np
+
+from merra import remote
+from merra.metrics import create_metrics
+from merra.products import fname_template, get_collection
+from merra.reshuffle import mkdate
+
+logger = logging.getLogger(__name__)
+
+# version of the kerchunk reference format
+reference_version = 1
+
+# placeholder of the data file in the references
+url_template = 'u'
+
+
+def reference_filename(filename, index_path=None):
+    """
+    Path of the reference file of a MERRA2 file.
+
+    Parameters
+    ----------
+    filename : string
+        path of the MERRA2 file
+    index_path : string, optional
+        root of the index, with the same YYYY/MM folders as the archive.
+        By default the references are stored next to the file.
+
+    Returns
+    -------
+    reference_file : string
+        path of the reference JSON file
+    """
+    basename = os.path.basename(filename)
+    if index_path is None:
+        return filename + '.json'
+    date = basename.split('.')[-2]
+    return os.path.join(index_path, date[:4], date[4:6], basename + '.json')
+
+
+def _json_value(value):
+    """
+    Attribute value of a HDF5 dataset as JSON serializable value.
+    """
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, np.ndarray):
+        if value.size == 1:
+            return _json_value(value.ravel()[0])
+        return [_json_value(v) for v in value.tolist()]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _codecs(dataset):
+    """
+    Compressor and filters of a HDF5 dataset as zarr codec specification.
+    """
+    compressor = None
+    filters = []
+    if dataset.compression == 'gzip':
+        compressor = {'id': 'zlib', 'level': dataset.compression_opts}
+    elif dataset.compression is not None:
+        raise ValueError("Compression {} of {} is not supported".format(
+            dataset.compression, dataset.name))
+    if dataset.shuffle:
+        filters.append({'id': 'shuffle',
+                        'elementsize': dataset.dtype.itemsize})
+    if dataset.fletcher32 or dataset.scaleoffset is not None:
+        raise ValueError("Filters of {} are not supported".format(
+            dataset.name))
+    return compressor, filters or None
+
+
+def file_references(filename, parameters=None):
+    """
+    Scan the chunks of a MERRA2 file.
+
+    Parameters
+    ----------
+    filename : string
+        path of the MERRA2 file
+    parameters : list, optional
+        variables to index, all variables by default. The coordinates are
+        always indexed.
+
+    Returns
+    -------
+    references : dict
+        kerchunk style references, the file is referenced by the
+        template u
+    """
+    import h5py
+
+    refs = {'.zgroup': json.dumps({'zarr_format': 2})}
+    with h5py.File(filename, 'r') as h5:
+        refs['.zattrs'] = json.dumps({
+            name: _json_value(value) for name, value in h5.attrs.items()
+            if name not in remote.hidden_attributes})
+        for name, dataset in h5.items():
+            if not isinstance(dataset, h5py.Dataset):
+                continue
+            if (parameters is not None and name not in parameters and
+                    name not in ['time', 'lat', 'lon']):
+                continue
+            attrs = {key: _json_value(value)
+                     for key, value in dataset.attrs.items()
+                     if key not in remote.hidden_attributes}
+            attrs['_ARRAY_DIMENSIONS'] = [
+                os.path.basename(dim[0].name) for dim in dataset.dims
+                if len(dim)]
+            fill_value = attrs.pop('_FillValue', None)
+            shape = list(dataset.shape)
+            if dataset.chunks is None:
+                chunks = shape
+                compressor, filters = None, None
+                refs[name + '/' + '.'.join(['0'] * len(shape))] = [
+                    '{{' + url_template + '}}', dataset.id.get_offset(),
+                    dataset.id.get_storage_size()]
+            else:
+                chunks = list(dataset.chunks)
+                compressor, filters = _codecs(dataset)
+                for i in range(dataset.id.get_num_chunks()):
+                    info = dataset.id.get_chunk_info(i)
+                    if info.filter_mask != 0:
+                        raise ValueError(
+                            "Chunk {} of {} skips filters".format(
+                                info.chunk_offset, name))
+                    key = '.'.join(str(offset // size) for offset, size in
+                                   zip(info.chunk_offset, chunks))
+                    refs[name + '/' + key] = [
+                        '{{' + url_template + '}}', info.byte_offset,
+                        info.size]
+            refs[name + '/.zarray'] = json.dumps({
+                'zarr_format': 2, 'shape': shape, 'chunks': chunks,
+                'dtype': dataset.dtype.str, 'fill_value': fill_value,
+                'order': 'C', 'compressor': compressor,
+                'filters': filters})
+            refs[name + '/.zattrs'] = json.dumps(attrs)
+
+    return {'version': reference_version,
+            'templates': {url_template: os.path.abspath(filename)},
+            'refs': refs}
+
+
+def write_references(filename, index_path=None, parameters=None,
+                     overwrite=False):
+    """
+    Scan a MERRA2 file and write its reference file.
+
+    Parameters
+    ----------
+    filename : string
+        path of the MERRA2 file
+    index_path : string, optional
+        root of the index, next to the file by default
+    parameters : list, optional
+        variables to index, all variables by default
+    overwrite : boolean, optional
+        scan the file again if the reference file exists
+
+    Returns
+    -------
+    reference_file : string
+        path of the reference file
+    written : boolean
+        False if the reference file existed
+    """
+    reference_file = reference_filename(filename, index_path)
+    if os.path.exists(reference_file) and not overwrite:
+        return reference_file, False
+    references = file_references(filename, parameters=parameters)
+    folder = os.path.dirname(reference_file)
+    if not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    tmp_file = '{}.{}.tmp'.format(reference_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(references, f)
+    os.replace(tmp_file, reference_file)
+    return reference_file, True
+
+
+def _index_worker(args):
+    """
+    Write the references of one file in a worker process.
+    """
+    filename, index_path, parameters, overwrite = args
+    return write_references(filename, index_path=index_path,
+                            parameters=parameters, overwrite=overwrite)
+
+
+def archive_files(data_path, collection='lnd', start_date=None,
+                  end_date=None):
+    """
+    Files of a collection in the YYYY/MM folders of the local archive.
+
+    Parameters
+    ----------
+    data_path : string
+        root path of the collection
+    collection : string, optional
+        short name or product name of the collection
+    start_date : datetime.datetime, optional
+        first day
+    end_date : datetime.datetime, optional
+        last day
+
+    Returns
+    -------
+    filenames : list
+        sorted paths of the files
+    """
+    pattern = os.path.join(data_path, '[0-9]' * 4, '[0-9]' * 2,
+                           fname_template(collection).format(
+                               datetime='[0-9]' * 8))
+    filenames = []
+    for filename in sorted(glob.glob(pattern)):
+        day = filename.split('.')[-2]
+        if start_date is not None and day < start_date.strftime('%Y%m%d'):
+            continue
+        if end_date is not None and day > end_date.strftime('%Y%m%d'):
+            continue
+        filenames.append(filename)
+    return filenames
+
+
+def build_index(data_path, index_path=None, collection='lnd',
+                start_date=None, end_date=None, parameters=None, n_proc=1,
+                overwrite=False, metrics=None):
+    """
+    Scan the files of the archive in parallel and write the reference
+    file of each.
+
+    Parameters
+    ----------
+    data_path : string
+        root path of the collection
+    index_path : string, optional
+        root of the index, the references are stored next to the files
+        by default
+    collection : string, optional
+        short name or product name of the collection
+    start_date : datetime.datetime, optional
+        first day to index
+    end_date : datetime.datetime, optional
+        last day to index
+    parameters : list, optional
+        variables to index, all variables by default
+    n_proc : int, optional
+        number of worker processes
+    overwrite : boolean, optional
+        scan files that already have a reference file again
+    metrics : merra.metrics.Metrics, optional
+        metrics the progress is recorded in
+
+    Returns
+    -------
+    n_written : int
+        number of reference files written
+    """
+    filenames = archive_files(data_path, collection=collection,
+                              start_date=start_date, end_date=end_date)
+    if metrics is not None:
+        metrics.total = len(filenames)
+    logger.info("Indexing %d files of %s.", len(filenames), data_path)
+
+    tasks = [(filename, index_path, parameters, overwrite)
+             for filename in filenames]
+    if n_proc == 1:
+        results = map(_index_worker, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(n_proc)
+        results = pool.imap_unordered(_index_worker, tasks)
+
+    n_written = 0
+    try:
+        for reference_file, written in results:
+            n_written += written
+            if metrics is not None:
+                metrics.count('files', int(written))
+                metrics.progress(1)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    logger.info("Wrote %d reference files.", n_written)
+    return n_written
+
+
+def _as_slice(positions):
+    """
+    Slice of ascending consecutive positions, the positions otherwise.
+    """
+    if positions[-1] - positions[0] + 1 == positions.size:
+        return slice(int(positions[0]), int(positions[-1]) + 1)
+    return positions
+
+
+def _index(positions):
+    """
+    Index of the block given by the positions along each axis.
+    """
+    if all(isinstance(p, slice) for p in positions):
+        return tuple(positions)
+    return np.ix_(*[np.arange(p.start, p.stop) if isinstance(p, slice)
+                    else p for p in positions])
+
+
+@functools.lru_cache(maxsize=16)
+def _load_references(reference_file, mtime):
+    """
+    Parsed references of a reference file, the last files are cached.
+    """
+    with open(reference_file) as f:
+        return json.load(f)
+
+
+class ReferenceVariable(object):
+    """
+    netCDF4 like view of a variable read through its chunk references. The
+    data is returned as stored, without masking.
+
+    Parameters
+    ----------
+    dataset : ReferenceDataset
+        dataset of the variable
+    name : string
+        name of the variable
+    """
+
+    def __init__(self, dataset, name):
+        self.ds = dataset
+        self.name = name
+        zarray = json.loads(dataset.refs[name + '/.zarray'])
+        self.attributes = json.loads(dataset.refs[name + '/.zattrs'])
+        self.shape = tuple(zarray['shape'])
+        self.chunks = tuple(zarray['chunks'])
+        self.dtype = np.dtype(zarray['dtype'])
+        self.fill_value = zarray['fill_value']
+        self.compressor = zarray['compressor']
+        self.filters = zarray['filters'] or []
+
+    def ncattrs(self):
+        """
+        Names of the attributes.
+        """
+        return [name for name in self.attributes
+                if name != '_ARRAY_DIMENSIONS']
+
+    def getncattr(self, name):
+        """
+        Value of an attribute.
+        """
+        return self.attributes[name]
+
+    def __getattr__(self, name):
+        if name in ('ds', 'attributes'):
+            raise AttributeError(name)
+        try:
+            return self.getncattr(name)
+        except KeyError:
+            raise AttributeError(name)
+
+    def _chunk(self, index):
+        """
+        Decompressed chunk of a chunk index, filled with the fill value if
+        the chunk was never written.
+        """
+        key = '{}/{}'.format(self.name, '.'.join(str(i) for i in index))
+        if key not in self.ds.refs:
+            fill_value = self.fill_value
+            if fill_value is None:
+                fill_value = 0
+            return np.full(self.chunks, fill_value, dtype=self.dtype)
+        _, offset, size = self.ds.refs[key]
+        data = self.ds.read_bytes(offset, size)
+        if self.compressor is not None:
+            data = zlib.decompress(data)
+        data = np.frombuffer(data, dtype=np.uint8)
+        for codec in reversed(self.filters):
+            data = np.ascontiguousarray(
+                data.reshape((codec['elementsize'], -1)).T).ravel()
+        return data.view(self.dtype).reshape(self.chunks)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (len(self.shape) - len(key))
+
+        indices = []
+        squeeze = []
+        for dim, (k, n) in enumerate(zip(key, self.shape)):
+            index = np.arange(n)[k]
+            if np.ndim(index) == 0:
+                squeeze.append(dim)
+            indices.append(np.atleast_1d(index))
+
+        out = np.empty([index.size for index in indices], dtype=self.dtype)
+        chunk_indices = [np.unique(index // size)
+                         for index, size in zip(indices, self.chunks)]
+        for chunk_index in itertools.product(*chunk_indices):
+            chunk = self._chunk(chunk_index)
+            out_pos = []
+            chunk_pos = []
+            for index, c, size in zip(indices, chunk_index, self.chunks):
+                selected = np.nonzero(index // size == c)[0]
+                out_pos.append(_as_slice(selected))
+                chunk_pos.append(_as_slice(index[selected] - c * size))
+            out[_index(out_pos)] = chunk[_index(chunk_pos)]
+        if squeeze:
+            out = out.squeeze(axis=tuple(squeeze))
+        return out
+
+
+class ReferenceDataset(object):
+    """
+    Read only netCDF4 like access to a MERRA2 file through its reference
+    file.
+
+    Parameters
+    ----------
+    reference_file : string
+        path of the reference JSON file
+    filename : string, optional
+        path or URL of the data file, by default the path stored in the
+        references
+    storage_options : dict, optional
+        options of the fsspec file system if filename is an URL
+    """
+
+    def __init__(self, reference_file, filename=None, storage_options=None):
+        try:
+            references = _load_references(
+                reference_file, os.stat(reference_file).st_mtime_ns)
+        except (IOError, OSError, ValueError) as e:
+            raise IOError("References {} can not be read: {}".format(
+                reference_file, e))
+        self.refs = references['refs']
+        if filename is None:
+            filename = references['templates'][url_template]
+        if remote.is_remote(filename):
+            fs, path = remote.get_filesystem(filename, storage_options)
+            self.file = fs.open(path, 'rb', cache_type='none')
+        else:
+            self.file = open(filename, 'rb')
+        self.bytes_fetched = 0
+        self.variables = {key[:-len('/.zarray')]: None
+                          for key in self.refs if key.endswith('/.zarray')}
+        for name in self.variables:
+            self.variables[name] = ReferenceVariable(self, name)
+
+    def read_bytes(self, offset, size):
+        """
+        Read a byte range of the data file.
+        """
+        self.file.seek(offset)
+        data = self.file.read(size)
+        self.bytes_fetched += len(data)
+        return data
+
+    def close(self):
+        """
+        Close the data file.
+        """
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def parse_args(args):
+    """
+    Parse command line parameters for indexing the archive.
+
+    Parameters
+    ----------
+    args : list of strings
+        command line parameters
+
+    Returns
+    -------
+    args: argparse.Namespace object
+        command line parameters
+    """
+    parser = argparse.ArgumentParser(
+        description="Write the chunk references of the MERRA2 files.")
+    parser.add_argument(
+        "dataset_root",
+        help='Root of local filesystem where the data is stored.')
+    parser.add_argument(
+        "--index_path",
+        help=(
+            "Root of the index, by default the references are stored next "
+            "to the files."))
+    parser.add_argument(
+        "--collection",
+        default='lnd',
+        help="Short name or product name of the collection.")
+    parser.add_argument("-s", "--start", type=mkdate,
+                        help="First day to index in format YYYY-MM-DD.")
+    parser.add_argument("-e", "--end", type=mkdate,
+                        help="Last day to index in format YYYY-MM-DD.")
+    parser.add_argument(
+        "--parameters",
+        nargs='+',
+        help="Variables to index, all variables by default.")
+    parser.add_argument(
+        "--n_proc",
+        default=1,
+        type=int,
+        help='Number of parallel processes scanning the files.')
+    parser.add_argument(
+        "--overwrite",
+        action='store_true',
+        help="Scan files that already have a reference file again.")
+    parser.add_argument(
+        "--metrics_file",
+        help="File the progress metrics are exported to.")
+    parser.add_argument(
+        "--metrics_format",
+        choices=['jsonl', 'prometheus'],
+        default='jsonl',
+        help="Format of the metrics file.")
+    parser.add_argument(
+        "--log_level",
+        default='INFO',
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help="Logging level.")
+    args = parser.parse_args(args)
+    try:
+        get_collection(args.collection)
+    except ValueError as e:
+        parser.error(str(e))
+    logging.basicConfig(level=args.log_level,
+                        format='%(asctime)s %(name)s %(levelname)s '
+                               '%(message)s')
+    return args
+
+
+def main(args):
+    args = parse_args(args)
+    metrics = create_metrics('merra_index',
+                             metrics_file=args.metrics_file,
+                             metrics_format=args.metrics_format)
+    build_index(args.dataset_root, index_path=args.index_path,
+                collection=args.collection, start_date=args.start,
+                end_date=args.end, parameters=args.parameters,
+                n_proc=args.n_proc, overwrite=args.overwrite,
+                metrics=metrics)
+    metrics.close()
+
+
+def run():
+    main(sys.argv[1:])
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,414 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019, TU Wien
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The regrid module implements the regridding of MERRA2 images to other grids,
+e.g. a 0.25 degree lat/lon grid or an EASE2 grid. The weights from the
+MERRA2 grid to the target grid are computed once, cached on disk as a sparse
+matrix and applied to whole (time, gpi) blocks as one sparse-dense product.
+"""
+
+import os
+import hashlib
+import numpy as np
+import scipy.sparse as sparse
+
+from datetime import datetime
+
+from merra.grid import create_merra_cell_grid
+from merra.interface import stream_images
+from merra.metrics import Metrics
+from merra.packing import is_sentinel
+from pygeobase.object_base import Image
+
+# shape and resolution of the MERRA2 grid, see merra.grid
+n_lat = 361
+n_lon = 576
+lat_res = 0.5
+lon_res = 0.625
+
+methods = ['nearest', 'bilinear', 'conservative']
+
+
+def _source_columns(source_grid):
+    """
+    Column of each MERRA2 gpi in the 1D images of the source grid.
+
+    Parameters
+    ----------
+    source_grid : pygeogrids.grids.BasicGrid
+        MERRA2 grid or a subset of it
+
+    Returns
+    -------
+    columns : numpy.ndarray
+        column of each gpi of the full MERRA2 grid, -1 for gpis that are
+        not part of the source grid
+    """
+    columns = np.full(n_lat * n_lon, -1, dtype=np.int64)
+    columns[source_grid.activegpis] = np.arange(source_grid.activegpis.size)
+    return columns
+
+
+def _to_matrix(rows, gpis, weights, n_target, source_grid):
+    """
+    Sparse (target, source) matrix from weights of MERRA2 gpis, weights of
+    gpis outside of the source grid are dropped.
+    """
+    columns = _source_columns(source_grid)[gpis]
+    valid = (columns >= 0) & (weights > 0)
+    return sparse.csr_matrix(
+        (weights[valid], (rows[valid], columns[valid])),
+        shape=(n_target, source_grid.activegpis.size))
+
+
+def nearest_weights(source_grid, lons, lats):
+    """
+    Nearest neighbour weights from the MERRA2 grid to target points.
+
+    Parameters
+    ----------
+    source_grid : pygeogrids.grids.BasicGrid
+        MERRA2 grid or a subset of it
+    lons, lats : numpy.ndarray
+        coordinates of the target points
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix
+        (target, source) weight matrix
+    """
+    row = np.clip(np.round((lats + 90.) / lat_res), 0, n_lat - 1)
+    col = np.mod(np.round((lons + 180.) / lon_res), n_lon)
+    gpis = (row * n_lon + col).astype(np.int64)
+    return _to_matrix(np.arange(lons.size), gpis, np.ones(lons.size),
+                      lons.size, source_grid)
+
+
+def bilinear_weights(source_grid, lons, lats):
+    """
+    Bilinear interpolation weights from the MERRA2 grid to target points.
+
+    Parameters
+    ----------
+    source_grid : pygeogrids.grids.BasicGrid
+        MERRA2 grid or a subset of it
+    lons, lats : numpy.ndarray
+        coordinates of the target points
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix
+        (target, source) weight matrix
+    """
+    y = np.clip((lats + 90.) / lat_res, 0, n_lat - 1)
+    x = np.mod((lons + 180.) / lon_res, n_lon)
+    row0 = np.minimum(np.floor(y), n_lat - 2)
+    col0 = np.floor(x)
+    fy = y - row0
+    fx = x - col0
+    # longitudes wrap around at the date line
+    col1 = np.mod(col0 + 1, n_lon)
+
+    rows = np.tile(np.arange(lons.size), 4)
+    gpis = np.concatenate([row0 * n_lon + col0, row0 * n_lon + col1,
+                           (row0 + 1) * n_lon + col0,
+                           (row0 + 1) * n_lon + col1]).astype(np.int64)
+    weights = np.concatenate([(1 - fy) * (1 - fx), (1 - fy) * fx,
+                              fy * (1 - fx), fy * fx])
+    return _to_matrix(rows, gpis, weights, lons.size, source_grid)
+
+
+def _overlap(target_lower, target_upper, source_lower, source_upper):
+    """
+    Length of the overlap of each target with each source interval.
+    """
+    return np.clip(np.minimum(target_upper[:, None], source_upper[None, :]) -
+                   np.maximum(target_lower[:, None], source_lower[None, :]),
+                   0, None)
+
+
+def _sin_lat(lat):
+    """
+    Sine of latitudes clipped to the poles.
+    """
+    return np.sin(np.deg2rad(np.clip(lat, -90., 90.)))
+
+
+def _regular_axis(values):
+    """
+    Unique values and spacing of a regular axis, None if not regular.
+    """
+    axis = np.unique(values)
+    if axis.size < 2:
+        return None
+    spacing = np.diff(axis)
+    if not np.allclose(spacing, spacing[0], rtol=1e-4):
+        return None
+    return axis, spacing[0]
+
+
+def conservative_weights(source_grid, lons, lats):
+    """
+    Area weighted (first order conservative) weights from the MERRA2 grid
+    to a regular lat/lon target grid.
+
+    Parameters
+    ----------
+    source_grid : pygeogrids.grids.BasicGrid
+        MERRA2 grid or a subset of it
+    lons, lats : numpy.ndarray
+        coordinates of the target points, cell centers of a regular
+        lat/lon grid
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix
+        (target, source) weight matrix
+    """
+    lon_axis = _regular_axis(lons)
+    lat_axis = _regular_axis(lats)
+    if lon_axis is None or lat_axis is None:
+        raise ValueError(
+            "Conservative regridding needs a regular lat/lon target grid.")
+    (tlons, tlon_res), (tlats, tlat_res) = lon_axis, lat_axis
+
+    # area of the overlap in latitude is proportional to the difference of
+    # the sine of the bounds
+    slats = np.arange(n_lat) * lat_res - 90.
+    wlat = _overlap(_sin_lat(tlats - tlat_res / 2.),
+                    _sin_lat(tlats + tlat_res / 2.),
+                    _sin_lat(slats - lat_res / 2.),
+                    _sin_lat(slats + lat_res / 2.))
+
+    # source cells crossing the date line are shifted by 360 degrees
+    slons = np.arange(n_lon) * lon_res - 180.
+    wlon = sum(_overlap(tlons - tlon_res / 2., tlons + tlon_res / 2.,
+                        slons - lon_res / 2. + shift,
+                        slons + lon_res / 2. + shift)
+               for shift in (-360., 0., 360.))
+
+    # (target lat x target lon, MERRA2 gpi) weights of the full target grid
+    full = sparse.kron(sparse.csr_matrix(wlat), sparse.csr_matrix(wlon),
+                       format='csr')
+    index = (np.searchsorted(tlats, lats) * tlons.size +
+             np.searchsorted(tlons, lons))
+    full = full[index].tocoo()
+    weights = _to_matrix(full.row, full.col, full.data, lons.size,
+                         source_grid)
+    # normalize, source cells outside of the source grid are not counted
+    norm = np.asarray(weights.sum(axis=1)).ravel()
+    norm[norm == 0] = 1.
+    return sparse.diags(1. / norm).dot(weights).tocsr()
+
+
+weight_functions = {'nearest': nearest_weights,
+                    'bilinear': bilinear_weights,
+                    'conservative': conservative_weights}
+
+
+class Regridder(object):
+    """
+    Regrid 1D MERRA2 images to a target grid with precomputed weights.
+
+    Parameters
+    ----------
+    target_grid : pygeogrids.grids.BasicGrid
+        target grid, the regridded arrays are in the order of its
+        activegpis
+    method : string, optional
+        'nearest', 'bilinear' or 'conservative'. Conservative regridding
+        needs a regular lat/lon target grid.
+    source_grid : pygeogrids.grids.BasicGrid, optional
+        grid of the 1D MERRA2 images, the full MERRA2 grid by default
+    cache_dir : string, optional
+        folder the weights are cached in, the weights are computed on
+        every initialization if not given
+    missing_value : float, optional
+        value of missing data in the images, the missing_value of the image
+        stack. NaN is always missing. Missing source data is excluded and
+        the weights of the valid data renormalized.
+    """
+
+    def __init__(self, target_grid, method='nearest', source_grid=None,
+                 cache_dir=None, missing_value=np.nan):
+        if method not in methods:
+            raise ValueError("Regridding method {} is not one of {}".format(
+                method, methods))
+        if source_grid is None:
+            source_grid = create_merra_cell_grid()
+        self.source_grid = source_grid
+        self.target_grid = target_grid
+        self.method = method
+        self.missing_value = missing_value
+
+        self.cache_file = None
+        if cache_dir is not None:
+            self.cache_file = os.path.join(
+                cache_dir, 'regrid_weights_{}_{}.npz'.format(
+                    method, self.cache_key()))
+
+        if self.cache_file is not None and os.path.exists(self.cache_file):
+            self.weights = sparse.load_npz(self.cache_file).tocsr()
+        else:
+            self.weights = weight_functions[method](
+                source_grid, target_grid.activearrlon,
+                target_grid.activearrlat)
+            if self.cache_file is not None:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                sparse.save_npz(self.cache_file, self.weights)
+
+    def cache_key(self):
+        """
+        Hash of the source and target grid identifying cached weights.
+        """
+        key = hashlib.sha1()
+        for array in [self.source_grid.activegpis,
+                      self.target_grid.activearrlon,
+                      self.target_grid.activearrlat]:
+            key.update(np.ascontiguousarray(array, dtype=np.float64).data)
+        return key.hexdigest()[:16]
+
+    def regrid(self, data):
+        """
+        Regrid images.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            1D image or (time, gpi) block on the source grid
+
+        Returns
+        -------
+        data : numpy.ndarray
+            1D image or (time, gpi) block on the target grid as float32,
+            target points without valid source data are NaN
+        """
+        block = np.atleast_2d(data)
+        valid = np.isfinite(block)
+        if is_sentinel(self.missing_value):
+            valid &= (block.astype(np.float32, copy=False) !=
+                      np.float32(self.missing_value))
+
+        values = np.where(valid, block, 0).astype(np.float64)
+        # (target, source) x (source, time) products for all images at once
+        regridded = self.weights.dot(values.T)
+        norm = self.weights.dot(valid.T.astype(np.float64))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            regridded = np.where(norm > 0, regridded / norm, np.nan)
+        regridded = np.ascontiguousarray(regridded.T, dtype=np.float32)
+        if np.ndim(data) == 1:
+            return regridded[0]
+        return regridded
+
+
+class RegriddedImageStack(object):
+    """
+    Image stack returning the images of a MERRA2 image stack on a target
+    grid. Can be used wherever a MerraImageStack is used for reading
+    (e.g. reshuffle), the images are always 1D arrays in the order of the
+    target grid.
+
+    Parameters
+    ----------
+    dataset : MerraImageStack or MerraMultiImageStack
+        image stack on the MERRA2 grid
+    regridder : Regridder
+        regridder to the target grid
+    """
+
+    def __init__(self, dataset, regridder):
+        self.dataset = dataset
+        self.regridder = regridder
+        self.grid = regridder.target_grid
+        # target points without valid source data are NaN
+        self.missing_value = np.nan
+
+    def tstamps_for_daterange(self, start_date, end_date):
+        """
+        Return timestamps for a given date range, see the wrapped stack.
+        """
+        return self.dataset.tstamps_for_daterange(start_date, end_date)
+
+    def timestamp_array(self, start_date, end_date):
+        """
+        Timestamps as datetime64 array, see the wrapped stack.
+        """
+        return self.dataset.timestamp_array(start_date, end_date)
+
+    def read_block(self, day, hours, metrics=None):
+        """
+        Read and regrid several hourly images of one day.
+
+        Parameters
+        ----------
+        day : datetime.datetime
+            day of the file
+        hours : list of int
+            hours of the day to read
+        metrics : merra.metrics.Metrics, optional
+            metrics the reading stages are recorded in
+
+        Returns
+        -------
+        data : dict
+            (hour, gpi) array of each parameter on the target grid
+        metadata : dict
+            long_name and units of each parameter
+        """
+        if metrics is None:
+            metrics = Metrics()
+        data, metadata = self.dataset.read_block(day, hours, metrics=metrics)
+        with metrics.timer('regrid'):
+            data = {parameter: self.regridder.regrid(block)
+                    for parameter, block in data.items()}
+        return data, metadata
+
+    def read(self, timestamp, **kwargs):
+        """
+        Read the regridded image of a timestamp.
+
+        Parameters
+        ----------
+        timestamp : datetime.datetime
+            exact timestamp of the image
+
+        Returns
+        -------
+        Image : object
+            pygeobase.object_base.Image object with 1D arrays
+        """
+        day = datetime(timestamp.year, timestamp.month, timestamp.day)
+        data, metadata = self.read_block(day, [timestamp.hour])
+        return Image(self.grid.activearrlon, self.grid.activearrlat,
+                     {parameter: block[0] for parameter, block in
+                      data.items()},
+                     metadata, timestamp)
+
+    def iter_arrays(self, start_date, end_date, read_ahead=0, metrics=None):
+        """
+        Stream the regridded images between two dates, see
+        :func:`merra.interface.stream_images`.
+        """
+        return stream_images(self, start_date, end_date,
+                             read_ahead=read_ahead, metrics=metrics)
@@ -0,0 +1,318 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019, TU Wien
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The remote module implements reading of MERRA2 files through fsspec file
+objects with h5py, e.g. from an object store behind an S3 compatible
+gateway. Opening a file only fetches the HDF5 metadata, reading fetches the
+compressed chunks of the requested hours, parameters and window. With a
+cache folder the fetched blocks are kept on local disk and are not fetched
+again by later reads.
+"""
+
+import os
+import hashlib
+import numpy as np
+
+from collections import OrderedDict
+
+# bytes fetched per request, about one compressed chunk of the MERRA2 files
+default_block_size = 2 ** 16
+
+# blocks of an open file kept in memory
+max_memory_blocks = 64
+
+# attributes of the HDF5 datasets that are netCDF internals
+hidden_attributes = ['DIMENSION_LIST', 'REFERENCE_LIST', 'CLASS', 'NAME',
+                     '_Netcdf4Coordinates', '_Netcdf4Dimid', '_nc3_strict']
+
+
+def is_remote(path):
+    """
+    True if the path is an URL with a protocol, e.g. s3://bucket/path.
+    """
+    return '://' in str(path)
+
+
+def get_filesystem(path, storage_options=None):
+    """
+    fsspec file system and path within it of a local path or URL.
+
+    Parameters
+    ----------
+    path : string
+        local path or URL
+    storage_options : dict, optional
+        options of the file system, e.g. endpoint_url and credentials of
+        an S3 compatible gateway
+
+    Returns
+    -------
+    fs : fsspec.AbstractFileSystem
+        file system
+    path : string
+        path within the file system
+    """
+    from fsspec.core import url_to_fs
+
+    fs, path = url_to_fs(str(path), **(storage_options or {}))
+    return fs, path
+
+
+def glob(pattern, storage_options=None):
+    """
+    Files matching a glob pattern as URLs of the same protocol.
+
+    Parameters
+    ----------
+    pattern : string
+        URL with wildcards
+    storage_options : dict, optional
+        options of the file system
+
+    Returns
+    -------
+    urls : list
+        sorted list of the matching files
+    """
+    fs, path = get_filesystem(pattern, storage_options)
+    return sorted(fs.unstrip_protocol(match) for match in fs.glob(path))
+
+
+def listdir(url, storage_options=None):
+    """
+    Names of the files in a folder, empty if the folder does not exist.
+    """
+    fs, path = get_filesystem(url, storage_options)
+    try:
+        return [entry.rstrip('/').split('/')[-1]
+                for entry in fs.ls(path, detail=False)]
+    except (IOError, OSError):
+        return []
+
+
+class BlockFile(object):
+    """
+    Read only file object fetching aligned blocks of a file of a fsspec
+    file system. The last blocks read are kept in memory and, with a cache
+    folder, stored on disk so that they are not fetched again when
+    the file is opened later.
+
+    Parameters
+    ----------
+    fs : fsspec.AbstractFileSystem
+        file system
+    path : string
+        path of the file within the file system
+    block_size : int, optional
+        bytes fetched per request
+    cache_dir : string, optional
+        folder the fetched blocks are cached in
+    """
+
+    def __init__(self, fs, path, block_size=default_block_size,
+                 cache_dir=None):
+        self.f = fs.open(path, 'rb', block_size=block_size,
+                         cache_type='none')
+        self.size = fs.size(path)
+        self.block_size = block_size
+        self.position = 0
+        self.blocks = OrderedDict()
+        self.bytes_fetched = 0
+        self.cache_path = None
+        if cache_dir is not None:
+            key = '{}-{}'.format(fs.unstrip_protocol(path), self.size)
+            self.cache_path = os.path.join(
+                cache_dir, hashlib.sha1(key.encode()).hexdigest())
+            if not os.path.exists(self.cache_path):
+                os.makedirs(self.cache_path, exist_ok=True)
+
+    def _block(self, index):
+        """
+        Data of a block, from memory, the cache folder or the file.
+        """
+        if index in self.blocks:
+            self.blocks.move_to_end(index)
+            return self.blocks[index]
+        cache_file = None
+        if self.cache_path is not None:
+            cache_file = os.path.join(self.cache_path, str(index))
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                data = f.read()
+        else:
+            self.f.seek(index * self.block_size)
+            data = self.f.read(self.block_size)
+            self.bytes_fetched += len(data)
+            if cache_file is not None:
+                tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+                with open(tmp_file, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_file, cache_file)
+        self.blocks[index] = data
+        if len(self.blocks) > max_memory_blocks:
+            self.blocks.popitem(last=False)
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        end = min(self.position + size, self.size)
+        if end <= self.position:
+            return b''
+        first = self.position // self.block_size
+        last = (end - 1) // self.block_size
+        data = b''.join(self._block(index)
+                        for index in range(first, last + 1))
+        offset = self.position - first * self.block_size
+        data = data[offset:offset + end - self.position]
+        self.position = end
+        return data
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.position = offset
+        elif whence == 1:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.blocks.clear()
+        self.f.close()
+
+
+class H5Variable(object):
+    """
+    netCDF4 like view of a HDF5 dataset of a MERRA2 file. The data is
+    returned as stored, without masking.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+        HDF5 dataset
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.shape = dataset.shape
+        self.dtype = dataset.dtype
+
+    def ncattrs(self):
+        """
+        Names of the attributes.
+        """
+        return [name for name in self.dataset.attrs
+                if name not in hidden_attributes]
+
+    def getncattr(self, name):
+        """
+        Value of an attribute, strings are decoded and single values
+        unpacked.
+        """
+        value = self.dataset.attrs[name]
+        if isinstance(value, bytes):
+            return value.decode()
+        if isinstance(value, np.ndarray) and value.size == 1:
+            return value[0]
+        return value
+
+    def __getattr__(self, name):
+        if name in ('dataset', 'shape', 'dtype'):
+            raise AttributeError(name)
+        try:
+            return self.getncattr(name)
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, key):
+        return self.dataset[key]
+
+
+class H5Dataset(object):
+    """
+    Read only netCDF4 like access to a MERRA2 file through h5py and fsspec.
+
+    Parameters
+    ----------
+    path : string
+        local path or URL of the file
+    storage_options : dict, optional
+        options of the file system
+    cache_dir : string, optional
+        folder the fetched blocks are cached in, not cached by default
+    block_size : int, optional
+        bytes fetched per request
+    """
+
+    def __init__(self, path, storage_options=None, cache_dir=None,
+                 block_size=default_block_size):
+        import h5py
+
+        fs, fs_path = get_filesystem(path, storage_options)
+        self.file = BlockFile(fs, fs_path, block_size=block_size,
+                              cache_dir=cache_dir)
+        try:
+            self.h5 = h5py.File(self.file, 'r')
+        except Exception:
+            self.file.close()
+            raise IOError("{} can not be opened with h5py".format(path))
+        self.variables = {name: H5Variable(item)
+                          for name, item in self.h5.items()
+                          if isinstance(item, h5py.Dataset)}
+
+    @property
+    def bytes_fetched(self):
+        """
+        Bytes fetched from the file system so far, without the blocks
+        found in the cache folder.
+        """
+        return self.file.bytes_fetched
+
+    def close(self):
+        """
+        Close the file.
+        """
+        self.h5.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,489 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019, TU Wien
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The repack module implements a command line utility that rewrites the
+downloaded MERRA2 archive into a slim archive for reading. Only the chosen
+variables are kept, every variable is rechunked to one hour of the whole
+grid (or another chunk shape) and compressed with a fast codec. The files
+keep their names and folders, so the slim archive is read by
+``MerraImageStack`` and ``merra_repurpose`` like the original one.
+
+USAGE in terminal:
+merra_repack [-h] [--parameters P [P ...]] [--compression COMPRESSION]
+             [--n_proc N_PROC] dataset_root out_path
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+
+from merra.metrics import create_metrics
+from merra.products import get_collection
+from merra.reshuffle import mkdate
+
+logger = logging.getLogger(__name__)
+
+# one hour of the whole grid per chunk
+default_chunksizes = (1, 361, 576)
+
+# codecs in order of decompression speed
+fast_compressions = ['blosc_lz4', 'zstd', 'zlib']
+
+# coordinate variables that are always copied
+coordinates = ['time', 'lat', 'lon']
+
+# global attribute with the settings a file was repacked with
+settings_attribute = 'merra_repack'
+
+
+def fastest_compression():
+    """
+    Fastest compression filter supported by the installed netCDF library.
+
+    Returns
+    -------
+    compression : string
+    """
+    from merra.transpose import available_compressions
+
+    available = available_compressions()
+    return [name for name in fast_compressions if name in available][0]
+
+
+def repacked_filename(filename, data_path, out_path):
+    """
+    Path of the repacked file, in the same YYYY/MM folder and with the
+    same name below the output path.
+    """
+    return os.path.join(out_path, os.path.relpath(filename, data_path))
+
+
+def repack_settings(parameters=None, compression='zlib', complevel=1,
+                    shuffle=True, chunksizes=default_chunksizes):
+    """
+    Settings of a repacked file as JSON string, stored in its global
+    attribute merra_repack. See :func:`repack_file` for the parameters.
+
+    Returns
+    -------
+    settings : string
+    """
+    return json.dumps({'parameters': parameters,
+                       'compression': compression,
+                       'complevel': complevel, 'shuffle': bool(shuffle),
+                       'chunksizes': [int(size) for size in chunksizes]},
+                      sort_keys=True)
+
+
+def file_settings(filename):
+    """
+    Settings a file was repacked with.
+
+    Parameters
+    ----------
+    filename : string
+        path of the repacked file
+
+    Returns
+    -------
+    settings : string or None
+        settings stored by :func:`repack_file`, None if the file has none
+        or can not be opened
+    """
+    from netCDF4 import Dataset
+
+    try:
+        with Dataset(filename) as ds:
+            return getattr(ds, settings_attribute, None)
+    except (IOError, OSError):
+        return None
+
+
+def repack_file(filename, out_filename, parameters=None, compression='zlib',
+                complevel=1, shuffle=True, chunksizes=default_chunksizes):
+    """
+    Rewrite a MERRA2 file with the given variables, chunk shape and
+    compression. The file is written to a temporary name first and
+    renamed when it is complete. The settings are stored in the global
+    attribute merra_repack, see :func:`repack_settings`.
+
+    Parameters
+    ----------
+    filename : string
+        path of the MERRA2 file
+    out_filename : string
+        path of the repacked file
+    parameters : list, optional
+        variables to keep, all (time, lat, lon) variables by default
+    compression : string, optional
+        compression filter, one of
+        :func:`merra.transpose.available_compressions` or None
+    complevel : int, optional
+        compression level
+    shuffle : boolean, optional
+        apply the HDF5 shuffle filter before compression
+    chunksizes : tuple, optional
+        (time, lat, lon) chunk shape, clipped to the shape of the variables
+
+    Returns
+    -------
+    size : int
+        size of the repacked file in bytes
+    """
+    from netCDF4 import Dataset
+
+    folder = os.path.dirname(out_filename)
+    if not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    tmp_file = '{}.{}.tmp'.format(out_filename, os.getpid())
+
+    kwargs = {'shuffle': shuffle, 'complevel': complevel}
+    if compression == 'zlib':
+        kwargs['zlib'] = True
+    elif compression is not None:
+        kwargs['compression'] = compression
+
+    with Dataset(filename) as src, \
+            Dataset(tmp_file, 'w', format='NETCDF4') as dst:
+        src.set_auto_maskandscale(False)
+        dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+        dst.setncattr(settings_attribute, repack_settings(
+            parameters=parameters, compression=compression,
+            complevel=complevel, shuffle=shuffle, chunksizes=chunksizes))
+        for name, dimension in src.dimensions.items():
+            dst.createDimension(
+                name, None if dimension.isunlimited() else len(dimension))
+
+        if parameters is None:
+            parameters = [name for name, variable in src.variables.items()
+                          if variable.dimensions == ('time', 'lat', 'lon')]
+        for name in coordinates + list(parameters):
+            variable = src.variables[name]
+            attributes = {attr: variable.getncattr(attr)
+                          for attr in variable.ncattrs()}
+            fill_value = attributes.pop('_FillValue', None)
+            if name in coordinates:
+                out = dst.createVariable(name, variable.dtype,
+                                         variable.dimensions,
+                                         fill_value=fill_value)
+            else:
+                chunks = [min(chunk, size) for chunk, size in
+                          zip(chunksizes, variable.shape)]
+                out = dst.createVariable(name, variable.dtype,
+                                         variable.dimensions,
+                                         fill_value=fill_value,
+                                         chunksizes=chunks, **kwargs)
+            out.setncatts(attributes)
+            out[:] = variable[:]
+    os.replace(tmp_file, out_filename)
+    return os.path.getsize(out_filename)
+
+
+def _repack_worker(args):
+    """
+    Repack one file in a worker process, files that are already repacked
+    with the same settings are skipped.
+    """
+    filename, out_filename, overwrite, kwargs = args
+    size = os.path.getsize(filename)
+    if (not overwrite and os.path.exists(out_filename) and
+            os.path.getmtime(out_filename) >= os.path.getmtime(filename) and
+            file_settings(out_filename) == repack_settings(**kwargs)):
+        return filename, size, os.path.getsize(out_filename), False
+    return filename, size, repack_file(filename, out_filename,
+                                       **kwargs), True
+
+
+def read_time(filename, parameters, hours=None, n_reads=3):
+    """
+    Time of reading all hours of the parameters of a file with
+    :class:`merra.interface.MerraImage`, the best of several reads.
+
+    Parameters
+    ----------
+    filename : string
+        path of the file
+    parameters : list
+        parameters to read
+    hours : list of int, optional
+        hours to read, all by default
+    n_reads : int, optional
+        number of reads
+
+    Returns
+    -------
+    seconds : float
+    """
+    from merra.grid import create_merra_cell_grid
+    from merra.interface import MerraImage
+
+    if hours is None:
+        hours = list(range(24))
+    image = MerraImage(filename, parameter=list(parameters),
+                       grid=create_merra_cell_grid())
+    times = []
+    for _ in range(n_reads):
+        t0 = time.perf_counter()
+        image.read_block(hours)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def repack_archive(data_path, out_path, collection='lnd', start_date=None,
+                   end_date=None, parameters=None, compression='fastest',
+                   complevel=1, shuffle=True, chunksizes=default_chunksizes,
+                   n_proc=1, overwrite=False, n_reads=3, metrics=None):
+    """
+    Repack the files of the archive in a process pool, one file per task.
+    Files whose repacked file is newer and was repacked with the same
+    settings are skipped, so an interrupted or extended archive is repacked
+    incrementally.
+
+    Parameters
+    ----------
+    data_path : string
+        root path of the collection
+    out_path : string
+        root path of the repacked collection
+    collection : string, optional
+        short name or product name of the collection
+    start_date : datetime.datetime, optional
+        first day to repack
+    end_date : datetime.datetime, optional
+        last day to repack
+    parameters : list, optional
+        variables to keep, all by default
+    compression : string, optional
+        compression filter or None, by default the fastest available one,
+        see :func:`fastest_compression`
+    complevel : int, optional
+        compression level
+    shuffle : boolean, optional
+        apply the HDF5 shuffle filter before compression
+    chunksizes : tuple, optional
+        (time, lat, lon) chunk shape
+    n_proc : int, optional
+        number of worker processes
+    overwrite : boolean, optional
+        repack files that are already repacked again
+    n_reads : int, optional
+        reads of the first repacked file and its original to compare the
+        read time, 0 to skip the comparison
+    metrics : merra.metrics.Metrics, optional
+        metrics the progress is recorded in
+
+    Returns
+    -------
+    summary : dict
+        number of repacked and skipped files, size of the original and
+        repacked files in bytes and, if measured, the read time of one
+        original and repacked file in seconds
+    """
+    from merra.references import archive_files
+
+    if compression == 'fastest':
+        compression = fastest_compression()
+    filenames = archive_files(data_path, collection=collection,
+                              start_date=start_date, end_date=end_date)
+    if metrics is not None:
+        metrics.total = len(filenames)
+    logger.info("Repacking %d files of %s with %s.", len(filenames),
+                data_path, compression)
+
+    kwargs = {'parameters': parameters, 'compression': compression,
+              'complevel': complevel, 'shuffle': shuffle,
+              'chunksizes': chunksizes}
+    tasks = [(filename, repacked_filename(filename, data_path, out_path),
+              overwrite, kwargs) for filename in filenames]
+    if n_proc == 1:
+        results = map(_repack_worker, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(n_proc)
+        results = pool.imap_unordered(_repack_worker, tasks)
+
+    summary = {'repacked': 0, 'skipped': 0, 'size': 0, 'repacked_size': 0}
+    sample = None
+    try:
+        for filename, size, repacked_size, written in results:
+            summary['repacked' if written else 'skipped'] += 1
+            summary['size'] += size
+            summary['repacked_size'] += repacked_size
+            if written and sample is None:
+                sample = filename
+            if metrics is not None:
+                metrics.count('files', int(written))
+                metrics.count('bytes', repacked_size if written else 0)
+                metrics.progress(1)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if summary['size']:
+        logger.info("Repacked %d files, skipped %d, %.1f%% of the "
+                    "original size.", summary['repacked'],
+                    summary['skipped'],
+                    100. * summary['repacked_size'] / summary['size'])
+    if sample is not None and n_reads:
+        if parameters is None:
+            from netCDF4 import Dataset
+            with Dataset(sample) as ds:
+                parameters = [name for name, variable in ds.variables.items()
+                              if variable.dimensions == ('time', 'lat',
+                                                         'lon')]
+        summary['read_time'] = read_time(sample, parameters,
+                                         n_reads=n_reads)
+        summary['repacked_read_time'] = read_time(
+            repacked_filename(sample, data_path, out_path), parameters,
+            n_reads=n_reads)
+        logger.info("Reading %s takes %.3fs instead of %.3fs.",
+                    os.path.basename(sample), summary['repacked_read_time'],
+                    summary['read_time'])
+    return summary
+
+
+def parse_args(args):
+    """
+    Parse command line parameters for repacking the archive.
+
+    Parameters
+    ----------
+    args : list of strings
+        command line parameters
+
+    Returns
+    -------
+    args: argparse.Namespace object
+        command line parameters
+    """
+    parser = argparse.ArgumentParser(
+        description="Rewrite the MERRA2 files into a slim archive.")
+    parser.add_argument(
+        "dataset_root",
+        help='Root of local filesystem where the data is stored.')
+    parser.add_argument(
+        "out_path",
+        help='Root of the repacked archive.')
+    parser.add_argument(
+        "--collection",
+        default='lnd',
+        help="Short name or product name of the collection.")
+    parser.add_argument("-s", "--start", type=mkdate,
+                        help="First day to repack in format YYYY-MM-DD.")
+    parser.add_argument("-e", "--end", type=mkdate,
+                        help="Last day to repack in format YYYY-MM-DD.")
+    parser.add_argument(
+        "--parameters",
+        nargs='+',
+        help="Variables to keep, all variables by default.")
+    parser.add_argument(
+        "--compression",
+        help=(
+            "Compression filter: zlib, zstd, blosc_lz4, blosc_zstd, bzip2 "
+            "or none. By default the fastest filter supported by the netCDF "
+            "library (blosc_lz4, zstd or zlib)."))
+    parser.add_argument(
+        "--complevel",
+        type=int,
+        default=1,
+        help="Compression level.")
+    parser.add_argument(
+        "--no_shuffle",
+        action='store_true',
+        help="Do not apply the HDF5 shuffle filter before compression.")
+    parser.add_argument(
+        "--chunksizes",
+        type=int,
+        nargs=3,
+        default=list(default_chunksizes),
+        metavar=('TIME', 'LAT', 'LON'),
+        help="Chunk shape of the variables, one hour of the whole grid by "
+             "default.")
+    parser.add_argument(
+        "--n_proc",
+        default=1,
+        type=int,
+        help='Number of parallel processes repacking the files.')
+    parser.add_argument(
+        "--overwrite",
+        action='store_true',
+        help="Repack files that are already repacked again.")
+    parser.add_argument(
+        "--metrics_file",
+        help="File the progress metrics are exported to.")
+    parser.add_argument(
+        "--metrics_format",
+        choices=['jsonl', 'prometheus'],
+        default='jsonl',
+        help="Format of the metrics file.")
+    parser.add_argument(
+        "--log_level",
+        default='INFO',
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help="Logging level.")
+    args = parser.parse_args(args)
+    try:
+        get_collection(args.collection)
+    except ValueError as e:
+        parser.error(str(e))
+    from merra.transpose import available_compressions
+    if args.compression not in available_compressions() + ['none', None]:
+        parser.error("argument --compression: invalid choice: {} (choose "
+                     "from {})".format(args.compression, ', '.join(
+                         available_compressions() + ['none'])))
+    logging.basicConfig(level=args.log_level,
+                        format='%(asctime)s %(name)s %(levelname)s '
+                               '%(message)s')
+    return args
+
+
+def main(args):
+    args = parse_args(args)
+    metrics = create_metrics('merra_repack',
+                             metrics_file=args.metrics_file,
+                             metrics_format=args.metrics_format)
+    compression = args.compression or 'fastest'
+    if compression == 'none':
+        compression = None
+    summary = repack_archive(
+        args.dataset_root, args.out_path, collection=args.collection,
+        start_date=args.start, end_date=args.end,
+        parameters=args.parameters, compression=compression,
+        complevel=args.complevel, shuffle=not args.no_shuffle,
+        chunksizes=tuple(args.chunksizes), n_proc=args.n_proc,
+        overwrite=args.overwrite, metrics=metrics)
+    metrics.close()
+    return summary
+
+
+def run():
+    main(sys.argv[1:])
+
+
+if __name__ == '__main__':
+    run()
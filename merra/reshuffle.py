@@ -28,17 +28,25 @@ USAGE in terminal:
 reshuffle.py [-h] [--imgbuffer IMGBUFFER]
                     dataset_root timeseries_root start end parameters
                     [parameters ...]
+
+The numerical and I/O packages are only imported by the functions that need
+them, so that the command line interface starts quickly.
 """
 
 import os
 import sys
+import json
+import time
+import logging
 import argparse
 
 from datetime import datetime
 
-from repurpose.img2ts import Img2Ts
-from merra.interface import MerraImageStack
-from pygeogrids import BasicGrid
+from merra.products import (default_collection, get_collection,
+                            split_parameters)
+from merra.metrics import Metrics, create_metrics
+
+logger = logging.getLogger(__name__)
 
 
 def mkdate(date_string):
@@ -62,28 +70,206 @@ def mkdate(date_string):
         return datetime.strptime(date_string, '%Y-%m-%dT%H:%M')
 
 
+def create_input_dataset(in_path, parameters, temporal_sampling=6,
+                         hours=None, available_only=False, backend='netcdf4',
+                         storage_options=None, cache_dir=None, bbox=None,
+                         index_path=None):
+    """
+    Create the image stack to convert. Parameters of several collections
+    are read with one MerraMultiImageStack.
+
+    Parameters
+    ----------
+    in_path: string or dict
+        input path or URL of the lnd collection or of each collection.
+        The path of a collection that is not given is assumed to be a
+        folder named like the product (e.g. M2T1NXSLV.5.12.4) next to the
+        lnd input path.
+    parameters: list or dict
+        parameters to read, see
+        :py:class:`merra.interface.MerraMultiImageStack`
+    temporal_sampling: int in range [1, 24]
+        Get an image every n hours where n=temporal_sampling.
+    hours: list of int, optional
+        hours of the day of the images, overrides temporal_sampling
+    available_only: boolean, optional
+        only convert days with a file of every collection
+    backend: string, optional
+        'netcdf4', 'h5py' or 'references', see
+        :class:`merra.interface.MerraImage`
+    storage_options: dict, optional
+        options of the fsspec file system of the h5py backend
+    cache_dir: string, optional
+        folder the blocks fetched by the h5py backend are cached in
+    bbox: tuple, optional
+        (min_lon, min_lat, max_lon, max_lat), only the window of the
+        files containing the bounding box is read
+    index_path: string, optional
+        root of the reference files of the references backend
+
+    Returns
+    -------
+    input_dataset : MerraImageStack or MerraMultiImageStack
+        image stack returning 1D images
+    """
+    from merra.interface import MerraImageStack, MerraMultiImageStack
+    from merra.remote import is_remote
+
+    reader_options = dict(hours=hours, available_only=available_only,
+                          backend=backend, storage_options=storage_options,
+                          cache_dir=cache_dir, bbox=bbox,
+                          index_path=index_path)
+    grouped = split_parameters(parameters)
+    if not isinstance(in_path, dict):
+        in_path = {default_collection: in_path}
+    in_path = {get_collection(name)[0]: path
+               for name, path in in_path.items()}
+
+    if list(grouped.keys()) == [default_collection]:
+        return MerraImageStack(data_path=in_path[default_collection],
+                               parameter=grouped[default_collection],
+                               temporal_sampling=temporal_sampling,
+                               array_1d=True, **reader_options)
+
+    data_paths = {}
+    for collection in grouped:
+        product = get_collection(collection)[1]['product']
+        if collection in in_path:
+            data_paths[collection] = in_path[collection]
+        elif is_remote(in_path[default_collection]):
+            root = in_path[default_collection].rstrip('/').rsplit('/', 1)[0]
+            data_paths[collection] = '/'.join([root, product])
+        else:
+            root = os.path.dirname(
+                os.path.normpath(in_path[default_collection]))
+            data_paths[collection] = os.path.join(root, product)
+    return MerraMultiImageStack(data_paths, grouped,
+                                temporal_sampling=temporal_sampling,
+                                array_1d=True, **reader_options)
+
+
+def select_grid(grid, bbox=None, cells=None, cellsize_lat=5.0,
+                cellsize_lon=6.25):
+    """
+    Subset of the grid points that is converted.
+
+    Parameters
+    ----------
+    grid: pygeogrids.grids.BasicGrid
+        grid of the images
+    bbox: tuple, optional
+        (min_lon, min_lat, max_lon, max_lat) of the region to convert
+    cells: list, optional
+        only keep the grid points of these cells
+    cellsize_lat: float, optional
+        Cell size of the time series files in latitude direction.
+    cellsize_lon: float, optional
+        Cell size of the time series files in longitude direction.
+
+    Returns
+    -------
+    grid: pygeogrids.grids.BasicGrid
+        grid of the converted grid points
+    """
+    from pygeogrids import BasicGrid
+
+    if bbox is not None:
+        grid = grid.subgrid_from_gpis(grid.get_bbox_grid_points(
+            latmin=bbox[1], latmax=bbox[3],
+            lonmin=bbox[0], lonmax=bbox[2]))
+    if cells is not None:
+        cell_grid = grid.to_cell_grid(cellsize_lat=cellsize_lat,
+                                      cellsize_lon=cellsize_lon)
+        gpis, lons, lats = cell_grid.grid_points_for_cell(list(cells))
+        grid = BasicGrid(lons, lats, gpis=gpis)
+    return grid
+
+
+def open_files_budget(max_open_files, n_writers, reserved=64):
+    """
+    Number of cell files every writer may keep open.
+
+    The budget is shared by the writers of all samplings and limited to
+    the soft limit of open files of the process, minus the files
+    reserved for the input images and other uses.
+
+    Parameters
+    ----------
+    max_open_files: int
+        Number of cell files that are kept open by all writers together.
+    n_writers: int
+        Number of writers.
+    reserved: int, optional
+        Number of file descriptors that are not used for cell files.
+
+    Returns
+    -------
+    budget: int
+        Number of open cell files per writer, at least one.
+    """
+    try:
+        import resource
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY:
+            max_open_files = min(max_open_files, soft - reserved)
+    except ImportError:
+        pass
+    return max(1, max_open_files // n_writers)
+
+
 def reshuffle(in_path,
               out_path,
               start_date,
               end_date,
               parameters,
               temporal_sampling=6,
-              img_buffer=50):
+              img_buffer=50,
+              out_format='netcdf',
+              engine='transpose',
+              metrics=None,
+              compression='zlib',
+              complevel=4,
+              shuffle=True,
+              time_chunksize=1000,
+              location_chunksize=None,
+              max_open_files=1000,
+              cellsize_lat=5.0,
+              cellsize_lon=6.25,
+              bbox=None,
+              packing=None,
+              target_grid=None,
+              regrid_method='nearest',
+              weights_cache=None,
+              cells=None,
+              hours=None,
+              available_only=False,
+              backend='netcdf4',
+              storage_options=None,
+              cache_dir=None,
+              index_path=None,
+              samplings=None,
+              statistics=False,
+              climatology=False):
     """
     Reshuffle method applied to MERRA2 data.
 
     Parameters
     ----------
-    in_path: string
-        input path where merra2 data was downloaded
+    in_path: string or dict
+        input path where merra2 data was downloaded, or the input path of
+        each collection, see :func:`create_input_dataset`. URLs (e.g.
+        s3://bucket/M2T1NXLND.5.12.4) are read with the h5py backend.
     out_path : string
         Output path.
     start_date : datetime
         Start date.
     end_date : datetime
         End date.
-    parameters: list
-        parameters to read and convert
+    parameters: list or dict
+        parameters to read and convert. Parameters of other collections
+        than lnd are given as collection:parameter (e.g. slv:T2M) or as a
+        dict of parameter lists per collection. All parameters are written
+        into the same time series files.
     temporal_sampling: int in range [1, 24]
             Get an image every n hours where n=temporal_sampling. For example:
             if 1: return hourly sampled data -> hourly sampling
@@ -91,29 +277,231 @@ def reshuffle(in_path,
             if 24: return the 00:30 image of each day -> daily sampling
     img_buffer: int, optional
         How many images to read at once before writing the time series.
+    out_format: string, optional
+        Format of the time series. 'netcdf' writes the default
+        OrthoMultiTs cell files, 'binary' writes a flat memory-mappable
+        store as implemented in :mod:`merra.binary`.
+    engine: string, optional
+        Conversion engine. 'transpose' reads whole day files and writes
+        each cell in one call, see :mod:`merra.transpose`. 'img2ts' uses
+        the generic image by image conversion of the repurpose package
+        and only supports the netcdf format.
+    metrics: merra.metrics.Metrics, optional
+        Metrics the timing of the conversion stages, counters and progress
+        are recorded in. By default progress is only logged.
+    compression: string, optional
+        Compression filter of the netCDF variables, one of
+        :func:`merra.transpose.available_compressions` or None for
+        uncompressed files. The img2ts engine only supports zlib.
+    complevel: int, optional
+        Compression level.
+    shuffle: boolean, optional
+        Apply the HDF5 shuffle filter before compression.
+    time_chunksize: int, optional
+        Chunk size of the netCDF variables along the time dimension.
+    location_chunksize: int, optional
+        Chunk size of the netCDF variables along the location dimension,
+        by default all locations of a cell are in one chunk.
+    max_open_files: int, optional
+        Number of netCDF cell files of the transpose engine that are kept
+        open between the image buffers instead of being reopened for every
+        buffer. Every open file keeps its current chunks in memory, about
+        1.5 MB for a cell of one parameter with the default chunks. The
+        files are shared by the writers of all samplings and limited to
+        the open files allowed by the system (``ulimit -n``).
+    cellsize_lat: float, optional
+        Cell size of the time series files in latitude direction.
+    cellsize_lon: float, optional
+        Cell size of the time series files in longitude direction.
+    bbox: tuple, optional
+        (min_lon, min_lat, max_lon, max_lat) of the region to convert, by
+        default the whole globe is converted.
+    packing: dict, optional
+        Packing of parameters into int16 or float16, see
+        :class:`merra.packing.Packer`. int16 parameters without a range
+        use the range in :data:`merra.packing.default_ranges` or the range
+        of the first buffer. float16 is only supported by the binary
+        format.
+    target_grid: pygeogrids.grids.BasicGrid, optional
+        Grid the images are regridded to before the conversion, by default
+        the time series are written on the MERRA2 grid.
+    regrid_method: string, optional
+        'nearest', 'bilinear' or 'conservative' (regular lat/lon target
+        grids only), see :mod:`merra.regrid`.
+    weights_cache: string, optional
+        Folder the regridding weights are cached in, out_path by default.
+    cells: list, optional
+        Only convert the grid points of these cells (of the cell size given
+        by cellsize_lat and cellsize_lon), e.g. one shard of a distributed
+        conversion, see :mod:`merra.shards`. Not supported by the img2ts
+        engine.
+    hours: list of int, optional
+        Hours of the day of the converted images, e.g. [3, 9, 15, 21].
+        Overrides temporal_sampling.
+    available_only: boolean, optional
+        Only convert the days with a local file. By default the time axis
+        covers every day of the date range and days without a file are
+        skipped (netCDF) or filled (binary).
+    backend: string, optional
+        Library reading the MERRA2 files, 'netcdf4' or 'h5py'. The h5py
+        backend reads through fsspec and only fetches the chunks of the
+        converted hours, parameters and bbox, see :mod:`merra.remote`.
+        'references' reads the chunks at the offsets of the chunk index
+        written by merra_index without the HDF5 library, see
+        :mod:`merra.references`.
+    storage_options: dict, optional
+        Options of the fsspec file system of the h5py backend, e.g.
+        endpoint_url and credentials of an S3 compatible gateway.
+    cache_dir: string, optional
+        Folder the blocks fetched by the h5py backend are cached in.
+    index_path: string, optional
+        Root of the chunk index of the references backend, by default the
+        reference files are next to the files.
+    samplings: list, optional
+        Write several temporal samplings from one read pass, each into a
+        sub folder of out_path named after the sampling, e.g. 6h or
+        24h_mean. Samplings are given as HOURS or HOURS:AGGREGATION
+        strings (see :func:`merra.transpose.parse_sampling`) or
+        :class:`merra.transpose.TemporalSampling` objects. The hours of all
+        samplings are read, temporal_sampling and hours are ignored.
+    statistics: boolean, optional
+        Compute count, mean, standard deviation, minimum and maximum of the
+        time series of every grid point during the conversion and store
+        them in the sidecar file stats.nc next to grid.nc, see
+        :mod:`merra.stats`. Only supported by the transpose engine.
+    climatology: boolean, optional
+        Also compute the day of year climatology of the statistics, used
+        for anomalies. The accumulators hold 366 float32 means and int32
+        counts per grid point, parameter and sampling, e.g. 610 MB per
+        parameter for the full grid, and are only allocated if set.
     """
+    from pygeogrids import BasicGrid
+    from merra.packing import Packer
+    from merra.regrid import Regridder, RegriddedImageStack
+    from merra.transpose import (CellTransposer, NcCellWriter,
+                                 BinaryCellWriter, transpose_stack,
+                                 parse_sampling, TemporalSampling)
+
+    if metrics is None:
+        metrics = Metrics(name='merra_reshuffle')
+
+    if samplings is not None:
+        if engine != 'transpose':
+            raise ValueError(
+                "Several samplings are only supported by the transpose "
+                "engine.")
+        sampling_specs = samplings
+        samplings = [sampling if isinstance(sampling, TemporalSampling)
+                     else parse_sampling(sampling) for sampling in samplings]
+        names = [sampling.name for sampling in samplings]
+        if len(names) != len(set(names)):
+            raise ValueError("Samplings {} are not unique.".format(names))
+        # the images needed by any of the samplings are read once
+        hours = sorted(set(hour for sampling in samplings
+                           for hour in sampling.hours))
 
     # define input dataset
     # the img_bulk class in img2ts iterates through every nth
     # timestamp as specified by temporal_sampling
-    input_dataset = MerraImageStack(data_path=in_path,
-                                    parameter=parameters,
-                                    temporal_sampling=temporal_sampling,
-                                    array_1d=True)
+    # only the window of the region is read if the images are not
+    # regridded
+    window = None
+    if engine == 'transpose' and target_grid is None:
+        window = bbox
+    input_dataset = create_input_dataset(in_path, parameters,
+                                         temporal_sampling=temporal_sampling,
+                                         hours=hours,
+                                         available_only=available_only,
+                                         backend=backend,
+                                         storage_options=storage_options,
+                                         cache_dir=cache_dir, bbox=window,
+                                         index_path=index_path)
     product = 'MERRA2_hourly'
 
     # create out_path directory if it does not exist yet
     if not os.path.exists(out_path):
         os.makedirs(out_path)
 
+    if target_grid is not None:
+        if weights_cache is None:
+            weights_cache = out_path
+        input_dataset = RegriddedImageStack(
+            input_dataset, Regridder(
+                target_grid, method=regrid_method,
+                source_grid=input_dataset.grid, cache_dir=weights_cache,
+                missing_value=input_dataset.missing_value))
+
+    if samplings is not None:
+        # windows without valid images get the missing value of the images
+        samplings = [
+            sampling if isinstance(sampling, TemporalSampling)
+            else parse_sampling(sampling,
+                                missing_value=input_dataset.missing_value)
+            for sampling in sampling_specs]
+
     # set global attribute
     global_attributes = {'product': product}
 
-    # get ts attributes from fist day of data
-    data = input_dataset.read(start_date)
+    # get ts attributes from the first image
+    timestamps = input_dataset.timestamp_array(start_date, end_date)
+    if timestamps.size == 0:
+        raise IOError("No images between {} and {}.".format(start_date,
+                                                          end_date))
+    data = input_dataset.read(timestamps[0].tolist())
     ts_attributes = data.metadata
-    # define grid
-    grid = BasicGrid(data.lon, data.lat)
+    # define grid, regridded images keep the gpis of the target grid
+    image_gpis = input_dataset.grid.activegpis
+    grid = BasicGrid(data.lon, data.lat, gpis=image_gpis)
+
+    if engine == 'transpose':
+        grid = select_grid(grid, bbox=bbox, cells=cells,
+                           cellsize_lat=cellsize_lat,
+                           cellsize_lon=cellsize_lon)
+        transposer = CellTransposer(grid, cellsize_lat=cellsize_lat,
+                                    cellsize_lon=cellsize_lon,
+                                    image_gpis=image_gpis)
+        outputs = [(out_path, timestamps)]
+        if samplings is not None:
+            outputs = [(os.path.join(out_path, sampling.name),
+                        sampling.timestamps(timestamps))
+                       for sampling in samplings]
+        writers = []
+        open_files = open_files_budget(max_open_files, len(outputs))
+        for path, time_axis in outputs:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            packer = Packer(packing,
+                            missing_value=input_dataset.missing_value)
+            if out_format == 'binary':
+                writers.append(BinaryCellWriter(
+                    path, transposer, time_axis, ts_attributes,
+                    packer=packer))
+            else:
+                writers.append(NcCellWriter(
+                    path, ts_attributes, global_attr=global_attributes,
+                    zlib=False, compression=compression,
+                    complevel=complevel, shuffle=shuffle,
+                    unlim_chunksize=time_chunksize,
+                    location_chunksize=location_chunksize, packer=packer,
+                    max_open_files=open_files))
+        if samplings is None:
+            writers = writers[0]
+        transpose_stack(input_dataset, transposer, writers,
+                        start_date, end_date, img_buffer=img_buffer,
+                        metrics=metrics, samplings=samplings,
+                        statistics=statistics, climatology=climatology)
+        return
+
+    if out_format != 'netcdf':
+        raise ValueError(
+            "The img2ts engine only supports the netcdf format.")
+    if (compression not in (None, 'zlib') or bbox is not None or packing or
+            cells is not None or statistics):
+        raise ValueError(
+            "The img2ts engine only supports unpacked, zlib compressed "
+            "time series of the whole globe without statistics.")
+
+    from repurpose.img2ts import Img2Ts
 
     # define reshuffler
     reshuffler = Img2Ts(input_dataset=input_dataset,
@@ -122,13 +510,162 @@ def reshuffle(in_path,
                         enddate=end_date,
                         input_grid=grid,
                         imgbuffer=img_buffer,
-                        cellsize_lat=5.0,
-                        cellsize_lon=6.25,
+                        cellsize_lat=cellsize_lat,
+                        cellsize_lon=cellsize_lon,
                         global_attr=global_attributes,
-                        zlib=True,
-                        unlim_chunksize=1000,
+                        zlib=compression == 'zlib',
+                        unlim_chunksize=time_chunksize,
                         ts_attributes=ts_attributes)
-    reshuffler.calc()
+    with metrics.timer('img2ts'):
+        reshuffler.calc()
+    metrics.close()
+
+
+# layouts compared by default in the layout benchmark
+default_layouts = [
+    {'compression': 'zlib', 'complevel': 4, 'time_chunksize': 1000},
+    {'compression': 'zlib', 'complevel': 1, 'time_chunksize': 1000},
+    {'compression': 'zlib', 'complevel': 4, 'time_chunksize': 100},
+    {'compression': 'zlib', 'complevel': 4, 'time_chunksize': 1000,
+     'location_chunksize': 1},
+    {'compression': 'zlib', 'complevel': 4, 'time_chunksize': 1000,
+     'shuffle': False},
+    {'compression': None, 'time_chunksize': 1000},
+    {'compression': 'zstd', 'complevel': 3, 'time_chunksize': 1000},
+    {'compression': 'blosc_lz4', 'complevel': 4, 'time_chunksize': 1000}]
+
+
+def layout_name(layout):
+    """
+    Short name of a layout, e.g. zlib_c4_t1000_l1_noshuffle.
+
+    Parameters
+    ----------
+    layout : dict
+        keyword arguments of :func:`reshuffle` defining the layout
+
+    Returns
+    -------
+    name : string
+    """
+    compression = layout.get('compression')
+    if compression is None:
+        name = 'none'
+    else:
+        name = '{}_c{}'.format(compression, layout.get('complevel', 4))
+    name += '_t{}'.format(layout.get('time_chunksize', 1000))
+    if layout.get('location_chunksize') is not None:
+        name += '_l{}'.format(layout['location_chunksize'])
+    if not layout.get('shuffle', True):
+        name += '_noshuffle'
+    return name
+
+
+def benchmark_layouts(in_path,
+                      out_path,
+                      start_date,
+                      end_date,
+                      parameters,
+                      bbox,
+                      layouts=None,
+                      temporal_sampling=6,
+                      n_reads=20):
+    """
+    Write a sample region with several compression and chunk layouts and
+    measure size, write time and read latency of each.
+
+    Parameters
+    ----------
+    in_path: string or dict
+        input path where merra2 data was downloaded, see
+        :func:`create_input_dataset`
+    out_path : string
+        Output path, each layout is written into a sub folder.
+    start_date : datetime
+        Start date.
+    end_date : datetime
+        End date.
+    parameters: list
+        parameters to read and convert
+    bbox: tuple
+        (min_lon, min_lat, max_lon, max_lat) of the sample region
+    layouts: list of dict, optional
+        keyword arguments of :func:`reshuffle` defining each layout,
+        default_layouts if not given. Layouts with a compression filter
+        that is not supported by the netCDF library are skipped.
+    temporal_sampling: int, optional
+        temporal sampling of the time series
+    n_reads: int, optional
+        number of time series read to measure the read latency
+
+    Returns
+    -------
+    results : list of dict
+        name, size in bytes, write time in seconds and mean read latency
+        of a full time series in milliseconds of each layout
+    """
+    import numpy as np
+    from merra.interface import MerraTs
+    from merra.transpose import available_compressions
+
+    if layouts is None:
+        layouts = default_layouts
+
+    results = []
+    for layout in layouts:
+        if layout.get('compression') not in available_compressions() + [None]:
+            logger.info("Skipping layout %s, compression not supported.",
+                        layout_name(layout))
+            continue
+
+        name = layout_name(layout)
+        path = os.path.join(out_path, name)
+        t0 = time.perf_counter()
+        reshuffle(in_path, path, start_date, end_date, parameters,
+                  temporal_sampling=temporal_sampling, bbox=bbox, **layout)
+        write_time = time.perf_counter() - t0
+
+        size = sum(os.path.getsize(os.path.join(path, f))
+                   for f in os.listdir(path)
+                   if f.endswith('.nc') and f != 'grid.nc')
+
+        reader = MerraTs(path, parameters=parameters)
+        gpis = reader.grid.activegpis
+        gpis = gpis[np.linspace(0, gpis.size - 1,
+                                min(n_reads, gpis.size)).astype(int)]
+        t0 = time.perf_counter()
+        for gpi in gpis:
+            reader.read(gpi)
+        read_latency = (time.perf_counter() - t0) / gpis.size * 1e3
+        reader.close()
+
+        results.append({'name': name,
+                        'size': size,
+                        'write_time': write_time,
+                        'read_latency': read_latency})
+    return results
+
+
+def format_benchmark(results):
+    """
+    Format the results of :func:`benchmark_layouts` as a table.
+
+    Parameters
+    ----------
+    results : list of dict
+        benchmark results
+
+    Returns
+    -------
+    table : string
+    """
+    lines = ['{:<28} {:>12} {:>10} {:>10}'.format(
+        'layout', 'size_MB', 'write_s', 'read_ms')]
+    for result in results:
+        lines.append('{:<28} {:>12.3f} {:>10.2f} {:>10.3f}'.format(
+            result['name'], result['size'] / 1e6, result['write_time'],
+            result['read_latency']))
+    return '\n'.join(lines)
 
 
 def parse_args(args):
@@ -149,17 +686,31 @@ def parse_args(args):
         description="Convert MERRA2 images to time series format.")
     parser.add_argument(
         "dataset_root",
-        help='Root of local filesystem where the data is stored.')
+        help=('Root of local filesystem where the data is stored, or URL '
+              'of the data for the h5py backend.'))
     parser.add_argument(
         "timeseries_root",
         help='Root of local filesystem where the timeseries will be stored.')
     parser.add_argument("start", type=mkdate, help=(
         "Startdate. Either in format YYYY-MM-DD or YYYY-MM-DDTHH:MM."))
     parser.add_argument("end", type=mkdate, help=(
-        "Enddate. Either in format YYYY-MM-DD or YYYY-MM-DDTHH:MM."))
+        "Enddate. Either in format YYYY-MM-DD or YYYY-MM-DDTHH:MM. A date "
+        "without time includes all images of the day."))
     parser.add_argument("parameters", metavar="parameters",
                         nargs="+",
-                        help=("Parameters to download in numerical format."))
+                        help=("Parameters to convert. Parameters of other "
+                              "collections than lnd are given as "
+                              "collection:parameter, e.g. slv:T2M."))
+
+    parser.add_argument(
+        "--collection_root",
+        nargs=2,
+        action='append',
+        metavar=('COLLECTION', 'PATH'),
+        help=(
+            "Root of the data of another collection (e.g. slv). By default "
+            "a folder named like the product (e.g. M2T1NXSLV.5.12.4) next "
+            "to dataset_root is used."))
 
     parser.add_argument("--temporal_sampling", type=int, default=6,
                         help=(
@@ -167,6 +718,21 @@ def parse_args(args):
                             "Integers between 1 (1-hourly resolution) and 24"
                             "(daily resolution) are possible."))
 
+    parser.add_argument(
+        "--hours",
+        type=int,
+        nargs='+',
+        help=(
+            "Hours of the day of the converted images, e.g. 3 9 15 21. "
+            "Overrides --temporal_sampling."))
+
+    parser.add_argument(
+        "--available_only",
+        action='store_true',
+        help=(
+            "Only convert the days with a local file instead of every day "
+            "between start and end."))
+
     parser.add_argument(
         "--imgbuffer",
         type=int,
@@ -175,10 +741,259 @@ def parse_args(args):
             "How many images to read at once. Bigger numbers make the "
             "conversion faster but consume more memory."))
 
+    parser.add_argument(
+        "--out_format",
+        choices=['netcdf', 'binary'],
+        default='netcdf',
+        help=(
+            "Format of the time series. 'netcdf' writes OrthoMultiTs cell "
+            "files, 'binary' writes uncompressed memory-mappable cell "
+            "files for the fastest possible point extraction."))
+
+    parser.add_argument(
+        "--engine",
+        choices=['transpose', 'img2ts'],
+        default='transpose',
+        help=(
+            "Conversion engine. 'transpose' reads whole day files and "
+            "writes every cell in one call, 'img2ts' converts image by "
+            "image with the repurpose package."))
+
+    parser.add_argument(
+        "--compression",
+        default='zlib',
+        help=(
+            "Compression filter of the netCDF time series, one of zlib, "
+            "zstd, blosc_lz4, blosc_zstd, bzip2 or none. LZ4 and Zstd "
+            "are only available if the netCDF library supports them."))
+
+    parser.add_argument(
+        "--complevel",
+        type=int,
+        default=4,
+        help="Compression level.")
+
+    parser.add_argument(
+        "--no_shuffle",
+        action='store_true',
+        help="Do not apply the HDF5 shuffle filter before compression.")
+
+    parser.add_argument(
+        "--time_chunksize",
+        type=int,
+        default=1000,
+        help="Chunk size of the netCDF time series along time.")
+
+    parser.add_argument(
+        "--location_chunksize",
+        type=int,
+        help=(
+            "Chunk size of the netCDF time series along the locations. "
+            "By default all locations of a cell are in one chunk."))
+
+    parser.add_argument(
+        "--max_open_files",
+        type=int,
+        default=1000,
+        help=(
+            "Number of netCDF cell files kept open between the image "
+            "buffers, each keeps its current chunks in memory. Shared by "
+            "all samplings and limited by the allowed open files."))
+
+    parser.add_argument(
+        "--cellsize_lat",
+        type=float,
+        default=5.0,
+        help="Cell size of the time series files in latitude direction.")
+
+    parser.add_argument(
+        "--cellsize_lon",
+        type=float,
+        default=6.25,
+        help="Cell size of the time series files in longitude direction.")
+
+    parser.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'),
+        help="Only convert the grid points in this bounding box.")
+
+    parser.add_argument(
+        "--target_grid",
+        help=(
+            "pygeogrids grid file (e.g. of an EASE2 grid) the images are "
+            "regridded to before the conversion."))
+
+    parser.add_argument(
+        "--target_resolution",
+        type=float,
+        help=(
+            "Regrid the images to a regular lat/lon grid with this "
+            "resolution in degrees before the conversion, e.g. 0.25."))
+
+    parser.add_argument(
+        "--regrid_method",
+        default='nearest',
+        help=(
+            "Regridding method, one of nearest, bilinear or conservative. "
+            "'conservative' is only available for regular lat/lon target "
+            "grids."))
+
+    parser.add_argument(
+        "--weights_cache",
+        help=(
+            "Folder the regridding weights are cached in, by default "
+            "timeseries_root."))
+
+    parser.add_argument(
+        "--packing",
+        nargs='+',
+        metavar='PARAMETER:DTYPE[:MIN:MAX]',
+        help=(
+            "Store parameters with reduced precision, e.g. SFMC:int16 or "
+            "TSURF:int16:150:350 for scaled 16 bit integers or SFMC:float16 "
+            "(binary format only). Without a range the configured range "
+            "of the parameter or the range of the first buffer is used. "
+            "'default' packs all parameters with a configured range into "
+            "int16."))
+
+    parser.add_argument(
+        "--benchmark_layout", "--benchmark-layout",
+        action='store_true',
+        help=(
+            "Write a sample region (--bbox, by default 10E-20E, 45N-50N) "
+            "with several compression and chunk layouts and report size, "
+            "write time and read latency instead of converting."))
+
+    parser.add_argument(
+        "--shard_mode",
+        choices=['plan', 'work', 'merge', 'status'],
+        help=(
+            "Distributed conversion through a work queue in the output "
+            "folder, see merra.shards. 'plan' writes the shard manifest, "
+            "'work' claims and converts shards until none is left and can "
+            "run on any number of hosts sharing the output folder, "
+            "'merge' builds and validates the final store and 'status' "
+            "reports the shards that are done, claimed and to do."))
+
+    parser.add_argument(
+        "--cells_per_shard",
+        type=int,
+        help="Number of cells of each shard, all cells by default.")
+
+    parser.add_argument(
+        "--years_per_shard",
+        type=int,
+        help=(
+            "Number of years of each shard, the whole date range by "
+            "default."))
+
+    parser.add_argument(
+        "--stale_after",
+        type=float,
+        help=(
+            "Seconds after which the lock of an unfinished shard is "
+            "considered stale, e.g. of a killed worker, and the shard is "
+            "converted again. Running workers renew their locks every "
+            "quarter of this time."))
+
+    parser.add_argument(
+        "--samplings",
+        nargs='+',
+        metavar='SAMPLING',
+        help=(
+            "Write several temporal samplings from one read pass, each into "
+            "a sub folder of timeseries_root. A sampling is given as HOURS "
+            "for an image every n hours or HOURS:AGGREGATION (mean, min or "
+            "max) for the aggregation of n hour windows, e.g. 1 6 24:mean. "
+            "Overrides --temporal_sampling and --hours."))
+
+    parser.add_argument(
+        "--statistics",
+        action='store_true',
+        help=(
+            "Compute mean, standard deviation, minimum and maximum of "
+            "every grid point during the conversion and store them in "
+            "stats.nc next to grid.nc."))
+
+    parser.add_argument(
+        "--climatology",
+        action='store_true',
+        help=(
+            "Also compute the day of year climatology of --statistics, "
+            "which needs 366 values per grid point and parameter."))
+
+    parser.add_argument(
+        "--backend",
+        choices=['netcdf4', 'h5py', 'references'],
+        default='netcdf4',
+        help=(
+            "Library reading the MERRA2 files. 'h5py' reads local files or "
+            "URLs (e.g. s3://bucket/M2T1NXLND.5.12.4) through fsspec and "
+            "only fetches the chunks of the converted hours, parameters and "
+            "bbox. 'references' reads the chunks at the offsets of the "
+            "chunk index written by merra_index."))
+
+    parser.add_argument(
+        "--storage_options",
+        type=json.loads,
+        help=(
+            "Options of the fsspec file system of the h5py backend as JSON, "
+            "e.g. '{\"anon\": true}'."))
+
+    parser.add_argument(
+        "--cache_dir",
+        help=(
+            "Folder the blocks fetched by the h5py backend are cached in, "
+            "e.g. for repeated conversions of the same remote files."))
+
+    parser.add_argument(
+        "--index_path",
+        help=(
+            "Root of the chunk index of the references backend, by default "
+            "the reference files are next to the files."))
+
+    parser.add_argument(
+        "--metrics_file",
+        help=(
+            "File the timing, throughput and progress metrics are "
+            "exported to."))
+
+    parser.add_argument(
+        "--metrics_format",
+        choices=['jsonl', 'prometheus'],
+        default='jsonl',
+        help=(
+            "Format of the metrics file. 'jsonl' appends one JSON line per "
+            "report, 'prometheus' writes a textfile for the node exporter."))
+
+    parser.add_argument(
+        "--log_level",
+        default='INFO',
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help="Logging level.")
+
     args = parser.parse_args(args)
+    # choices that need the netCDF library and scipy are checked after
+    # parsing so that --help does not import them
+    from merra.regrid import methods
+    from merra.transpose import available_compressions
+    if args.compression not in available_compressions() + ['none']:
+        parser.error("argument --compression: invalid choice: {} (choose "
+                     "from {})".format(args.compression, ', '.join(
+                         available_compressions() + ['none'])))
+    if args.regrid_method not in methods:
+        parser.error("argument --regrid_method: invalid choice: {} (choose "
+                     "from {})".format(args.regrid_method,
+                                       ', '.join(methods)))
     # set defaults that can not be handled by argparse
-    print("Converting data from {} to {} into folder {}.".format(
-        args.start.isoformat(), args.end.isoformat(), args.timeseries_root))
+    logging.basicConfig(level=args.log_level,
+                        format='%(asctime)s %(name)s %(levelname)s '
+                               '%(message)s')
+    logger.info("Converting data from %s to %s into folder %s.",
+                args.start.isoformat(), args.end.isoformat(),
+                args.timeseries_root)
     return args
 
 
@@ -186,14 +1001,104 @@ def main(args):
     # parse command line arguments
     args = parse_args(args)
 
+    in_path = {default_collection: args.dataset_root}
+    for collection, path in args.collection_root or []:
+        in_path[collection] = path
+
+    compression = args.compression
+    if compression == 'none':
+        compression = None
+
+    from pygeogrids.grids import genreg_grid
+    from pygeogrids.netcdf import load_grid
+    from merra.packing import parse_packing
+
+    packing = None
+    if args.packing:
+        packing = parse_packing(args.packing)
+
+    target_grid = None
+    if args.target_grid is not None:
+        target_grid = load_grid(args.target_grid)
+    elif args.target_resolution is not None:
+        target_grid = genreg_grid(args.target_resolution,
+                                  args.target_resolution)
+
+    if args.benchmark_layout:
+        bbox = args.bbox
+        if bbox is None:
+            bbox = (10., 45., 20., 50.)
+        results = benchmark_layouts(in_path,
+                                    args.timeseries_root,
+                                    args.start,
+                                    args.end,
+                                    args.parameters,
+                                    bbox,
+                                    temporal_sampling=args.temporal_sampling)
+        print(format_benchmark(results))
+        return
+
+    options = dict(temporal_sampling=args.temporal_sampling,
+                   hours=args.hours,
+                   available_only=args.available_only,
+                   img_buffer=args.imgbuffer,
+                   out_format=args.out_format,
+                   compression=compression,
+                   complevel=args.complevel,
+                   shuffle=not args.no_shuffle,
+                   time_chunksize=args.time_chunksize,
+                   location_chunksize=args.location_chunksize,
+                   max_open_files=args.max_open_files,
+                   cellsize_lat=args.cellsize_lat,
+                   cellsize_lon=args.cellsize_lon,
+                   bbox=args.bbox,
+                   packing=packing,
+                   target_grid=target_grid,
+                   regrid_method=args.regrid_method,
+                   weights_cache=args.weights_cache,
+                   backend=args.backend,
+                   storage_options=args.storage_options,
+                   cache_dir=args.cache_dir,
+                   index_path=args.index_path,
+                   samplings=args.samplings,
+                   statistics=args.statistics,
+                   climatology=args.climatology)
+
+    if args.shard_mode is not None:
+        from merra import shards
+        if args.shard_mode == 'plan':
+            shards.plan_shards(in_path,
+                               args.timeseries_root,
+                               args.start,
+                               args.end,
+                               args.parameters,
+                               cells_per_shard=args.cells_per_shard,
+                               years_per_shard=args.years_per_shard,
+                               **options)
+        elif args.shard_mode == 'work':
+            shards.run_worker(args.timeseries_root,
+                              stale_after=args.stale_after,
+                              metrics_file=args.metrics_file,
+                              metrics_format=args.metrics_format)
+        elif args.shard_mode == 'merge':
+            shards.merge_shards(args.timeseries_root)
+        else:
+            for key, shard_ids in shards.shard_status(
+                    args.timeseries_root).items():
+                print("{}: {}".format(key, ' '.join(shard_ids)))
+        return
+
     # hand over to reshuffle routine
-    reshuffle(args.dataset_root,
+    reshuffle(in_path,
               args.timeseries_root,
               args.start,
               args.end,
               args.parameters,
-              temporal_sampling=args.temporal_sampling,
-              img_buffer=args.imgbuffer)
+              engine=args.engine,
+              metrics=create_metrics('merra_reshuffle',
+                                     metrics_file=args.metrics_file,
+                                     metrics_format=args.metrics_format),
+              **options)
 
 
 def run():
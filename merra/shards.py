@@ -0,0 +1,785 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019, TU Wien
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The shards module splits a conversion into independent shards of cells and
+time ranges that are converted by any number of workers, e.g. on the nodes
+of a cluster. The workers share nothing but the file system: a shard is
+claimed by atomically creating its lock file, converted into a staging
+folder and marked as done. :func:`merge_shards` moves or concatenates the
+staged cells into the final store and validates it.
+
+Layout of the work queue in the output folder::
+
+    shards/manifest.json    conversion options and list of shards
+    shards/grid.nc          grid of the final store
+    shards/target_grid.nc   target grid of the regridding, if any
+    shards/0003.lock        shard 3 is claimed (worker, time and token)
+    shards/0003.done        shard 3 is converted
+    shards/0003/            time series of shard 3
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import socket
+import inspect
+import logging
+import threading
+import numpy as np
+
+from contextlib import contextmanager
+from datetime import datetime
+
+from merra.metrics import create_metrics
+from merra.reshuffle import reshuffle, create_input_dataset, select_grid
+from merra.stats import merge_stats_files, stats_filename
+
+logger = logging.getLogger(__name__)
+
+shards_dir_name = 'shards'
+manifest_name = 'manifest.json'
+
+# options of reshuffle that are not stored in the manifest
+excluded_options = ['metrics', 'engine', 'cells']
+
+
+def shards_path(out_path):
+    """
+    Folder of the work queue of a distributed conversion.
+    """
+    return os.path.join(out_path, shards_dir_name)
+
+
+def _shard_file(out_path, shard_id, suffix=''):
+    return os.path.join(shards_path(out_path), shard_id + suffix)
+
+
+def _write_json(filename, content):
+    """
+    Write a JSON file atomically, readers never see a partial file.
+    """
+    tmp_name = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp_name, 'w') as f:
+        json.dump(content, f, indent=2)
+    os.replace(tmp_name, filename)
+
+
+def worker_name():
+    """
+    Default name of a worker, host name and process id.
+    """
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def year_ranges(start_date, end_date, years_per_shard=1):
+    """
+    Split a date range at the start of years.
+
+    Parameters
+    ----------
+    start_date : datetime
+        Start date.
+    end_date : datetime
+        End date.
+    years_per_shard : int, optional
+        number of years of each range
+
+    Returns
+    -------
+    ranges : list of tuple
+        (start, end) datetimes of the ranges
+    """
+    ranges = []
+    start = start_date
+    while start <= end_date:
+        end = datetime(start.year + years_per_shard, 1, 1)
+        end = min(datetime.fromordinal(end.toordinal() - 1), end_date)
+        ranges.append((start, end))
+        start = datetime.fromordinal(end.toordinal() + 1)
+    return ranges
+
+
+def reshuffle_options(**options):
+    """
+    Keyword arguments of :func:`merra.reshuffle.reshuffle` of a sharded
+    conversion, completed with the defaults of reshuffle.
+    """
+    defaults = {name: parameter.default for name, parameter in
+                inspect.signature(reshuffle).parameters.items()
+                if parameter.default is not parameter.empty and
+                name not in excluded_options}
+    unknown = set(options) - set(defaults)
+    if unknown:
+        raise ValueError(
+            "Options {} are not supported by a sharded conversion".format(
+                sorted(unknown)))
+    defaults.update(options)
+    return defaults
+
+
+def plan_shards(in_path, out_path, start_date, end_date, parameters,
+                cells_per_shard=None, years_per_shard=None, time_ranges=None,
+                **options):
+    """
+    Split a conversion into shards of cells and time ranges and write the
+    shard manifest. The first image is read to find the cells of the
+    converted grid.
+
+    Parameters
+    ----------
+    in_path: string or dict
+        input path where merra2 data was downloaded, see
+        :func:`merra.reshuffle.create_input_dataset`
+    out_path : string
+        Output path of the final store, the work queue is created in
+        its shards folder.
+    start_date : datetime
+        Start date.
+    end_date : datetime
+        End date.
+    parameters: list
+        parameters to read and convert
+    cells_per_shard : int, optional
+        number of cells of each shard, all cells by default
+    years_per_shard : int, optional
+        number of years of each shard, the whole date range by default.
+        Shards of the same cells but different years are concatenated by
+        :func:`merge_shards`.
+    time_ranges : list of tuple, optional
+        explicit (start, end) datetimes of the shards, overrides
+        years_per_shard
+    **options
+        keyword arguments of :func:`merra.reshuffle.reshuffle`, e.g.
+        out_format, compression or bbox. int16 packing ranges must be
+        configured, ranges detected from data would differ between
+        shards.
+
+    Returns
+    -------
+    manifest : dict
+        content of the manifest
+    """
+    from pygeogrids import BasicGrid
+    from pygeogrids.netcdf import save_grid
+    from merra.packing import Packer
+    from merra.regrid import Regridder, RegriddedImageStack
+
+    options = reshuffle_options(**options)
+    if options['samplings'] is not None:
+        raise ValueError(
+            "Sharded conversions do not support several samplings.")
+    if not Packer(options['packing']).fitted:
+        raise ValueError(
+            "Sharded conversions need configured ranges for all int16 "
+            "packed parameters.")
+
+    queue_path = shards_path(out_path)
+    manifest_file = os.path.join(queue_path, manifest_name)
+    if os.path.exists(manifest_file):
+        raise IOError("{} exists already.".format(manifest_file))
+    if not os.path.exists(queue_path):
+        os.makedirs(queue_path)
+
+    input_dataset = create_input_dataset(
+        in_path, parameters, temporal_sampling=options['temporal_sampling'],
+        hours=options['hours'], available_only=options['available_only'],
+        backend=options['backend'],
+        storage_options=options['storage_options'],
+        cache_dir=options['cache_dir'], index_path=options['index_path'])
+    if options['target_grid'] is not None:
+        # compute the regridding weights once for all workers
+        if options['weights_cache'] is None:
+            options['weights_cache'] = out_path
+        input_dataset = RegriddedImageStack(
+            input_dataset, Regridder(
+                options['target_grid'], method=options['regrid_method'],
+                source_grid=input_dataset.grid,
+                cache_dir=options['weights_cache'],
+                missing_value=input_dataset.missing_value))
+        target_grid_file = os.path.join(queue_path, 'target_grid.nc')
+        save_grid(target_grid_file, options['target_grid'])
+        options['target_grid'] = target_grid_file
+
+    timestamps = input_dataset.timestamp_array(start_date, end_date)
+    if timestamps.size == 0:
+        raise IOError("No images between {} and {}.".format(start_date,
+                                                          end_date))
+    data = input_dataset.read(timestamps[0].tolist())
+    grid = select_grid(BasicGrid(data.lon, data.lat,
+                                 gpis=input_dataset.grid.activegpis),
+                       bbox=options['bbox'],
+                       cellsize_lat=options['cellsize_lat'],
+                       cellsize_lon=options['cellsize_lon'])
+    grid = grid.to_cell_grid(cellsize_lat=options['cellsize_lat'],
+                             cellsize_lon=options['cellsize_lon'])
+    save_grid(os.path.join(queue_path, 'grid.nc'), grid)
+    cells = [int(cell) for cell in grid.get_cells()]
+
+    if cells_per_shard is None:
+        cells_per_shard = len(cells)
+    if time_ranges is None:
+        if years_per_shard is None:
+            time_ranges = [(start_date, end_date)]
+        else:
+            time_ranges = year_ranges(start_date, end_date, years_per_shard)
+
+    shards = []
+    for i in range(0, len(cells), cells_per_shard):
+        for start, end in time_ranges:
+            shards.append({'id': '{:04d}'.format(len(shards)),
+                           'cells': cells[i:i + cells_per_shard],
+                           'start_date': start.isoformat(),
+                           'end_date': end.isoformat()})
+
+    manifest = {'in_path': in_path,
+                'parameters': list(parameters),
+                'start_date': start_date.isoformat(),
+                'end_date': end_date.isoformat(),
+                'options': options,
+                'shards': shards}
+    _write_json(manifest_file, manifest)
+    logger.info("Planned %d shards of %d cells in %s.", len(shards),
+                len(cells), queue_path)
+    return manifest
+
+
+def read_manifest(out_path):
+    """
+    Read the shard manifest of a distributed conversion.
+
+    Parameters
+    ----------
+    out_path : string
+        Output path of the final store.
+
+    Returns
+    -------
+    manifest : dict
+        content of the manifest, see :func:`plan_shards`
+    """
+    manifest_file = os.path.join(shards_path(out_path), manifest_name)
+    if not os.path.exists(manifest_file):
+        raise IOError(
+            "No shard manifest in {}, plan the shards first.".format(
+                out_path))
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def shard_status(out_path):
+    """
+    Shards that are done, claimed by a worker or still to do.
+
+    Parameters
+    ----------
+    out_path : string
+        Output path of the final store.
+
+    Returns
+    -------
+    status : dict
+        list of shard ids for 'done', 'claimed' and 'todo'
+    """
+    status = {'done': [], 'claimed': [], 'todo': []}
+    for shard in read_manifest(out_path)['shards']:
+        if os.path.exists(_shard_file(out_path, shard['id'], '.done')):
+            status['done'].append(shard['id'])
+        elif os.path.exists(_shard_file(out_path, shard['id'], '.lock')):
+            status['claimed'].append(shard['id'])
+        else:
+            status['todo'].append(shard['id'])
+    return status
+
+
+def claim_shard(out_path, worker=None, stale_after=None):
+    """
+    Claim the next shard that is neither done nor claimed by creating its
+    lock file with O_EXCL, which is atomic on local and NFS file systems.
+
+    Parameters
+    ----------
+    out_path : string
+        Output path of the final store.
+    worker : string, optional
+        name of the worker written into the lock file, host name and
+        process id by default
+    stale_after : float, optional
+        seconds after which the lock of a shard that is not done is
+        considered stale, e.g. of a killed worker, and the shard is claimed
+        again. Must be longer than the renewal interval of the locks of
+        running workers, see :func:`convert_shard`. Locks never become
+        stale by default.
+
+    Returns
+    -------
+    shard : dict or None
+        the claimed shard with the token of its lock or None if all shards
+        are done or claimed
+    """
+    worker = worker or worker_name()
+    for shard in read_manifest(out_path)['shards']:
+        if os.path.exists(_shard_file(out_path, shard['id'], '.done')):
+            continue
+        lock_file = _shard_file(out_path, shard['id'], '.lock')
+        if stale_after is not None and os.path.exists(lock_file):
+            try:
+                age = time.time() - os.path.getmtime(lock_file)
+                if age > stale_after:
+                    # only one worker succeeds to rename the stale lock
+                    stale_file = '{}.stale.{}'.format(lock_file,
+                                                      os.getpid())
+                    os.rename(lock_file, stale_file)
+                    os.remove(stale_file)
+                    logger.warning("Removed stale lock of shard %s.",
+                                   shard['id'])
+            except OSError:
+                pass
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        token = uuid.uuid4().hex
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'worker': worker, 'time': time.time(),
+                       'token': token}, f)
+        return dict(shard, token=token)
+    return None
+
+
+def owns_shard(out_path, shard):
+    """
+    True if the lock of a claimed shard was not taken over by another
+    worker after it became stale.
+
+    Parameters
+    ----------
+    out_path : string
+        Output path of the final store.
+    shard : dict
+        shard as returned by :func:`claim_shard`
+    """
+    try:
+        with open(_shard_file(out_path, shard['id'], '.lock')) as f:
+            lock = json.load(f)
+    except (IOError, OSError, ValueError):
+        return False
+    return lock.get('token') == shard.get('token')
+
+
+def release_shard(out_path, shard):
+    """
+    Remove the lock of a shard that was not converted, e.g. after an
+    error, so that another worker can claim it. The lock of another
+    worker is kept.
+    """
+    lock_file = _shard_file(out_path, shard['id'], '.lock')
+    if owns_shard(out_path, shard):
+        os.remove(lock_file)
+
+
+@contextmanager
+def renew_lock(out_path, shard, interval=None):
+    """
+    Touch the lock of a claimed shard every interval seconds in a
+    background thread while the shard is converted, so that it does not
+    become stale. The lock of another worker is not touched.
+
+    Parameters
+    ----------
+    out_path : string
+        Output path of the final store.
+    shard : dict
+        shard as returned by :func:`claim_shard`
+    interval : float, optional
+        seconds between the renewals, the lock is not renewed by default
+    """
+    if interval is None:
+        yield
+        return
+
+    lock_file = _shard_file(out_path, shard['id'], '.lock')
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(interval):
+            if not owns_shard(out_path, shard):
+                return
+            try:
+                os.utime(lock_file)
+            except OSError:
+                return
+
+    thread = threading.Thread(target=heartbeat, name='merra-shard-lock')
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def convert_shard(out_path, shard, manifest=None, metrics=None,
+                  renew_interval=None):
+    """
+    Convert a claimed shard into its staging folder and mark it as done.
+    The shard is not marked as done if its lock was taken over by another
+    worker in the meantime, which converts it again.
+
+    Parameters
+    ----------
+    out_path : string
+        Output path of the final store.
+    shard : dict
+        shard as returned by :func:`claim_shard`
+    manifest : dict, optional
+        content of the manifest, read from out_path if not given
+    metrics: merra.metrics.Metrics, optional
+        metrics of the conversion of the shard
+    renew_interval : float, optional
+        seconds between the renewals of the lock during the conversion,
+        see :func:`renew_lock`
+
+    Returns
+    -------
+    done : bool
+        False if the lock was taken over by another worker
+    """
+    from pygeogrids.netcdf import load_grid
+
+    if manifest is None:
+        manifest = read_manifest(out_path)
+    options = dict(manifest['options'])
+    if options['target_grid'] is not None:
+        options['target_grid'] = load_grid(options['target_grid'])
+
+    staging_path = _shard_file(out_path, shard['id'])
+    # remove the partial output of a worker that was killed
+    if os.path.exists(staging_path):
+        shutil.rmtree(staging_path)
+
+    t0 = time.perf_counter()
+    with renew_lock(out_path, shard, renew_interval):
+        reshuffle(manifest['in_path'], staging_path,
+                  datetime.fromisoformat(shard['start_date']),
+                  datetime.fromisoformat(shard['end_date']),
+                  manifest['parameters'], cells=shard['cells'],
+                  metrics=metrics, **options)
+    if not owns_shard(out_path, shard):
+        logger.warning("Lock of shard %s was taken over by another worker, "
+                       "it is not marked as done.", shard['id'])
+        return False
+    _write_json(_shard_file(out_path, shard['id'], '.done'),
+                {'worker': worker_name(), 'time': time.time(),
+                 'runtime': time.perf_counter() - t0})
+    release_shard(out_path, shard)
+    return True
+
+
+def run_worker(out_path, worker=None, stale_after=None, metrics_file=None,
+               metrics_format='jsonl'):
+    """
+    Claim and convert shards until all shards are done or claimed. Any
+    number of workers can run at the same time on hosts sharing the
+    output folder.
+
+    Parameters
+    ----------
+    out_path : string
+        Output path of the final store.
+    worker : string, optional
+        name of the worker, host name and process id by default
+    stale_after : float, optional
+        seconds after which locks of unfinished shards are stale, see
+        :func:`claim_shard`. The locks of the shards of this worker are
+        renewed every quarter of this time.
+    metrics_file : string, optional
+        file the metrics of each shard are exported to
+    metrics_format : string, optional
+        'jsonl' or 'prometheus'
+
+    Returns
+    -------
+    shard_ids : list
+        ids of the shards converted by this worker
+    """
+    manifest = read_manifest(out_path)
+    converted = []
+    while True:
+        shard = claim_shard(out_path, worker=worker, stale_after=stale_after)
+        if shard is None:
+            break
+        logger.info("Converting shard %s of %d cells from %s to %s.",
+                    shard['id'], len(shard['cells']), shard['start_date'],
+                    shard['end_date'])
+        metrics = create_metrics('merra_reshuffle',
+                                 metrics_file=metrics_file,
+                                 metrics_format=metrics_format)
+        try:
+            done = convert_shard(
+                out_path, shard, manifest=manifest, metrics=metrics,
+                renew_interval=None if stale_after is None
+                else stale_after / 4.)
+        except BaseException:
+            release_shard(out_path, shard)
+            raise
+        if done:
+            converted.append(shard['id'])
+    return converted
+
+
+def _read_nc_cell(filename, packer):
+    """
+    Read a staged netCDF cell file with unpacked data.
+    """
+    import netCDF4
+
+    with netCDF4.Dataset(filename) as ds:
+        ds.set_auto_maskandscale(False)
+        time_var = ds.variables['time']
+        timestamps = netCDF4.num2date(time_var[:], time_var.units,
+                                      only_use_cftime_datetimes=False,
+                                      only_use_python_datetimes=True)
+        data = {}
+        attributes = {}
+        for name, var in ds.variables.items():
+            if var.dimensions != ('locations', 'time'):
+                continue
+            data[name] = packer.unpack(name, var[:])
+            attributes[name] = {
+                attr: var.getncattr(attr) for attr in var.ncattrs()
+                if attr not in ('_FillValue', 'scale_factor', 'add_offset')}
+        return (ds.variables['location_id'][:], ds.variables['lon'][:],
+                ds.variables['lat'][:], timestamps, data, attributes,
+                ds.getncattr('product'))
+
+
+def _merge_nc_cell(out_path, cell, files, options):
+    """
+    Concatenate the staged netCDF files of a cell along time.
+    """
+    from merra.packing import Packer
+    from merra.transpose import NcCellWriter
+
+    packer = Packer(options['packing'])
+    writer = None
+    for filename in files:
+        gpis, lons, lats, timestamps, data, attributes, product = \
+            _read_nc_cell(filename, packer)
+        if writer is None:
+            writer = NcCellWriter(
+                out_path, attributes, global_attr={'product': product},
+                zlib=False, compression=options['compression'],
+                complevel=options['complevel'], shuffle=options['shuffle'],
+                unlim_chunksize=options['time_chunksize'],
+                location_chunksize=options['location_chunksize'],
+                packer=packer)
+        writer.write(cell, gpis, lons, lats, data, timestamps, None)
+    if writer is not None:
+        writer.close()
+
+
+def _merge_binary_cell(out_path, cell, sources, header):
+    """
+    Copy the staged binary matrices of a cell into their time slots.
+    """
+    from merra import binary
+    from merra.packing import Packer
+
+    packer = Packer(header['packing'])
+    cell_header = binary.read_cell_header(sources[0][0], cell)
+    n_gpi = cell_header['gpis'].size
+    for parameter in header['parameters']:
+        binary.create_cell(out_path, cell, cell_header['gpis'],
+                           cell_header['lons'], cell_header['lats'],
+                           [parameter], header['n_time'],
+                           dtype=packer.dtype(parameter),
+                           fill_value=packer.fill_value(parameter))
+        store = binary.open_cell_data(out_path, cell, parameter, n_gpi,
+                                      header['n_time'],
+                                      dtype=packer.dtype(parameter),
+                                      mode='r+')
+        for path, offset, n_time in sources:
+            store[:, offset:offset + n_time] = binary.open_cell_data(
+                path, cell, parameter, n_gpi, n_time,
+                dtype=packer.dtype(parameter))
+        store.flush()
+        del store
+
+
+def _merge_binary(out_path, sources):
+    """
+    Merge staged binary stores, the time axis of the final store is the
+    concatenation of the time axes of the time ranges.
+    """
+    from merra import binary
+
+    stores = {}
+    for paths in sources.values():
+        for path in paths:
+            if path not in stores:
+                stores[path] = binary.read_store_header(path)
+
+    # all cells have the same time ranges
+    paths = list(sources.values())[0]
+    header = stores[paths[0]][0]
+    timestamps = np.concatenate([stores[path][1] for path in paths])
+    binary.write_store_header(out_path, header['parameters'], timestamps,
+                              attributes=header['attributes'],
+                              packing=header['packing'])
+    header['n_time'] = timestamps.size
+
+    for cell, paths in sources.items():
+        if len(paths) == 1:
+            filenames = [binary.cell_header_templ.format(cell=cell)] + [
+                binary.cell_data_templ.format(cell=cell, parameter=parameter)
+                for parameter in header['parameters']]
+            for filename in filenames:
+                os.replace(os.path.join(paths[0], filename),
+                           os.path.join(out_path, filename))
+            continue
+        offsets = np.cumsum([0] + [stores[path][1].size for path in paths])
+        _merge_binary_cell(out_path, cell,
+                           [(path, offsets[i], stores[path][1].size)
+                            for i, path in enumerate(paths)], header)
+
+
+def validate_store(out_path, manifest=None):
+    """
+    Check that the store of a distributed conversion contains all cells of
+    the manifest with the same time axis.
+
+    Parameters
+    ----------
+    out_path : string
+        Output path of the final store.
+    manifest : dict, optional
+        content of the manifest, read from out_path if not given
+
+    Returns
+    -------
+    summary : dict
+        number of shards, cells and timestamps of the store
+    """
+    import netCDF4
+    from merra import binary
+    from pygeogrids.netcdf import load_grid
+
+    if manifest is None:
+        manifest = read_manifest(out_path)
+    cells = sorted(set(cell for shard in manifest['shards']
+                       for cell in shard['cells']))
+
+    grid_cells = load_grid(os.path.join(out_path, 'grid.nc')).get_cells()
+    if sorted(int(cell) for cell in grid_cells) != cells:
+        raise IOError("The cells of grid.nc do not match the manifest.")
+
+    n_times = set()
+    if manifest['options']['out_format'] == 'binary':
+        header, timestamps = binary.read_store_header(out_path)
+    for cell in cells:
+        if manifest['options']['out_format'] == 'binary':
+            n_gpi = binary.read_cell_header(out_path, cell)['gpis'].size
+            for parameter in header['parameters']:
+                filename = os.path.join(
+                    out_path, binary.cell_data_templ.format(
+                        cell=cell, parameter=parameter))
+                itemsize = np.dtype(header['packing'].get(
+                    parameter, {}).get('dtype', header['dtype'])).itemsize
+                if (os.path.getsize(filename) !=
+                        n_gpi * timestamps.size * itemsize):
+                    raise IOError("{} is incomplete.".format(filename))
+            n_times.add(timestamps.size)
+        else:
+            filename = os.path.join(out_path, '{:04d}.nc'.format(cell))
+            with netCDF4.Dataset(filename) as ds:
+                n_times.add(len(ds.dimensions['time']))
+    if len(n_times) != 1:
+        raise IOError(
+            "The cells of {} have different time axes.".format(out_path))
+
+    return {'shards': len(manifest['shards']),
+            'cells': len(cells),
+            'timestamps': n_times.pop()}
+
+
+def merge_shards(out_path, remove=True):
+    """
+    Move or concatenate the staged cells of all shards into the final
+    store, write its grid and validate it. Cells that are in a single
+    shard are moved, cells of several time ranges are concatenated.
+
+    Parameters
+    ----------
+    out_path : string
+        Output path of the final store.
+    remove : boolean, optional
+        remove the work queue and the staged shards after the merge
+
+    Returns
+    -------
+    summary : dict
+        number of shards, cells and timestamps of the merged store
+    """
+    manifest = read_manifest(out_path)
+    status = shard_status(out_path)
+    if status['todo'] or status['claimed']:
+        raise IOError(
+            "Shards {} are not converted yet.".format(
+                status['todo'] + status['claimed']))
+
+    # staged folders of each cell in time order
+    sources = {}
+    for shard in sorted(manifest['shards'],
+                        key=lambda shard: shard['start_date']):
+        for cell in shard['cells']:
+            sources.setdefault(cell, []).append(
+                _shard_file(out_path, shard['id']))
+
+    if manifest['options']['out_format'] == 'binary':
+        _merge_binary(out_path, sources)
+    else:
+        for cell, paths in sources.items():
+            files = [os.path.join(path, '{:04d}.nc'.format(cell))
+                     for path in paths]
+            if len(files) == 1:
+                os.replace(files[0], os.path.join(
+                    out_path, '{:04d}.nc'.format(cell)))
+            else:
+                _merge_nc_cell(out_path, cell, files, manifest['options'])
+
+    os.replace(os.path.join(shards_path(out_path), 'grid.nc'),
+               os.path.join(out_path, 'grid.nc'))
+    if manifest['options'].get('statistics'):
+        merge_stats_files([os.path.join(_shard_file(out_path, shard['id']),
+                                        stats_filename)
+                           for shard in manifest['shards']],
+                          os.path.join(out_path, stats_filename))
+    summary = validate_store(out_path, manifest)
+    logger.info("Merged %d shards of %d cells with %d timestamps.",
+                summary['shards'], summary['cells'], summary['timestamps'])
+    if remove:
+        shutil.rmtree(shards_path(out_path))
+    return summary
@@ -0,0 +1,445 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019, TU Wien
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The stats module implements statistics of the time series that are
+accumulated while the images are converted, so that no second pass over
+the time series is needed. Mean and standard deviation of every grid point
+are updated per buffer with the numerically stable algorithm of Welford
+and Chan, together with minimum and maximum. A day of year climatology is
+accumulated as running mean. The results are stored in a sidecar file next
+to grid.nc and used for anomalies by the time series readers.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+from netCDF4 import Dataset
+from merra.packing import is_sentinel
+
+# name of the sidecar file in the time series folder
+stats_filename = 'stats.nc'
+
+# days of the climatology, Feb 29 has its own day
+n_doy = 366
+
+# statistics of each parameter in the sidecar file
+statistics = ['count', 'mean', 'std', 'min', 'max']
+
+
+def day_of_year(timestamps):
+    """
+    Zero based day of the year in a leap year calendar, so that each date
+    has the same day in all years.
+
+    Parameters
+    ----------
+    timestamps : numpy.ndarray or pandas.DatetimeIndex
+        timestamps
+
+    Returns
+    -------
+    doy : numpy.ndarray
+        day of the year from 0 to 365
+    """
+    days = np.asarray(timestamps, dtype='datetime64[D]')
+    years = days.astype('datetime64[Y]')
+    doy = (days - years).astype(int)
+    year = years.astype(int) + 1970
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    return doy + ((~leap) & (doy >= 59))
+
+
+class StreamingStats(object):
+    """
+    Streaming statistics and climatology of the time series of grid
+    points.
+
+    Parameters
+    ----------
+    gpis : numpy.ndarray
+        grid points in the order of the rows of the updates
+    climatology : boolean, optional
+        accumulate the day of year climatology, which needs 366 float32
+        means and int32 counts per grid point and parameter. They are only
+        allocated if set.
+    missing_value : float, optional
+        value of missing data, the missing_value of the image stack. NaN is
+        always missing.
+    """
+
+    def __init__(self, gpis, climatology=False, missing_value=np.nan):
+        self.gpis = np.asarray(gpis)
+        self.climatology = climatology
+        self.missing_value = missing_value
+        self.parameters = {}
+
+    def _accumulators(self, parameter):
+        """
+        Accumulators of a parameter, created on first use.
+        """
+        if parameter not in self.parameters:
+            n = self.gpis.size
+            acc = {'count': np.zeros(n, dtype=np.int64),
+                   'mean': np.zeros(n, dtype=np.float64),
+                   'm2': np.zeros(n, dtype=np.float64),
+                   'min': np.full(n, np.inf),
+                   'max': np.full(n, -np.inf)}
+            if self.climatology:
+                acc['clim'] = np.zeros((n_doy, n), dtype=np.float32)
+                acc['clim_count'] = np.zeros((n_doy, n), dtype=np.int32)
+            self.parameters[parameter] = acc
+        return self.parameters[parameter]
+
+    def _valid(self, block):
+        """
+        Mask of the valid values of a block.
+        """
+        valid = np.isfinite(block)
+        if is_sentinel(self.missing_value):
+            valid &= block != np.float32(self.missing_value)
+        return valid
+
+    def update(self, timestamps, data):
+        """
+        Add a buffer of time series.
+
+        Parameters
+        ----------
+        timestamps : numpy.ndarray
+            timestamps of the columns of the blocks
+        data : dict
+            (gpi, time) block of each parameter
+        """
+        doy = None
+        if self.climatology:
+            doy = day_of_year(timestamps)
+        for parameter, block in data.items():
+            acc = self._accumulators(parameter)
+            valid = self._valid(block)
+            values = np.where(valid, block, 0.).astype(np.float64)
+            count = valid.sum(axis=1)
+            mean = values.sum(axis=1) / np.maximum(count, 1)
+            m2 = np.where(valid, (values - mean[:, np.newaxis]) ** 2,
+                          0.).sum(axis=1)
+            self._combine(acc, slice(None), count, mean, m2,
+                          np.where(valid, block, np.inf).min(axis=1),
+                          np.where(valid, block, -np.inf).max(axis=1))
+
+            if doy is None:
+                continue
+            for day in np.unique(doy):
+                columns = doy == day
+                day_count = valid[:, columns].sum(axis=1)
+                day_sum = values[:, columns].sum(axis=1)
+                total = acc['clim_count'][day] + day_count
+                acc['clim'][day] += (
+                    (day_sum - day_count * acc['clim'][day]) /
+                    np.maximum(total, 1)).astype(np.float32)
+                acc['clim_count'][day] = total
+
+    @staticmethod
+    def _combine(acc, rows, count, mean, m2, vmin, vmax):
+        """
+        Combine partial statistics into the accumulators of the rows with
+        the parallel algorithm of Chan et al.
+        """
+        count_a = acc['count'][rows]
+        total = count_a + count
+        delta = mean - acc['mean'][rows]
+        weight = count / np.maximum(total, 1)
+        acc['mean'][rows] += delta * weight
+        acc['m2'][rows] += m2 + delta ** 2 * count_a * weight
+        acc['count'][rows] = total
+        acc['min'][rows] = np.minimum(acc['min'][rows], vmin)
+        acc['max'][rows] = np.maximum(acc['max'][rows], vmax)
+
+    def merge(self, other):
+        """
+        Add the statistics of other grid points or another time range,
+        e.g. of the shards of a distributed conversion.
+
+        Parameters
+        ----------
+        other : StreamingStats
+            statistics to add, of the same or other grid points
+        """
+        gpis = np.union1d(self.gpis, other.gpis)
+        if gpis.size != self.gpis.size:
+            # extend the accumulators to the union of the grid points
+            rows = np.searchsorted(gpis, self.gpis)
+            self.gpis, old = gpis, self.parameters
+            self.parameters = {}
+            for parameter, old_acc in old.items():
+                acc = self._accumulators(parameter)
+                for key, values in old_acc.items():
+                    acc[key][..., rows] = values
+        rows = np.searchsorted(self.gpis, other.gpis)
+        for parameter, other_acc in other.parameters.items():
+            acc = self._accumulators(parameter)
+            self._combine(acc, rows, other_acc['count'], other_acc['mean'],
+                          other_acc['m2'], other_acc['min'],
+                          other_acc['max'])
+            if self.climatology and 'clim' in other_acc:
+                count_a = acc['clim_count'][:, rows]
+                total = count_a + other_acc['clim_count']
+                acc['clim'][:, rows] = (
+                    (acc['clim'][:, rows] * count_a +
+                     other_acc['clim'] * other_acc['clim_count']) /
+                    np.maximum(total, 1)).astype(np.float32)
+                acc['clim_count'][:, rows] = total
+
+    def results(self, parameter):
+        """
+        Statistics of a parameter.
+
+        Returns
+        -------
+        results : dict
+            count, mean, std (with one degree of freedom), min and max of
+            each grid point, NaN without valid values
+        """
+        acc = self.parameters[parameter]
+        count = acc['count']
+        empty = count == 0
+        std = np.sqrt(acc['m2'] / np.maximum(count - 1, 1))
+        std[count < 2] = np.nan
+        return {'count': count,
+                'mean': np.where(empty, np.nan, acc['mean']),
+                'std': std,
+                'min': np.where(empty, np.nan, acc['min']),
+                'max': np.where(empty, np.nan, acc['max'])}
+
+    def write(self, filename):
+        """
+        Write the statistics into a sidecar file.
+
+        Parameters
+        ----------
+        filename : string
+            path of the file
+        """
+        order = np.argsort(self.gpis)
+        with Dataset(filename, 'w') as ds:
+            ds.createDimension('gpi', self.gpis.size)
+            ds.createDimension('doy', n_doy)
+            ds.createVariable('gpi', 'i4', ('gpi',))[:] = self.gpis[order]
+            for parameter in sorted(self.parameters):
+                acc = self.parameters[parameter]
+                results = self.results(parameter)
+                for name in statistics:
+                    # double precision, so that merged shards are exact
+                    dtype = {'count': 'i4', 'mean': 'f8',
+                             'std': 'f8'}.get(name, 'f4')
+                    var = ds.createVariable(
+                        '{}_{}'.format(parameter, name), dtype, ('gpi',),
+                        zlib=True)
+                    var[:] = results[name][order]
+                if 'clim' in acc:
+                    for name, dtype in [('clim', 'f4'), ('clim_count', 'i4')]:
+                        var = ds.createVariable(
+                            '{}_{}'.format(parameter, name), dtype,
+                            ('doy', 'gpi'), zlib=True,
+                            chunksizes=(n_doy, min(self.gpis.size, 1024)))
+                        var[:] = acc[name][:, order]
+
+    @classmethod
+    def read(cls, filename):
+        """
+        Read the statistics of a sidecar file, e.g. to merge them.
+
+        Parameters
+        ----------
+        filename : string
+            path of the file
+
+        Returns
+        -------
+        stats : StreamingStats
+        """
+        with Dataset(filename) as ds:
+            ds.set_auto_mask(False)
+            gpis = ds.variables['gpi'][:]
+            names = [name[:-len('_count')] for name in ds.variables
+                     if name.endswith('_count') and
+                     not name.endswith('_clim_count')]
+            climatology = all('{}_clim'.format(name) in ds.variables
+                              for name in names)
+            stats = cls(gpis, climatology=climatology)
+            for parameter in names:
+                acc = stats._accumulators(parameter)
+                values = {name: ds.variables[
+                    '{}_{}'.format(parameter, name)][:]
+                    for name in statistics}
+                count = values['count'].astype(np.int64)
+                acc['count'][:] = count
+                acc['mean'][:] = np.nan_to_num(values['mean'])
+                acc['m2'][:] = np.nan_to_num(
+                    values['std'].astype(np.float64) ** 2 *
+                    np.maximum(count - 1, 0))
+                acc['min'][:] = np.where(count > 0, values['min'], np.inf)
+                acc['max'][:] = np.where(count > 0, values['max'], -np.inf)
+                if climatology:
+                    for name in ['clim', 'clim_count']:
+                        acc[name][:] = ds.variables[
+                            '{}_{}'.format(parameter, name)][:]
+        return stats
+
+
+def merge_stats_files(filenames, filename):
+    """
+    Merge the sidecar files of several grid point sets or time ranges.
+
+    Parameters
+    ----------
+    filenames : list
+        sidecar files to merge
+    filename : string
+        merged sidecar file
+    """
+    stats = StreamingStats.read(filenames[0])
+    for other in filenames[1:]:
+        stats.merge(StreamingStats.read(other))
+    stats.write(filename)
+
+
+class StatsReader(object):
+    """
+    Read the statistics and climatology of grid points from a sidecar
+    file. The file is kept open and only the rows of the requested grid
+    points are read.
+
+    Parameters
+    ----------
+    filename : string
+        path of the sidecar file
+    """
+
+    def __init__(self, filename):
+        self.ds = Dataset(filename)
+        self.ds.set_auto_mask(False)
+        self.gpis = self.ds.variables['gpi'][:]
+        self.variables = self.ds.variables
+
+    def _row(self, gpi):
+        """
+        Row of a grid point in the file.
+        """
+        row = np.searchsorted(self.gpis, gpi)
+        if row >= self.gpis.size or self.gpis[row] != gpi:
+            raise ValueError("No statistics of grid point {}".format(gpi))
+        return row
+
+    def stats(self, gpi, parameter):
+        """
+        Statistics of a parameter at a grid point.
+
+        Returns
+        -------
+        stats : dict
+            count, mean, std, min and max
+        """
+        row = self._row(gpi)
+        return {name: self.variables['{}_{}'.format(parameter, name)][row]
+                for name in statistics}
+
+    def climatology(self, gpi, parameter):
+        """
+        Day of year climatology of a parameter at a grid point.
+
+        Returns
+        -------
+        climatology : numpy.ndarray
+            mean of each day of the year, NaN for days without data
+        """
+        name = '{}_clim'.format(parameter)
+        if name not in self.variables:
+            raise ValueError(
+                "No climatology of {} stored, convert with "
+                "--climatology.".format(parameter))
+        row = self._row(gpi)
+        clim = self.variables[name][:, row]
+        count = self.variables['{}_clim_count'.format(parameter)][:, row]
+        return np.where(count > 0, clim, np.nan)
+
+    def anomalies(self, gpi, ts, climatology=True, missing_value=np.nan):
+        """
+        Anomalies of time series of a grid point.
+
+        Parameters
+        ----------
+        gpi : int
+            grid point of the time series
+        ts : pandas.DataFrame
+            time series with a DatetimeIndex
+        climatology : boolean, optional
+            subtract the day of year climatology, otherwise the mean
+        missing_value : float, optional
+            value of missing data besides NaN, returned as NaN
+
+        Returns
+        -------
+        anomalies : pandas.DataFrame
+            anomalies of the parameters with statistics
+        """
+        anomalies = {}
+        doy = day_of_year(ts.index.values)
+        for parameter in ts.columns:
+            if '{}_mean'.format(parameter) not in self.variables:
+                continue
+            values = ts[parameter].values.astype(np.float64)
+            if is_sentinel(missing_value):
+                values[values == missing_value] = np.nan
+            if climatology:
+                reference = self.climatology(gpi, parameter)[doy]
+            else:
+                reference = self.stats(gpi, parameter)['mean']
+            anomalies[parameter] = values - reference
+        return pd.DataFrame(anomalies, index=ts.index)
+
+    def close(self):
+        """
+        Close the sidecar file.
+        """
+        self.ds.close()
+
+
+def open_stats(ts_path):
+    """
+    Reader of the sidecar file of a time series folder.
+
+    Parameters
+    ----------
+    ts_path : string
+        time series folder
+
+    Returns
+    -------
+    reader : StatsReader
+    """
+    filename = os.path.join(ts_path, stats_filename)
+    if not os.path.exists(filename):
+        raise IOError(
+            "{} has no statistics, convert with statistics=True".format(
+                ts_path))
+    return StatsReader(filename)
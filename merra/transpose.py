@@ -0,0 +1,750 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019, TU Wien
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The transpose module implements a MERRA2 specific transposition engine for
+the conversion of images to time series. Whole day files are read as
+(time, gpi) blocks, reordered once into cell-major order with a precomputed
+permutation and every cell is written as one contiguous (gpi, time) slab.
+"""
+
+import os
+import logging
+import netCDF4
+import numpy as np
+
+from collections import OrderedDict
+from datetime import datetime
+
+from merra import binary
+from merra.metrics import Metrics
+from merra.packing import Packer, is_sentinel
+from merra.stats import StreamingStats, stats_filename
+from pygeogrids.netcdf import save_grid
+from pynetcf.time_series import OrthoMultiTs
+
+logger = logging.getLogger(__name__)
+
+# compression filters and the netCDF4 flag telling if the library was built
+# with support for them
+compression_support = OrderedDict([
+    ('zlib', None),
+    ('zstd', '__has_zstandard_support__'),
+    ('blosc_lz4', '__has_blosc_support__'),
+    ('blosc_zstd', '__has_blosc_support__'),
+    ('bzip2', '__has_bzip2_support__')])
+
+
+def available_compressions():
+    """
+    Compression filters supported by the installed netCDF library.
+
+    Returns
+    -------
+    compressions : list
+        names of the filters, zlib is always available
+    """
+    return [compression for compression, flag in compression_support.items()
+            if flag is None or getattr(netCDF4, flag, False)]
+
+
+class CellTransposer(object):
+    """
+    Precomputed permutation of the grid points of a 1D MERRA2 image into
+    cell-major order.
+
+    Parameters
+    ----------
+    grid : pygeogrids.grids.BasicGrid
+        grid of the 1D images, can be a subset of the image grid in which
+        case only its grid points are written
+    cellsize_lat : float, optional
+        Cell size in latitude direction.
+    cellsize_lon : float, optional
+        Cell size in longitude direction.
+    image_gpis : numpy.ndarray, optional
+        gpi of each column of the 1D images, e.g. the gpis of the target
+        grid of regridded images. By default the gpis are the column
+        numbers as on the MERRA2 grid.
+    """
+
+    def __init__(self, grid, cellsize_lat=5.0, cellsize_lon=6.25,
+                 image_gpis=None):
+        self.grid = grid.to_cell_grid(cellsize_lat=cellsize_lat,
+                                      cellsize_lon=cellsize_lon)
+
+        # sort by cell and within a cell by gpi, which is the order used
+        # in the netCDF cell files
+        self.order = np.lexsort((self.grid.activegpis,
+                                 self.grid.activearrcell))
+        self.cells, starts = np.unique(self.grid.activearrcell[self.order],
+                                       return_index=True)
+        self.bounds = list(zip(starts, np.append(starts[1:],
+                                                 self.order.size)))
+        self.gpis = self.grid.activegpis[self.order]
+        self.lons = self.grid.activearrlon[self.order]
+        self.lats = self.grid.activearrlat[self.order]
+        # column of each gpi in the 1D images
+        self.columns = self.gpis
+        if image_gpis is not None:
+            image_gpis = np.asarray(image_gpis)
+            sorter = np.argsort(image_gpis)
+            self.columns = sorter[np.searchsorted(image_gpis, self.gpis,
+                                                  sorter=sorter)]
+
+    def transpose(self, block):
+        """
+        Reorder a (time, gpi) block into a C-contiguous (gpi, time) block in
+        cell-major order.
+
+        Parameters
+        ----------
+        block : numpy.ndarray
+            (time, gpi) array with gpis in the order of the 1D images
+
+        Returns
+        -------
+        block : numpy.ndarray
+            (gpi, time) array in cell-major order
+        """
+        return np.ascontiguousarray(block.T[self.columns])
+
+    def iter_cells(self, data):
+        """
+        Split transposed blocks into the slabs of each cell.
+
+        Parameters
+        ----------
+        data : dict
+            (gpi, time) array in cell-major order for each parameter
+
+        Yields
+        ------
+        cell : int
+            cell number
+        gpis, lons, lats : numpy.ndarray
+            grid points of the cell
+        cell_data : dict
+            (gpi, time) slab of the cell for each parameter
+        """
+        for cell, (start, end) in zip(self.cells, self.bounds):
+            cell_data = {parameter: block[start:end]
+                         for parameter, block in data.items()}
+            yield (cell, self.gpis[start:end], self.lons[start:end],
+                   self.lats[start:end], cell_data)
+
+
+class NcCellWriter(object):
+    """
+    Append cell slabs to OrthoMultiTs netCDF files as read by
+    :py:class:`merra.interface.MerraTs`.
+
+    Parameters
+    ----------
+    out_path : string
+        Output path.
+    attributes : dict
+        metadata of each parameter
+    global_attr : dict, optional
+        global attributes of the cell files
+    zlib : boolean, optional
+        compress the variables with zlib, kept for backwards
+        compatibility, use compression instead
+    unlim_chunksize : int, optional
+        chunk size along the time dimension
+    time_units : string, optional
+        units of the time variable
+    compression : string, optional
+        compression filter, one of :func:`available_compressions` or None
+        for uncompressed variables. Defaults to zlib if zlib is set.
+    complevel : int, optional
+        compression level
+    shuffle : boolean, optional
+        apply the HDF5 shuffle filter before compression
+    location_chunksize : int, optional
+        chunk size along the location dimension, by default all locations
+        of a cell are in one chunk
+    packer : merra.packing.Packer, optional
+        packing of the parameters, only int16 packing is supported by
+        netCDF. The packed variables get CF scale_factor and add_offset
+        attributes.
+    max_open_files : int, optional
+        number of cell files that are kept open between the writes of the
+        batches. The files of further cells are opened and closed for
+        every batch, as the cells are written in the same order in every
+        batch closing the least recently written file would close every
+        file before it is written again.
+    """
+
+    filename_templ = '%04d.nc'
+
+    def __init__(self, out_path, attributes, global_attr=None, zlib=True,
+                 unlim_chunksize=1000,
+                 time_units='days since 1858-11-17 00:00:00',
+                 compression=None, complevel=4, shuffle=True,
+                 location_chunksize=None, packer=None, max_open_files=1000):
+        self.out_path = out_path
+        self.attributes = attributes
+        self.packer = packer or Packer()
+        for parameter in self.packer.packing:
+            if self.packer.dtype(parameter) == np.float16:
+                raise ValueError(
+                    "float16 packing of {} is not supported by netCDF, use "
+                    "int16 or the binary format.".format(parameter))
+        self.global_attr = global_attr or {}
+        if compression is None and zlib:
+            compression = 'zlib'
+        if (compression is not None and
+                compression not in available_compressions()):
+            raise ValueError(
+                "Compression {} is not supported by the netCDF library, "
+                "available are {}".format(compression,
+                                          available_compressions()))
+        self.compression = compression
+        self.complevel = complevel
+        self.shuffle = shuffle
+        self.unlim_chunksize = unlim_chunksize
+        self.location_chunksize = location_chunksize
+        self.time_units = time_units
+        self.max_open_files = max_open_files
+        self._open_cells = OrderedDict()
+
+    def _open_cell(self, cell, n_loc):
+        """
+        Open cell file from the open files or open it for appending. It
+        is kept open if less than max_open_files are open.
+
+        Parameters
+        ----------
+        cell : int
+            cell number
+        n_loc : int
+            number of grid points of the cell
+
+        Returns
+        -------
+        dataout : pynetcf.time_series.OrthoMultiTs
+            open cell file
+        """
+        if cell in self._open_cells:
+            return self._open_cells[cell]
+        # the data is packed already, netCDF4 must not scale it again
+        dataout = OrthoMultiTs(
+            os.path.join(self.out_path, self.filename_templ % cell),
+            n_loc=n_loc, mode='a',
+            zlib=self.compression == 'zlib', complevel=self.complevel,
+            unlim_chunksize=self.unlim_chunksize,
+            time_units=self.time_units, autoscale=False)
+        if len(self._open_cells) < self.max_open_files:
+            self._open_cells[cell] = dataout
+        return dataout
+
+    def _create_variables(self, dataout, data):
+        """
+        Create the data variables of a new cell file with the configured
+        filters and chunk shape.
+
+        Parameters
+        ----------
+        dataout : pynetcf.time_series.OrthoMultiTs
+            open cell file
+        data : dict
+            (gpi, time) slab for each parameter
+        """
+        n_loc = dataout.n_loc
+        if self.location_chunksize is not None:
+            n_loc = min(self.location_chunksize, n_loc)
+        chunksizes = None
+        if self.unlim_chunksize is not None:
+            chunksizes = (n_loc, self.unlim_chunksize)
+
+        kwargs = {'shuffle': self.shuffle}
+        if self.compression not in (None, 'zlib'):
+            kwargs['compression'] = self.compression
+
+        for key in data:
+            if key not in dataout.dataset.variables:
+                dataout.write_var(key, data=None,
+                                  dim=(dataout.loc_dim_name,
+                                       dataout.obs_dim_name),
+                                  attr=self.packer.attributes(key),
+                                  dtype=self.packer.dtype(key),
+                                  chunksizes=chunksizes, **kwargs)
+
+    def write(self, cell, gpis, lons, lats, data, timestamps, t_index):
+        """
+        Append the slabs of a cell.
+
+        Parameters
+        ----------
+        cell : int
+            cell number
+        gpis, lons, lats : numpy.ndarray
+            grid points of the cell
+        data : dict
+            (gpi, time) slab for each parameter
+        timestamps : numpy.ndarray
+            timestamps of the second dimension of the slabs
+        t_index : numpy.ndarray
+            position of the timestamps in the full time axis, not needed
+            for appending
+        """
+        data = {key: self.packer.pack(key, values)
+                for key, values in data.items()}
+        dataout = self._open_cell(cell, gpis.size)
+        self._create_variables(dataout, data)
+
+        for attr in self.global_attr:
+            dataout.add_global_attr(attr, self.global_attr[attr])
+        dataout.add_global_attr('geospatial_lat_min', np.min(lats))
+        dataout.add_global_attr('geospatial_lat_max', np.max(lats))
+        dataout.add_global_attr('geospatial_lon_min', np.min(lons))
+        dataout.add_global_attr('geospatial_lon_max', np.max(lons))
+
+        # the offset of an open file is only determined by its first write
+        dataout.write_offset = None
+        dataout.write_all(gpis, data, timestamps, lons=lons, lats=lats,
+                          attributes=self.attributes)
+        if cell not in self._open_cells:
+            dataout.close()
+
+    def close(self):
+        """
+        Close all open cell files.
+        """
+        for dataout in self._open_cells.values():
+            dataout.close()
+        self._open_cells = OrderedDict()
+
+
+class BinaryCellWriter(object):
+    """
+    Write cell slabs into the flat binary store of :mod:`merra.binary`.
+    The cells are allocated for the full time axis on initialization.
+
+    Parameters
+    ----------
+    out_path : string
+        Output path.
+    transposer : CellTransposer
+        transposer defining the cells and their grid points
+    timestamps : list
+        full time axis of the store
+    attributes : dict
+        metadata of each parameter
+    packer : merra.packing.Packer, optional
+        packing of the parameters, the packing is stored in the header of
+        the store
+    """
+
+    def __init__(self, out_path, transposer, timestamps, attributes,
+                 packer=None):
+        self.out_path = out_path
+        self.timestamps = timestamps
+        self.attributes = attributes
+        self.n_time = len(timestamps)
+        self.parameters = sorted(attributes.keys())
+        self.packer = packer or Packer()
+
+        self._write_header()
+        for cell, gpis, lons, lats, _ in transposer.iter_cells({}):
+            for parameter in self.parameters:
+                binary.create_cell(out_path, cell, gpis, lons, lats,
+                                   [parameter], self.n_time,
+                                   dtype=self.packer.dtype(parameter),
+                                   fill_value=self.packer.fill_value(
+                                       parameter))
+        self._header_packing = self.packer.fitted
+
+    def _write_header(self):
+        """
+        Write the store header with the current packing.
+        """
+        binary.write_store_header(self.out_path, self.parameters,
+                                  self.timestamps, attributes=self.attributes,
+                                  packing=self.packer.to_dict())
+
+    def write(self, cell, gpis, lons, lats, data, timestamps, t_index):
+        """
+        Write the slabs of a cell into their time slots.
+
+        Parameters
+        ----------
+        cell : int
+            cell number
+        gpis, lons, lats : numpy.ndarray
+            grid points of the cell
+        data : dict
+            (gpi, time) slab for each parameter
+        timestamps : numpy.ndarray
+            timestamps of the second dimension of the slabs
+        t_index : numpy.ndarray
+            position of the timestamps in the full time axis
+        """
+        if not self._header_packing:
+            # the packing ranges are known after the first buffer
+            self._write_header()
+            self._header_packing = True
+
+        t_slice = slice(t_index[0], t_index[-1] + 1)
+        if t_slice.stop - t_slice.start != len(t_index):
+            t_slice = t_index
+        for parameter in self.parameters:
+            store = binary.open_cell_data(self.out_path, cell, parameter,
+                                          gpis.size, self.n_time,
+                                          dtype=self.packer.dtype(parameter),
+                                          mode='r+')
+            store[:, t_slice] = self.packer.pack(parameter, data[parameter])
+            store.flush()
+            del store
+
+    def close(self):
+        """
+        Nothing to close, the cell files are only mapped while written.
+        """
+        pass
+
+
+# aggregations of the images within the windows of a temporal sampling
+aggregations = ['mean', 'min', 'max']
+
+
+def parse_sampling(spec, missing_value=np.nan):
+    """
+    Parse a temporal sampling as given on the command line.
+
+    Parameters
+    ----------
+    spec : string
+        HOURS for an image every n hours (e.g. 6) or HOURS:AGGREGATION for
+        the aggregation of the images of n hour windows (e.g. 24:mean)
+    missing_value : float, optional
+        value of missing data in the images, the missing_value of the image
+        stack, see :class:`TemporalSampling`
+
+    Returns
+    -------
+    sampling : TemporalSampling
+    """
+    fields = str(spec).split(':')
+    if len(fields) > 2 or not fields[0].isdigit():
+        raise ValueError(
+            "Sampling {} is not of the form HOURS or "
+            "HOURS:AGGREGATION".format(spec))
+    aggregation = fields[1] if len(fields) == 2 else None
+    return TemporalSampling(int(fields[0]), aggregation=aggregation,
+                            missing_value=missing_value)
+
+
+class TemporalSampling(object):
+    """
+    Temporal sampling of an output of the conversion, either every n-th
+    hourly image or an aggregation of the hourly images of n hour windows.
+    The windows start at midnight.
+
+    Parameters
+    ----------
+    step : int
+        hours between the images, a divisor of 24
+    aggregation : string, optional
+        'mean', 'min' or 'max' of the valid images of each window with the
+        center of the window as timestamp, e.g. 12:00 for daily windows.
+        By default the images at the start of each window are taken.
+    missing_value : float, optional
+        value of missing data in the images, NaN like the fill value of the
+        image stacks by default. NaN is always missing. Windows without
+        valid images are set to it.
+    """
+
+    def __init__(self, step, aggregation=None, missing_value=np.nan):
+        if step < 1 or 24 % step != 0:
+            raise ValueError(
+                "Sampling step {} is not a divisor of 24".format(step))
+        if aggregation is not None and aggregation not in aggregations:
+            raise ValueError("Aggregation {} is not one of {}".format(
+                aggregation, aggregations))
+        self.step = step
+        self.aggregation = aggregation
+        self.missing_value = missing_value
+
+    @property
+    def name(self):
+        """
+        Name of the output folder of the sampling, e.g. 6h or 24h_mean.
+        """
+        name = '{}h'.format(self.step)
+        if self.aggregation is not None:
+            name += '_' + self.aggregation
+        return name
+
+    @property
+    def hours(self):
+        """
+        Hours of the day of the images that are needed.
+        """
+        if self.aggregation is None:
+            return list(range(0, 24, self.step))
+        return list(range(24))
+
+    def _windows(self, timestamps):
+        """
+        Number of the window of each image timestamp.
+        """
+        minutes = (np.asarray(timestamps, dtype='datetime64[m]') -
+                   np.timedelta64(30, 'm')).astype(np.int64)
+        return minutes // (self.step * 60)
+
+    def _window_timestamps(self, windows):
+        """
+        Timestamps of the centers of windows.
+        """
+        return (windows * self.step * 60 + self.step * 30).astype(
+            'datetime64[m]')
+
+    def timestamps(self, timestamps):
+        """
+        Time axis of the output.
+
+        Parameters
+        ----------
+        timestamps : numpy.ndarray
+            datetime64 timestamps of the images that are read
+
+        Returns
+        -------
+        timestamps : numpy.ndarray
+            datetime64[m] timestamps of the output
+        """
+        timestamps = np.asarray(timestamps, dtype='datetime64[m]')
+        if self.aggregation is None:
+            hours = (timestamps - timestamps.astype('datetime64[D]')).astype(
+                'timedelta64[h]').astype(int)
+            return timestamps[np.isin(hours, self.hours)]
+        return self._window_timestamps(np.unique(self._windows(timestamps)))
+
+    def apply(self, timestamps, data):
+        """
+        Sample or aggregate transposed (gpi, time) blocks of images.
+
+        Parameters
+        ----------
+        timestamps : numpy.ndarray
+            datetime64 timestamps of the columns of the blocks in ascending
+            order
+        data : dict
+            (gpi, time) block of each parameter
+
+        Returns
+        -------
+        timestamps : numpy.ndarray
+            datetime64[m] timestamps of the columns of the output blocks
+        data : dict
+            (gpi, time) output block of each parameter
+        """
+        timestamps = np.asarray(timestamps, dtype='datetime64[m]')
+        if self.aggregation is None:
+            columns = np.isin(timestamps, self.timestamps(timestamps))
+            return timestamps[columns], {
+                parameter: block[:, columns]
+                for parameter, block in data.items()}
+
+        windows, starts = np.unique(self._windows(timestamps),
+                                    return_index=True)
+        aggregated = {}
+        for parameter, block in data.items():
+            valid = np.isfinite(block)
+            if is_sentinel(self.missing_value):
+                valid &= block != np.float32(self.missing_value)
+            counts = np.add.reduceat(valid, starts, axis=1)
+            if self.aggregation == 'mean':
+                values = np.add.reduceat(np.where(valid, block, 0.),
+                                         starts, axis=1, dtype=np.float64)
+                values /= np.maximum(counts, 1)
+            elif self.aggregation == 'min':
+                values = np.minimum.reduceat(np.where(valid, block, np.inf),
+                                             starts, axis=1)
+            else:
+                values = np.maximum.reduceat(np.where(valid, block, -np.inf),
+                                             starts, axis=1)
+            values = values.astype(block.dtype)
+            values[counts == 0] = (np.nan if self.missing_value is None
+                                   else self.missing_value)
+            aggregated[parameter] = values
+        return self._window_timestamps(windows), aggregated
+
+
+def group_by_day(timestamps):
+    """
+    Group timestamps by day.
+
+    Parameters
+    ----------
+    timestamps : list or numpy.ndarray
+        datetime.datetime objects or datetime64 array in ascending order
+
+    Returns
+    -------
+    days : OrderedDict
+        day as key and list of (position, timestamp) as values, the
+        timestamps are datetime.datetime objects
+    """
+    timestamps = np.asarray(timestamps, dtype='datetime64[m]')
+    day_numbers, starts = np.unique(timestamps.astype('datetime64[D]'),
+                                    return_index=True)
+    ends = np.append(starts[1:], timestamps.size)
+    days = OrderedDict()
+    for day, start, end in zip(day_numbers.tolist(), starts, ends):
+        days[datetime(day.year, day.month, day.day)] = list(zip(
+            range(start, end), timestamps[start:end].tolist()))
+    return days
+
+
+def transpose_stack(input_dataset, transposer, writer, start_date, end_date,
+                    img_buffer=50, metrics=None, samplings=None,
+                    statistics=False, climatology=False):
+    """
+    Read whole day files of the image stack in batches of at least
+    img_buffer images, transpose them into cell-major order and write
+    every cell slab in one call. Days that can not be read are skipped.
+
+    Parameters
+    ----------
+    input_dataset : MerraImageStack
+        image stack to convert
+    transposer : CellTransposer
+        precomputed permutation into cell-major order
+    writer : NcCellWriter or BinaryCellWriter or list
+        writer of the cell slabs, int16 packing ranges that are not
+        configured are taken from the first batch. A list of writers
+        writes several outputs from the same read pass.
+    start_date : datetime
+        Start date.
+    end_date : datetime
+        End date.
+    img_buffer : int, optional
+        Minimum number of images per batch, whole days are always read.
+    metrics : merra.metrics.Metrics, optional
+        metrics the stages, counters and progress are recorded in
+    samplings : list of TemporalSampling, optional
+        temporal sampling of the output of each writer, None writes all
+        images that are read
+    statistics : boolean, optional
+        accumulate the statistics of the time series of every grid point
+        while writing and store them in the sidecar file of each output,
+        see :mod:`merra.stats`
+    climatology : boolean, optional
+        also accumulate the day of year climatology of the statistics
+    """
+    writers = writer if isinstance(writer, list) else [writer]
+    if samplings is None:
+        samplings = [None] * len(writers)
+    if len(samplings) != len(writers):
+        raise ValueError("A sampling is needed for every writer.")
+    for writer in writers:
+        save_grid(os.path.join(writer.out_path, 'grid.nc'), transposer.grid)
+
+    timestamps = input_dataset.timestamp_array(start_date, end_date)
+    days = list(group_by_day(timestamps).items())
+    time_axes = [None if sampling is None else sampling.timestamps(timestamps)
+                 for sampling in samplings]
+    accumulators = [None] * len(writers)
+    if statistics:
+        accumulators = [StreamingStats(
+            transposer.gpis, climatology=climatology,
+            missing_value=input_dataset.missing_value) for _ in writers]
+
+    if metrics is None:
+        metrics = Metrics(name='merra_reshuffle')
+    metrics.total = len(timestamps)
+
+    try:
+        batch = []
+        n_images = 0
+        for i, (day, day_timestamps) in enumerate(days):
+            batch.append((day, day_timestamps))
+            n_images += len(day_timestamps)
+            if n_images < img_buffer and i < len(days) - 1:
+                continue
+
+            blocks = {}
+            batch_timestamps = []
+            t_index = []
+            for day, day_timestamps in batch:
+                hours = [timestamp.hour for _, timestamp in day_timestamps]
+                try:
+                    data, _ = input_dataset.read_block(day, hours,
+                                                       metrics=metrics)
+                except IOError as e:
+                    logger.warning(e)
+                    metrics.progress(len(hours))
+                    continue
+                for parameter, block in data.items():
+                    blocks.setdefault(parameter, []).append(block)
+                batch_timestamps.extend(ts for _, ts in day_timestamps)
+                t_index.extend(pos for pos, _ in day_timestamps)
+
+            batch = []
+            n_images = 0
+            if len(batch_timestamps) == 0:
+                continue
+
+            with metrics.timer('transpose'):
+                transposed = {parameter: transposer.transpose(np.vstack(block))
+                              for parameter, block in blocks.items()}
+            del blocks
+
+            batch_timestamps = np.array(batch_timestamps)
+            t_index = np.array(t_index)
+            for writer, sampling, time_axis, stats in zip(
+                    writers, samplings, time_axes, accumulators):
+                if sampling is None:
+                    out_timestamps, out_index, out_data = \
+                        batch_timestamps, t_index, transposed
+                else:
+                    with metrics.timer('aggregate'):
+                        out_timestamps, out_data = sampling.apply(
+                            batch_timestamps.astype('datetime64[m]'),
+                            transposed)
+                    out_index = np.searchsorted(time_axis, out_timestamps)
+                    out_timestamps = out_timestamps.astype(
+                        'datetime64[us]').astype(object)
+                if stats is not None:
+                    with metrics.timer('statistics'):
+                        stats.update(out_timestamps, out_data)
+                if not writer.packer.fitted:
+                    writer.packer.fit(out_data)
+
+                for cell, gpis, lons, lats, cell_data in \
+                        transposer.iter_cells(out_data):
+                    with metrics.timer('write'):
+                        writer.write(cell, gpis, lons, lats, cell_data,
+                                     out_timestamps, out_index)
+                    metrics.count('cells')
+            metrics.progress(len(batch_timestamps))
+    finally:
+        for writer in writers:
+            writer.close()
+
+    for writer, stats in zip(writers, accumulators):
+        if stats is not None:
+            stats.write(os.path.join(writer.out_path, stats_filename))
+    metrics.close()
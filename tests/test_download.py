@@ -1,13 +1,112 @@
 import os
+import re
+import shutil
+import tempfile
+import threading
 import unittest
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from urllib import request, error, parse
 
+import numpy as np
+import numpy.testing as npt
 from datetime import datetime
+from netCDF4 import Dataset
+from merra.interface import MerraImageStack
 from merra.download import get_last_formatted_dir_in_dir
 from merra.download import get_first_formatted_dir_in_dir
 from merra.download import get_last_folder
 from merra.download import get_first_folder
 from merra.download import folder_get_version_first_last
 from merra.download import get_start_date
+from merra.download import (remote_url, opendap_url, download_tasks,
+                            download_files, file_subset, subset_suffix)
+from merra.products import stream_number, daily_fname
+
+
+def fetch(urls, targets):
+    """
+    Download function like the one of datedown, which leaves an empty
+    file for URLs that are not found.
+    """
+    for url, target in zip(urls, targets):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            try:
+                with request.urlopen(url) as response:
+                    f.write(response.read())
+            except error.HTTPError:
+                pass
+
+
+def write_subset(source, target, constraint):
+    """
+    Write the hyperslabs of an OPeNDAP constraint of a file into a new
+    netCDF4 file.
+    """
+    def hyperslab(text):
+        values = [int(value) for value in text.split(':')]
+        if len(values) == 3:
+            return slice(values[0], values[2] + 1, values[1])
+        return slice(values[0], values[-1] + 1)
+
+    with Dataset(source) as src, Dataset(target, 'w') as dst:
+        src.set_auto_maskandscale(False)
+        for name, dims in re.findall(r'(\w+)((?:\[[\d:]+\])+)',
+                                     constraint):
+            index = tuple(hyperslab(dim)
+                          for dim in re.findall(r'\[([\d:]+)\]', dims))
+            variable = src.variables[name]
+            data = variable[index]
+            for dim, size in zip(variable.dimensions, data.shape):
+                if dim not in dst.dimensions:
+                    dst.createDimension(dim, size)
+            attrs = {attr: variable.getncattr(attr)
+                     for attr in variable.ncattrs()}
+            out = dst.createVariable(name, variable.dtype,
+                                     variable.dimensions, zlib=True,
+                                     fill_value=attrs.pop('_FillValue',
+                                                          None))
+            out.setncatts(attrs)
+            out[:] = data
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """
+    Static files and folder listings, netCDF4 subsets of the files for
+    OPeNDAP requests (file name + .nc4?constraint).
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path, _, constraint = self.path.partition('?')
+        if not constraint:
+            return super(QuietHandler, self).do_GET()
+        source = self.translate_path(path[:-len('.nc4')])
+        if not os.path.exists(source):
+            return self.send_error(404)
+        target = os.path.join(tempfile.mkdtemp(), 'subset.nc4')
+        write_subset(source, target, parse.unquote(constraint))
+        with open(target, 'rb') as f:
+            content = f.read()
+        self.server.sent_bytes += len(content)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def serve(root):
+    """
+    Serve a folder over HTTP on a free local port.
+    """
+    server = HTTPServer(('127.0.0.1', 0),
+                        partial(QuietHandler, directory=root))
+    server.sent_bytes = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
 
 
 class Test(unittest.TestCase):
@@ -81,6 +180,157 @@ class Test(unittest.TestCase):
     def test_get_start_date(self):
         product = 'M2T1NXLND.5.12.4'
         assert get_start_date(product) == datetime(1980, 1, 1)
+        assert get_start_date('M2T1NXSLV.5.12.4') == datetime(1980, 1, 1)
+
+    def test_urls(self):
+        """
+        URLs and paths follow from the date, existing days are skipped.
+        """
+        assert stream_number(datetime(1991, 12, 31)) == '100'
+        assert stream_number(datetime(1992, 1, 1)) == '200'
+        assert stream_number(datetime(2010, 6, 1)) == '300'
+        assert stream_number(datetime(2018, 10, 1)) == '400'
+        assert daily_fname('slv', datetime(1985, 3, 4)) == \
+            'MERRA2_100.tavg1_2d_slv_Nx.19850304.nc4'
+        assert remote_url('lnd', datetime(2018, 10, 2)) == (
+            'https://goldsmr4.gesdisc.eosdis.nasa.gov/data/MERRA2/'
+            'M2T1NXLND.5.12.4/2018/10/'
+            'MERRA2_400.tavg1_2d_lnd_Nx.20181002.nc4')
+
+        path = os.path.join(os.path.dirname(__file__),
+                            'merra-test-data', 'M2T1NXLND.5.12.4')
+        tasks = download_tasks('M2T1NXLND.5.12.4', datetime(2018, 9, 30),
+                               datetime(2018, 10, 2, 12), path)
+        assert [os.path.basename(target) for _, target in tasks] == [
+            'MERRA2_400.tavg1_2d_lnd_Nx.20180930.nc4',
+            'MERRA2_400.tavg1_2d_lnd_Nx.20181002.nc4']
+        assert tasks[1][1] == os.path.join(
+            path, '2018', '10', 'MERRA2_400.tavg1_2d_lnd_Nx.20181002.nc4')
+
+    def test_download_fallback(self):
+        """
+        Files are downloaded from the generated URLs, a day of another
+        stream is found in the listing of its folder.
+        """
+        remote = tempfile.mkdtemp()
+        folder = os.path.join(remote, 'data', 'MERRA2', 'M2T1NXLND.5.12.4',
+                              '2020', '09')
+        os.makedirs(folder)
+        for name in ['MERRA2_400.tavg1_2d_lnd_Nx.20200901.nc4',
+                     'MERRA2_401.tavg1_2d_lnd_Nx.20200902.nc4']:
+            with open(os.path.join(folder, name), 'wb') as f:
+                f.write(name.encode())
+        server = serve(remote)
+        url_root = 'http://127.0.0.1:{}'.format(server.server_port)
+
+        local = tempfile.mkdtemp()
+        tasks = download_tasks('lnd', datetime(2020, 9, 1),
+                               datetime(2020, 9, 3), local,
+                               url_root=url_root)
+        assert len(tasks) == 3
+        missing = download_files(tasks, fetch)
+        server.shutdown()
+
+        assert [target for _, target in missing] == [tasks[2][1]]
+        files = sorted(os.listdir(os.path.join(local, '2020', '09')))
+        assert files == ['MERRA2_400.tavg1_2d_lnd_Nx.20200901.nc4',
+                         'MERRA2_401.tavg1_2d_lnd_Nx.20200902.nc4']
+        with open(os.path.join(local, '2020', '09', files[1]), 'rb') as f:
+            assert f.read() == files[1].encode()
+        assert download_tasks('lnd', datetime(2020, 9, 1),
+                              datetime(2020, 9, 3), local) == [
+            (remote_url('lnd', datetime(2020, 9, 3)), tasks[2][1])]
+        shutil.rmtree(remote)
+
+    def test_download_subset(self):
+        """
+        OPeNDAP subsets of parameters, hours and region are downloaded and
+        read by the image stack like whole files.
+        """
+        assert opendap_url('lnd', datetime(2018, 10, 1), ['SFMC', 'RZMC'],
+                           hours=[0, 6, 12, 18], bbox=(15, 45, 20, 50)) == (
+            'https://goldsmr4.gesdisc.eosdis.nasa.gov/opendap/MERRA2/'
+            'M2T1NXLND.5.12.4/2018/10/'
+            'MERRA2_400.tavg1_2d_lnd_Nx.20181001.nc4.nc4?'
+            'SFMC[0:6:18][270:280][312:320],RZMC[0:6:18][270:280][312:320],'
+            'time[0:6:18],lat[270:280],lon[312:320]')
+        with self.assertRaises(ValueError):
+            opendap_url('lnd', datetime(2018, 10, 1), ['SFMC'],
+                        hours=[0, 1, 3])
+
+        fname = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'merra-test-data', 'M2T1NXLND.5.12.4', '2018',
+                             '10', 'MERRA2_400.tavg1_2d_lnd_Nx.20181001.nc4')
+        remote = tempfile.mkdtemp()
+        folder = os.path.join(remote, 'opendap', 'MERRA2',
+                              'M2T1NXLND.5.12.4', '2018', '10')
+        os.makedirs(folder)
+        # the second day is only available as stream 401
+        for name in ['MERRA2_400.tavg1_2d_lnd_Nx.20181001.nc4',
+                     'MERRA2_401.tavg1_2d_lnd_Nx.20181002.nc4']:
+            os.symlink(fname, os.path.join(folder, name))
+        server = serve(remote)
+        url_root = 'http://127.0.0.1:{}'.format(server.server_port)
+
+        local = tempfile.mkdtemp()
+        hours = [0, 6, 12, 18]
+        tasks = download_tasks('lnd', datetime(2018, 10, 1),
+                               datetime(2018, 10, 2), local,
+                               url_root=url_root, parameters=['SFMC'],
+                               hours=hours, bbox=(15, 45, 20, 50))
+        assert download_files(tasks, fetch) == []
+        server.shutdown()
+        assert 0 < server.sent_bytes < 2 * os.path.getsize(fname) / 1000
+
+        # the subset is recorded, only the same subset is skipped
+        constraint = tasks[0][0].partition('?')[2]
+        folder = os.path.join(local, '2018', '10')
+        names = sorted(name for name in os.listdir(folder)
+                       if name.endswith('.nc4'))
+        assert len(names) == 2
+        for name in names:
+            path = os.path.join(folder, name)
+            assert file_subset(path) == constraint
+            with open(path + subset_suffix) as f:
+                assert f.read() == constraint
+        assert download_tasks('lnd', datetime(2018, 10, 1),
+                              datetime(2018, 10, 2), local,
+                              url_root=url_root, parameters=['SFMC'],
+                              hours=hours, bbox=(15, 45, 20, 50)) == []
+        assert len(download_tasks('lnd', datetime(2018, 10, 1),
+                                  datetime(2018, 10, 2), local,
+                                  url_root=url_root,
+                                  parameters=['SFMC', 'RZMC'],
+                                  hours=hours)) == 2
+        assert len(download_tasks('lnd', datetime(2018, 10, 1),
+                                  datetime(2018, 10, 2), local)) == 2
+
+        stack = MerraImageStack(local, parameter='SFMC', hours=hours)
+        for day in [datetime(2018, 10, 1), datetime(2018, 10, 2)]:
+            data, _ = stack.read_block(day, hours)
+            npt.assert_allclose(data['SFMC'][:, 159290],
+                                [0.218083, 0.219587, 0.214836, 0.220690],
+                                rtol=1e-5)
+            assert np.isnan(data['SFMC'][:, 0]).all()
+        image = stack.read(datetime(2018, 10, 2, 6, 30))
+        npt.assert_allclose(image.data['SFMC'][84, 314], 0.219587,
+                            rtol=1e-5)
+        with self.assertRaises(IOError):
+            stack.read_block(datetime(2018, 10, 1), [3])
+
+        # a damaged subset newer than its record is downloaded again
+        path = os.path.join(folder, names[0])
+        with open(path, 'r+b') as f:
+            f.truncate(100)
+        mtime = os.path.getmtime(path + subset_suffix) + 10
+        os.utime(path, (mtime, mtime))
+        assert file_subset(path) is None
+        assert download_tasks('lnd', datetime(2018, 10, 1),
+                              datetime(2018, 10, 2), local,
+                              url_root=url_root, parameters=['SFMC'],
+                              hours=hours, bbox=(15, 45, 20, 50)) == [
+            tasks[0]]
+        shutil.rmtree(remote)
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
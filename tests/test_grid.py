@@ -1,5 +1,11 @@
+import os
+import tempfile
 import unittest
-from merra.grid import create_merra_cell_grid
+import numpy as np
+import numpy.testing as npt
+from pygeogrids.grids import CellGrid
+from merra.grid import (create_merra_cell_grid, publish_merra_grid,
+                        attach_merra_grid, shared_grid_env)
 
 
 class Test(unittest.TestCase):
@@ -19,6 +25,55 @@ class Test(unittest.TestCase):
         assert grid.activearrlat[159290] == 48.0
         assert grid.activearrlon[159290] == 16.25
 
+    def test_find_nearest_gpi(self):
+        """
+        The nearest grid point computed from row and column is the one of
+        the KD-tree search.
+        """
+        grid = create_merra_cell_grid()
+        tree_grid = CellGrid(grid.arrlon, grid.arrlat, grid.arrcell)
+        rng = np.random.default_rng(0)
+        lon = rng.uniform(-180, 180, 10000)
+        # the points of the pole rows are all at the same location
+        lat = rng.uniform(-89.7, 89.7, 10000)
+        gpi, dist = grid.find_nearest_gpi(lon, lat)
+        tree_gpi, tree_dist = tree_grid.find_nearest_gpi(lon, lat)
+        npt.assert_array_equal(gpi, tree_gpi)
+        npt.assert_allclose(dist, tree_dist)
+        assert grid.kdTree is None
+
+        assert grid.find_nearest_gpi(16.3, 48.1)[0] == 159290
+        assert grid.find_nearest_gpi(179.9, 0.1)[0] == 103680
+        assert grid.find_nearest_gpi(16.3, 48.1, max_dist=10)[0] == \
+            np.iinfo(np.int32).max
+        assert grid.gpi2rowcol(159290) == (276, 314)
+
+    def test_shared_grid(self):
+        """
+        Attach to the grid published in shared memory and as files.
+        """
+        grid = create_merra_cell_grid()
+        for path in [None, tempfile.mkdtemp()]:
+            with publish_merra_grid(path) as shared:
+                assert os.environ[shared_grid_env] == shared.name
+                attached = create_merra_cell_grid()
+                npt.assert_array_equal(attached.activearrlon,
+                                       grid.activearrlon)
+                npt.assert_array_equal(attached.activearrlat,
+                                       grid.activearrlat)
+                npt.assert_array_equal(attached.activearrcell,
+                                       grid.activearrcell)
+                assert not attached.arrlon.flags.writeable
+                assert attached.gpi2cell(159290) == 1431
+                assert attached.find_nearest_gpi(16.3, 48.1)[0] == 159290
+                # the nearest grid point is found without a KD-tree
+                assert attached.kdTree is None
+                del attached
+            assert shared_grid_env not in os.environ
+
+        # the files stay available for processes started later
+        assert attach_merra_grid(path).n_gpi == 207936
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,67 @@
+import os
+import sys
+import json
+import subprocess
+import unittest
+
+# packages that must not be imported by the command line entry points before
+# the conversion or download starts
+heavy_modules = ['numpy', 'pandas', 'netCDF4', 'scipy', 'pygeogrids',
+                 'pygeobase', 'pynetcf', 'repurpose', 'datedown']
+
+# upper bound of the import time in seconds, only checked if set because
+# the wall clock time depends on the machine and its load
+import_time_limit = float(os.environ.get('MERRA_IMPORT_TIME_LIMIT', 0))
+
+import_script = """
+import sys
+import json
+import time
+t0 = time.perf_counter()
+import {module}
+import_time = time.perf_counter() - t0
+print(json.dumps({{'import_time': import_time,
+                  'modules': sorted(m.split('.')[0] for m in sys.modules)}}))
+"""
+
+
+def measure_import(module):
+    """
+    Import a module in a fresh interpreter and return the import time in
+    seconds and the imported top level packages.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        [p for p in [env.get('PYTHONPATH')] if p])
+    output = subprocess.check_output(
+        [sys.executable, '-c', import_script.format(module=module)], env=env)
+    result = json.loads(output.decode().splitlines()[-1])
+    return result['import_time'], set(result['modules'])
+
+
+class Test(unittest.TestCase):
+    """
+    Import time regression tests of the command line entry points.
+    """
+
+    def test_cli_import_time(self):
+        for module in ['merra.reshuffle', 'merra.download']:
+            import_time, modules = measure_import(module)
+            assert not modules.intersection(heavy_modules), \
+                (module, sorted(modules.intersection(heavy_modules)))
+            if import_time_limit:
+                assert import_time < import_time_limit, (module,
+                                                         import_time)
+
+    def test_cli_help(self):
+        for module in ['merra.reshuffle', 'merra.download']:
+            output = subprocess.check_output(
+                [sys.executable, '-m', module, '--help'],
+                cwd=os.path.dirname(os.path.dirname(
+                    os.path.abspath(__file__))))
+            assert b'usage' in output
+
+
+if __name__ == "__main__":
+    unittest.main()
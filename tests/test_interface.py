@@ -1,8 +1,18 @@
 import os
+import shutil
+import tempfile
 import unittest
+import numpy as np
 import numpy.testing as npt
 from datetime import datetime
-from merra.interface import MerraImage, MerraImageStack
+from merra.interface import MerraImage, MerraImageStack, MerraMultiImageStack
+
+
+def sfmc_at_gpi(timestamp, data):
+    """
+    Per image function used in the map_images test.
+    """
+    return np.array([data['SFMC'][159290], timestamp.hour])
 
 
 class Test(unittest.TestCase):
@@ -96,6 +106,30 @@ class Test(unittest.TestCase):
         npt.assert_almost_equal(image.data['TSURF'][84][314], 277.240417,
                                 decimal=6)
 
+    def test_fill_values(self):
+        """
+        The fill value of the files is replaced with NaN or a sentinel.
+        """
+        fname = os.path.join(os.path.dirname(__file__), 'merra-test-data',
+                             'M2T1NXLND.5.12.4', '2018', '10',
+                             'MERRA2_400.tavg1_2d_lnd_Nx.20181001.nc4')
+        timestamp = datetime(2018, 10, 1, 0, 30)
+        raw = MerraImage(fname, array_1d=True, fill_value=None).read(
+            timestamp).data['SFMC']
+        missing = raw == np.float32(1e15)
+        assert missing.any() and not missing.all()
+
+        data = MerraImage(fname, array_1d=True).read(timestamp).data['SFMC']
+        assert data.dtype == np.float32
+        npt.assert_array_equal(np.isnan(data), missing)
+        npt.assert_array_equal(data[~missing], raw[~missing])
+
+        block, _ = MerraImage(fname, fill_value=-9999.,
+                              bbox=(15, 45, 20, 50)).read_block([0, 6])
+        assert (block['SFMC'][:, 0] == -9999.).all()
+        npt.assert_almost_equal(block['SFMC'][0, 159290], 0.218083,
+                                decimal=6)
+
     def test_image_stack_reading(self):
         """
         Test if the image stack is read correctly.
@@ -160,6 +194,123 @@ class Test(unittest.TestCase):
                            datetime(2018, 10, 1, 12, 30),
                            datetime(2018, 10, 1, 18, 30)]
 
+    def test_timestamps_sub_day_and_availability(self):
+        """
+        Sub-day bounds and hours are honoured, days without a file are
+        dropped with available_only.
+        """
+        path = os.path.join(os.path.dirname(__file__), 'merra-test-data',
+                            'M2T1NXLND.5.12.4')
+        img = MerraImageStack(path, hours=[3, 9, 15, 21])
+        tstamps = img.tstamps_for_daterange(datetime(2018, 10, 1, 4),
+                                            datetime(2018, 10, 2, 9, 30))
+        assert tstamps == [datetime(2018, 10, 1, 9, 30),
+                           datetime(2018, 10, 1, 15, 30),
+                           datetime(2018, 10, 1, 21, 30),
+                           datetime(2018, 10, 2, 3, 30),
+                           datetime(2018, 10, 2, 9, 30)]
+
+        img = MerraImageStack(path, temporal_sampling=12,
+                              available_only=True)
+        tstamps = img.timestamp_array(datetime(1980, 1, 1),
+                                      datetime(2019, 12, 31))
+        npt.assert_array_equal(tstamps, np.array(['2018-10-01T00:30',
+                                                  '2018-10-01T12:30'],
+                                                 dtype='datetime64[m]'))
+
+    def test_multi_collection_stack(self):
+        """
+        Test reading parameters of two collections in one pass. The slv
+        collection is emulated by a renamed copy of the lnd test file.
+        """
+        lnd_path = os.path.join(os.path.dirname(__file__),
+                                'merra-test-data', 'M2T1NXLND.5.12.4')
+        slv_path = os.path.join(tempfile.mkdtemp(), 'M2T1NXSLV.5.12.4')
+        os.makedirs(os.path.join(slv_path, '2018', '10'))
+        shutil.copy(
+            os.path.join(lnd_path, '2018', '10',
+                         'MERRA2_400.tavg1_2d_lnd_Nx.20181001.nc4'),
+            os.path.join(slv_path, '2018', '10',
+                         'MERRA2_400.tavg1_2d_slv_Nx.20181001.nc4'))
+
+        img = MerraMultiImageStack({'lnd': lnd_path, 'slv': slv_path},
+                                   parameter=['SFMC', 'slv:TSURF'],
+                                   array_1d=True)
+        assert img.stacks['lnd'].grid is img.stacks['slv'].grid
+
+        image = img.read(timestamp=datetime(2018, 10, 1, 0, 30))
+        assert sorted(image.data.keys()) == ['SFMC', 'TSURF']
+        npt.assert_almost_equal(image.data['SFMC'][159290], 0.218083,
+                                decimal=6)
+        npt.assert_almost_equal(image.data['TSURF'][159290], 277.240417,
+                                decimal=6)
+
+        data, metadata = img.read_block(datetime(2018, 10, 1), [0, 6])
+        assert data['TSURF'].shape == (2, 207936)
+        npt.assert_almost_equal(data['SFMC'][1, 159290], 0.219587,
+                                decimal=6)
+
+    def test_iter_arrays(self):
+        """
+        Test streaming the images of a day with and without read-ahead.
+        """
+        img = MerraImageStack(data_path=os.path.join(
+            os.path.dirname(__file__), 'merra-test-data', 'M2T1NXLND.5.12.4'),
+            parameter=['SFMC', 'TSURF'])
+
+        for read_ahead in [0, 2]:
+            images = list(img.iter_arrays(datetime(2018, 10, 1),
+                                          datetime(2018, 10, 2),
+                                          read_ahead=read_ahead))
+            # the second day is not available
+            assert [timestamp for timestamp, _ in images] == \
+                [datetime(2018, 10, 1, h, 30) for h in [0, 6, 12, 18]]
+            timestamp, data = images[1]
+            assert data['SFMC'].shape == img.grid.activearrlon.shape
+            npt.assert_almost_equal(data['SFMC'][159290], 0.219587,
+                                    decimal=6)
+
+        images = img.iter_arrays(datetime(2018, 10, 1),
+                                 datetime(2018, 10, 1), read_ahead=1)
+        next(images)
+        images.close()
+
+    def test_map_images(self):
+        """
+        Test applying a function to every image serially and in a pool.
+        """
+        img = MerraImageStack(data_path=os.path.join(
+            os.path.dirname(__file__), 'merra-test-data', 'M2T1NXLND.5.12.4'),
+            parameter=['SFMC'])
+
+        for n_proc in [1, 2]:
+            timestamps, results = img.map_images(sfmc_at_gpi,
+                                                 datetime(2018, 10, 1),
+                                                 datetime(2018, 10, 2),
+                                                 n_proc=n_proc)
+            assert timestamps == [datetime(2018, 10, 1, h, 30)
+                                  for h in [0, 6, 12, 18]]
+            assert results.shape == (4, 2)
+            npt.assert_almost_equal(results[:, 0], [0.218083, 0.219587,
+                                                    0.214836, 0.220690],
+                                    decimal=6)
+            npt.assert_equal(results[:, 1], [0, 6, 12, 18])
+
+        # the day read to find the shape of the results is not read again
+        days = []
+        read_block = img.read_block
+
+        def counting_read_block(day, hours):
+            days.append(day)
+            return read_block(day, hours)
+
+        img.read_block = counting_read_block
+        timestamps, results = img.map_images(sfmc_at_gpi,
+                                             datetime(2018, 10, 1),
+                                             datetime(2018, 10, 2))
+        assert days.count(datetime(2018, 10, 1)) == 1
+        assert results.shape == (4, 2)
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,64 @@
+import os
+import json
+import tempfile
+import unittest
+
+from merra.metrics import Metrics, JsonLinesSink, PrometheusSink
+
+
+class Test(unittest.TestCase):
+    """
+    Tests for the instrumentation layer.
+    """
+
+    def test_metrics_export(self):
+        """
+        Test timers, counters, ETA and both export formats.
+        """
+        path = tempfile.mkdtemp()
+        jsonl = os.path.join(path, 'metrics.jsonl')
+        prom = os.path.join(path, 'metrics.prom')
+        metrics = Metrics(name='test', total=4,
+                          sinks=[JsonLinesSink(jsonl), PrometheusSink(prom)],
+                          interval=3600)
+
+        with metrics.timer('read'):
+            pass
+        with metrics.timer('read'):
+            pass
+        metrics.count('images', 2)
+        metrics.progress(2)
+        assert metrics.eta() is not None
+        assert not os.path.exists(jsonl)
+
+        metrics.progress(2)
+        assert metrics.eta() == 0
+
+        # the final report is written only once
+        metrics.close()
+        with open(jsonl) as f:
+            lines = f.readlines()
+        assert len(lines) == 1
+        snapshot = json.loads(lines[-1])
+        assert snapshot['done'] == 4
+        assert snapshot['stages']['read']['calls'] == 2
+        assert snapshot['counters']['images'] == 2
+
+        with open(prom) as f:
+            lines = f.read().splitlines()
+        assert 'test_done_total 4' in lines
+        assert 'test_images_total 2' in lines
+        assert 'test_stage_calls_total{stage="read"} 2' in lines
+
+        # runs that are not complete report when they are closed
+        metrics = Metrics(name='test', total=4, sinks=[JsonLinesSink(jsonl)],
+                          interval=3600)
+        metrics.progress(2)
+        metrics.close()
+        with open(jsonl) as f:
+            lines = f.readlines()
+        assert len(lines) == 2 and json.loads(lines[-1])['done'] == 2
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import numpy as np
+import numpy.testing as npt
+import unittest
+
+from merra.packing import Packer, parse_packing, int16_fill_value
+
+
+class Test(unittest.TestCase):
+    """
+    Testing the packing of parameters
+    """
+
+    def test_int16_roundtrip(self):
+        """
+        Packed values are restored within half a packing step, missing
+        values become NaN.
+        """
+        packer = Packer({'SFMC': 'int16'}, missing_value=1e15)
+        data = np.array([[0., 0.218083, 1., np.nan, 1e15]],
+                        dtype=np.float32)
+        packed = packer.pack('SFMC', data)
+        assert packed.dtype == np.int16
+        assert packed[0, 3] == int16_fill_value
+        assert packed[0, 4] == int16_fill_value
+
+        unpacked = packer.unpack('SFMC', packed)
+        assert unpacked.dtype == np.float32
+        scale = packer.packing['SFMC']['scale_factor']
+        npt.assert_allclose(unpacked[0, :3], data[0, :3], atol=scale)
+        assert np.isnan(unpacked[0, 3:]).all()
+
+        # without sentinel only NaN is missing, 1e15 overflows float16
+        with np.errstate(over='ignore'):
+            packed = Packer({'SFMC': 'float16'}).pack('SFMC', data)
+        assert np.isnan(packed[0, 3])
+        assert np.isinf(packed[0, 4])
+
+    def test_fit(self):
+        """
+        The range of parameters without configured range is taken from the
+        first data and values outside are clipped.
+        """
+        packer = Packer({'T2M': 'int16', 'SFMC': 'float16'})
+        assert not packer.fitted
+        packer.fit({'T2M': np.array([250., 300., np.nan], dtype=np.float32)})
+        assert packer.fitted
+        assert packer.packing['T2M']['valid_range'] == (245., 305.)
+
+        packed = packer.pack('T2M', np.array([260., 400.], dtype=np.float32))
+        npt.assert_allclose(packer.unpack('T2M', packed), [260., 305.],
+                            atol=1e-3)
+        packed = packer.pack('SFMC', np.array([0.25, np.nan],
+                                              dtype=np.float32))
+        assert packed.dtype == np.float16
+        npt.assert_allclose(packer.unpack('SFMC', packed), [0.25, np.nan])
+
+    def test_parse_packing(self):
+        """
+        Command line packing with explicit and default ranges.
+        """
+        packing = parse_packing(['TSURF:int16:200:300', 'SFMC:float16'])
+        assert packing['TSURF'] == {'dtype': 'int16',
+                                    'valid_range': (200., 300.)}
+        assert packing['SFMC'] == {'dtype': 'float16'}
+        assert 'GWETTOP' in parse_packing(['default'])
+
+        packer = Packer(packing)
+        restored = Packer(packer.to_dict())
+        assert restored.packing['TSURF']['scale_factor'] == \
+            packer.packing['TSURF']['scale_factor']
+        with self.assertRaises(ValueError):
+            parse_packing(['SFMC'])
+        with self.assertRaises(ValueError):
+            Packer({'SFMC': 'int8'})
+
+
+if __name__ == "__main__":
+    unittest.main()
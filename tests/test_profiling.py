@@ -0,0 +1,48 @@
+import os
+import unittest
+
+from io import StringIO
+from datetime import datetime
+
+from merra import profiling
+from merra.interface import MerraImageStack
+
+
+class Test(unittest.TestCase):
+    """
+    Tests for the profiling hooks.
+    """
+
+    def test_profile_stack_read(self):
+        """
+        Test if the stages of an image stack read are recorded.
+        """
+        img = MerraImageStack(os.path.join(os.path.dirname(__file__),
+                                           'merra-test-data',
+                                           'M2T1NXLND.5.12.4'),
+                              parameter=['SFMC'])
+        stream = StringIO()
+        with profiling.profile(stream) as profiler:
+            img.read(timestamp=datetime(2018, 10, 1, 0, 30))
+
+        for name in ['stack_read', 'glob', 'open', 'decompress',
+                     'mask', 'index', 'flipud']:
+            assert profiler.stages[name].calls == 1
+        # the grid is shared by the stack and not created per read
+        assert 'grid' not in profiler.stages
+        assert profiler.stages['stack_read'].total >= \
+            profiler.stages['open'].total
+        assert stream.getvalue().splitlines()[0].split()[0] == 'stage'
+        assert len(stream.getvalue().splitlines()) == 8
+
+    def test_disabled(self):
+        """
+        Test that no profiler is active outside of the context manager.
+        """
+        with profiling.profile(None):
+            pass
+        assert profiling.stage('open') is profiling._null_timer
+
+
+if __name__ == "__main__":
+    unittest.main()
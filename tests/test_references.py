@@ -0,0 +1,105 @@
+import os
+import json
+import tempfile
+import unittest
+import numpy.testing as npt
+from datetime import datetime
+
+from netCDF4 import Dataset
+from merra.interface import MerraImage, MerraTs
+from merra.metrics import Metrics
+from merra.references import (build_index, reference_filename,
+                              ReferenceDataset, main)
+from merra.reshuffle import main as reshuffle_main
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'merra-test-data', 'M2T1NXLND.5.12.4')
+fname = os.path.join(inpath, '2018', '10',
+                     'MERRA2_400.tavg1_2d_lnd_Nx.20181001.nc4')
+
+
+@unittest.skipIf(h5py is None, "h5py is not installed")
+class Test(unittest.TestCase):
+    """
+    Tests of the chunk index and the references backend.
+    """
+
+    def test_build_index(self):
+        """
+        The archive is indexed once, the references read the same data as
+        netCDF4.
+        """
+        index_path = tempfile.mkdtemp()
+        assert build_index(inpath, index_path=index_path, n_proc=2) == 1
+        assert build_index(inpath, index_path=index_path) == 0
+        reference_file = reference_filename(fname, index_path)
+        assert reference_file == os.path.join(
+            index_path, '2018', '10', os.path.basename(fname) + '.json')
+        with open(reference_file) as f:
+            references = json.load(f)
+        assert references['version'] == 1
+        zarray = json.loads(references['refs']['SFMC/.zarray'])
+        assert zarray['chunks'] == [1, 91, 144]
+        assert len([key for key in references['refs']
+                    if key.startswith('SFMC/') and '.z' not in key]) == \
+            24 * 4 * 4
+
+        keys = {3: [3, [0, 6, 23], (3, slice(100, 200, 3), [5, 300, 575]),
+                    (slice(None), 180, slice(20, 30))],
+                1: [3, slice(10, 20), [0, 6, 23]]}
+        with Dataset(fname) as nc, \
+                ReferenceDataset(reference_file, fname) as ds:
+            assert ds.variables['SFMC'].units == \
+                nc.variables['SFMC'].units
+            for name in ['SFMC', 'TSURF', 'lat', 'time']:
+                variable = nc.variables[name]
+                variable.set_auto_mask(False)
+                for key in keys[variable.ndim]:
+                    npt.assert_array_equal(ds.variables[name][key],
+                                           variable[key])
+
+    def test_references_backend(self):
+        """
+        Images read through the references, also of a window, equal the
+        netCDF4 backend and only the needed chunks are read.
+        """
+        index_path = tempfile.mkdtemp()
+        main([inpath, '--index_path', index_path, '--parameters', 'SFMC',
+              'RZMC'])
+        parameters = ['SFMC', 'RZMC']
+        for bbox in [None, (15, 45, 20, 50)]:
+            metrics = Metrics()
+            img = MerraImage(fname, parameter=parameters, bbox=bbox,
+                             backend='references', index_path=index_path)
+            data, metadata = img.read_block([0, 6, 12, 18], metrics=metrics)
+            nc_data, nc_metadata = MerraImage(
+                fname, parameter=parameters, bbox=bbox).read_block(
+                    [0, 6, 12, 18])
+            assert metadata == nc_metadata
+            for parameter in parameters:
+                npt.assert_array_equal(data[parameter], nc_data[parameter])
+        # one chunk of each hour and parameter
+        assert metrics.counters['fetched_bytes'] < \
+            os.path.getsize(fname) / 50
+
+        img = MerraImage(fname, backend='references', index_path=index_path)
+        image = img.read(datetime(2018, 10, 1, 6, 30))
+        assert image.data['SFMC'].shape == (361, 576)
+
+        ts_path = tempfile.mkdtemp()
+        reshuffle_main([inpath, ts_path, '2018-10-01', '2018-10-01', 'SFMC',
+                        '--backend', 'references', '--index_path',
+                        index_path, '--bbox', '15', '45', '20', '50'])
+        ts = MerraTs(ts_path, parameters=['SFMC']).read(16.375, 48.125)
+        npt.assert_allclose(ts['SFMC'].values,
+                            [0.218083, 0.219587, 0.214836, 0.220690],
+                            rtol=1e-5)
+
+
+if __name__ == "__main__":
+    unittest.main()
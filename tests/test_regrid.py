@@ -0,0 +1,104 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+from datetime import datetime
+
+from pygeogrids.grids import genreg_grid
+from merra.grid import create_merra_cell_grid
+from merra.interface import MerraImageStack
+from merra.regrid import Regridder, RegriddedImageStack
+
+
+def smooth_field(lons, lats):
+    return np.cos(np.deg2rad(lats)) * np.sin(np.deg2rad(lons))
+
+
+class Test(unittest.TestCase):
+    """
+    Testing the regridding to other grids
+    """
+
+    def setUp(self):
+        self.source_grid = create_merra_cell_grid()
+        self.target_grid = genreg_grid(1., 1.)
+        self.image = smooth_field(self.source_grid.activearrlon,
+                                  self.source_grid.activearrlat)
+        self.should = smooth_field(self.target_grid.activearrlon,
+                                   self.target_grid.activearrlat)
+
+    def test_methods(self):
+        """
+        All methods reproduce a smooth field, images and blocks give the
+        same result.
+        """
+        for method, atol in [('nearest', 0.01), ('bilinear', 1e-3),
+                             ('conservative', 0.01)]:
+            regridder = Regridder(self.target_grid, method=method,
+                                  source_grid=self.source_grid)
+            regridded = regridder.regrid(self.image)
+            assert regridded.shape == (self.target_grid.activegpis.size,)
+            npt.assert_allclose(regridded, self.should, atol=atol)
+
+            block = regridder.regrid(np.vstack([self.image, 2 * self.image]))
+            assert block.shape == (2, self.target_grid.activegpis.size)
+            npt.assert_allclose(block[1], 2 * regridded, rtol=1e-5)
+
+    def test_missing_values(self):
+        """
+        Missing source data is excluded from the weighted mean.
+        """
+        regridder = Regridder(self.target_grid, method='bilinear',
+                              source_grid=self.source_grid,
+                              missing_value=1e15)
+        image = self.image.copy()
+        # gpi 159290 is at 16.25E, 48N
+        image[159290] = 1e15
+        image[159291] = np.nan
+        regridded = regridder.regrid(image)
+        assert np.isfinite(regridded).all()
+        assert np.abs(regridded).max() <= 1.
+
+        image[:] = 1e15
+        assert np.isnan(regridder.regrid(image)).all()
+
+    def test_weights_cache(self):
+        """
+        The weights are written once and read from the cache afterwards.
+        """
+        cache_dir = tempfile.mkdtemp()
+        regridder = Regridder(self.target_grid, method='conservative',
+                              source_grid=self.source_grid,
+                              cache_dir=cache_dir)
+        assert os.listdir(cache_dir) == [
+            os.path.basename(regridder.cache_file)]
+        cached = Regridder(self.target_grid, method='conservative',
+                           source_grid=self.source_grid,
+                           cache_dir=cache_dir)
+        assert (cached.weights != regridder.weights).nnz == 0
+
+        with self.assertRaises(ValueError):
+            Regridder(self.target_grid, method='cubic',
+                      source_grid=self.source_grid)
+
+    def test_regridded_stack(self):
+        """
+        Read the test image on a 0.25 degree grid.
+        """
+        stack = MerraImageStack(data_path=os.path.join(
+            os.path.dirname(__file__), 'merra-test-data', 'M2T1NXLND.5.12.4'),
+            parameter=['SFMC'])
+        target_grid = genreg_grid(0.25, 0.25)
+        regridded = RegriddedImageStack(
+            stack, Regridder(target_grid, source_grid=stack.grid))
+
+        image = regridded.read(datetime(2018, 10, 1, 0, 30))
+        assert image.lon.size == target_grid.activegpis.size
+        gpi = target_grid.find_nearest_gpi(16.375, 48.125)[0]
+        npt.assert_almost_equal(image.data['SFMC'][gpi], 0.218083,
+                                decimal=6)
+
+
+if __name__ == "__main__":
+    unittest.main()
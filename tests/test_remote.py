@@ -0,0 +1,104 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+from datetime import datetime
+
+from merra.interface import MerraImage, MerraImageStack, MerraTs
+from merra.metrics import Metrics
+from merra.reshuffle import main
+
+try:
+    import h5py
+    import fsspec
+except ImportError:
+    h5py = None
+
+inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'merra-test-data', 'M2T1NXLND.5.12.4')
+fname = os.path.join(inpath, '2018', '10',
+                     'MERRA2_400.tavg1_2d_lnd_Nx.20181001.nc4')
+
+
+@unittest.skipIf(h5py is None, "h5py and fsspec are not installed")
+class Test(unittest.TestCase):
+    """
+    Tests of the h5py backend reading through fsspec.
+    """
+
+    def test_h5py_backend(self):
+        """
+        The h5py backend reads the same images as netCDF4, also from an
+        URL.
+        """
+        parameters = ['SFMC', 'TSURF']
+        timestamp = datetime(2018, 10, 1, 6, 30)
+        img = MerraImage(fname, parameter=parameters, array_1d=True).read(
+            timestamp)
+        for filename in [fname, 'file://' + fname]:
+            h5_img = MerraImage(filename, parameter=parameters,
+                                array_1d=True, backend='h5py').read(timestamp)
+            for parameter in parameters:
+                npt.assert_array_equal(h5_img.data[parameter],
+                                       img.data[parameter])
+            assert h5_img.metadata == img.metadata
+
+        stack = MerraImageStack('file://' + inpath, backend='h5py',
+                                available_only=True)
+        timestamps = stack.timestamp_array(datetime(2018, 9, 1),
+                                           datetime(2018, 10, 31))
+        assert timestamps.size == 4
+        data, _ = stack.read_block(datetime(2018, 10, 1), [0, 6, 12, 18])
+        npt.assert_allclose(data['SFMC'][:, 159290],
+                            [0.218083, 0.219587, 0.214836, 0.220690],
+                            rtol=1e-5)
+
+    def test_window_and_cache(self):
+        """
+        A bbox read only fetches a fraction of the file, cached blocks are
+        not fetched again.
+        """
+        bbox = (15, 45, 20, 50)
+        hours = [0, 6, 12, 18]
+        data, _ = MerraImage(fname, bbox=bbox).read_block(hours)
+
+        cache_dir = tempfile.mkdtemp()
+        fetched = []
+        for _ in range(2):
+            metrics = Metrics()
+            img = MerraImage('file://' + fname, bbox=bbox, backend='h5py',
+                             cache_dir=cache_dir)
+            h5_data, _ = img.read_block(hours, metrics=metrics)
+            npt.assert_array_equal(h5_data['SFMC'], data['SFMC'])
+            fetched.append(metrics.counters['fetched_bytes'])
+        assert 0 < fetched[0] < os.path.getsize(fname) / 20
+        assert fetched[1] == 0
+        assert len(os.listdir(cache_dir)) == 1
+
+        # grid points outside of the window have the fill value
+        assert np.isnan(data['SFMC'][:, 0]).all()
+        npt.assert_allclose(data['SFMC'][:, 159290],
+                            [0.218083, 0.219587, 0.214836, 0.220690],
+                            rtol=1e-5)
+
+    def test_reshuffle_h5py(self):
+        """
+        Conversion of a region read with the h5py backend.
+        """
+        ts_path = tempfile.mkdtemp()
+        args = ['file://' + inpath, ts_path, '2018-10-01', '2018-10-01',
+                'SFMC', '--backend', 'h5py', '--bbox', '15', '45', '20', '50',
+                '--cache_dir', tempfile.mkdtemp()]
+        main(args)
+
+        reader = MerraTs(ts_path, parameters=['SFMC'])
+        ts = reader.read(16.375, 48.125)
+        npt.assert_allclose(ts['SFMC'].values,
+                            [0.218083, 0.219587, 0.214836, 0.220690],
+                            rtol=1e-5)
+        assert np.isfinite(ts['SFMC'].values).all()
+
+
+if __name__ == "__main__":
+    unittest.main()
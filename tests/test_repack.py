@@ -0,0 +1,93 @@
+import os
+import json
+import tempfile
+import unittest
+import numpy.testing as npt
+from datetime import datetime
+
+from netCDF4 import Dataset
+from merra.interface import MerraImageStack
+from merra.repack import repack_archive, fastest_compression, main
+
+inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'merra-test-data', 'M2T1NXLND.5.12.4')
+fname = os.path.join(inpath, '2018', '10',
+                     'MERRA2_400.tavg1_2d_lnd_Nx.20181001.nc4')
+
+
+class Test(unittest.TestCase):
+    """
+    Tests of the repacking of the archive.
+    """
+
+    def test_repack_archive(self):
+        """
+        The slim archive keeps the chosen variables with the new layout and
+        is read like the original one, repacked files are skipped.
+        """
+        out_path = tempfile.mkdtemp()
+        summary = repack_archive(inpath, out_path,
+                                 parameters=['SFMC', 'TSURF'], n_proc=2,
+                                 n_reads=1)
+        assert summary['repacked'] == 1 and summary['skipped'] == 0
+        assert 0 < summary['repacked_size'] < summary['size'] / 2
+        assert summary['read_time'] > 0 and summary['repacked_read_time'] > 0
+
+        repacked = os.path.join(out_path, os.path.relpath(fname, inpath))
+        with Dataset(repacked) as ds:
+            assert sorted(ds.variables.keys()) == ['SFMC', 'TSURF', 'lat',
+                                                   'lon', 'time']
+            assert ds.variables['SFMC'].chunking() == [1, 361, 576]
+            filters = ds.variables['SFMC'].filters()
+            compression = fastest_compression()
+            if compression.startswith('blosc'):
+                assert filters['blosc']['compressor'] == compression
+            else:
+                assert filters[compression] and filters['complevel'] == 1
+
+        hours = [0, 6, 12, 18]
+        day = datetime(2018, 10, 1)
+        data, metadata = MerraImageStack(
+            out_path, parameter=['SFMC', 'TSURF']).read_block(day, hours)
+        data_should, metadata_should = MerraImageStack(
+            inpath, parameter=['SFMC', 'TSURF']).read_block(day, hours)
+        assert metadata == metadata_should
+        for parameter in ['SFMC', 'TSURF']:
+            npt.assert_array_equal(data[parameter], data_should[parameter])
+
+        summary = repack_archive(inpath, out_path,
+                                 parameters=['SFMC', 'TSURF'])
+        assert summary['repacked'] == 0 and summary['skipped'] == 1
+        assert 'read_time' not in summary
+
+        # files repacked with other settings are repacked again
+        summary = repack_archive(inpath, out_path,
+                                 parameters=['SFMC', 'TSURF'], complevel=4,
+                                 n_reads=0)
+        assert summary['repacked'] == 1 and summary['skipped'] == 0
+        with Dataset(repacked) as ds:
+            assert ds.variables['SFMC'].filters()['complevel'] == 4
+            assert json.loads(ds.merra_repack)['complevel'] == 4
+
+    def test_repack_cli(self):
+        """
+        Repacking with another codec and chunk shape from the command line.
+        """
+        out_path = tempfile.mkdtemp()
+        metrics_file = os.path.join(tempfile.mkdtemp(), 'metrics.jsonl')
+        main([inpath, out_path, '--parameters', 'SFMC', '--compression',
+              'zlib', '--complevel', '4', '--chunksizes', '24', '91', '144',
+              '--metrics_file', metrics_file])
+        with open(metrics_file) as f:
+            metrics = json.loads(f.readlines()[-1])
+        assert metrics['counters']['files'] == 1
+
+        repacked = os.path.join(out_path, os.path.relpath(fname, inpath))
+        with Dataset(repacked) as ds:
+            assert ds.variables['SFMC'].chunking() == [24, 91, 144]
+            assert ds.variables['SFMC'].filters()['complevel'] == 4
+            assert ds.variables['SFMC'].units == 'm-3 m-3'
+
+
+if __name__ == "__main__":
+    unittest.main()
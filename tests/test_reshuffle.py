@@ -1,12 +1,32 @@
 import os
 import glob
+import json
 import tempfile
 import numpy as np
 import numpy.testing as npt
+from datetime import datetime
 import unittest
 
-from merra.reshuffle import main
-from merra.interface import MerraTs
+from netCDF4 import Dataset, num2date
+from merra.reshuffle import (main, reshuffle, benchmark_layouts,
+                             open_files_budget)
+from merra.interface import MerraTs, MerraBinaryTs
+from merra.binary import read_cell_header
+from pygeogrids import BasicGrid
+
+
+def cell_mean(cell, gpis, lons, lats, time, data):
+    """
+    Per cell function used in the map_cells test.
+    """
+    return gpis, data['SFMC'].mean(axis=0)
+
+
+def cell_error(cell, gpis, lons, lats, time, data):
+    """
+    Per cell function failing in the map_cells test.
+    """
+    raise ValueError("cell {}".format(cell))
 
 
 class Test(unittest.TestCase):
@@ -43,6 +63,445 @@ class Test(unittest.TestCase):
                                     dtype=np.float32)
         npt.assert_allclose(ts['SFMC'].values, ts_values_should, rtol=1e-5)
 
+    def test_reshuffle_binary(self):
+        """
+        Create the flat binary store and read it with the memmap reader.
+        """
+        inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'merra-test-data', 'M2T1NXLND.5.12.4')
+        ts_path = tempfile.mkdtemp()
+        metrics_file = os.path.join(tempfile.mkdtemp(), 'metrics.jsonl')
+        args = [inpath, ts_path, '2018-10-01', '2018-10-01', 'SFMC',
+                '--out_format', 'binary', '--metrics_file', metrics_file]
+        main(args)
+
+        with open(metrics_file) as f:
+            metrics = json.loads(f.readlines()[-1])
+        assert metrics['done'] == 4
+        assert metrics['counters']['images'] == 4
+        assert sorted(metrics['stages'].keys()) == \
+            ['decode', 'open', 'read', 'transpose', 'write']
+
+        reader = MerraBinaryTs(ts_path)
+        ts = reader.read(16.375, 48.125)
+
+        ts_values_should = np.array([0.218083, 0.219587,
+                                     0.214836, 0.220690],
+                                    dtype=np.float32)
+        npt.assert_allclose(ts['SFMC'].values, ts_values_should, rtol=1e-5)
+        assert ts.index[0] == np.datetime64('2018-10-01T00:30')
+        npt.assert_allclose(reader.read(159290)['SFMC'].values,
+                            ts_values_should, rtol=1e-5)
+
+    def test_reshuffle_img2ts_engine(self):
+        """
+        The image by image conversion of repurpose gives the same result
+        as the default transpose engine.
+        """
+        inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'merra-test-data', 'M2T1NXLND.5.12.4')
+        ts_path = tempfile.mkdtemp()
+        args = [inpath, ts_path, '2018-10-01', '2018-10-01', 'SFMC',
+                '--engine', 'img2ts']
+        main(args)
+
+        reader = MerraTs(ts_path,
+                         ioclass_kws={'read_bulk': True},
+                         parameters=['SFMC'])
+        ts = reader.read(16.375, 48.125)
+
+        ts_values_should = np.array([0.218083, 0.219587,
+                                     0.214836, 0.220690],
+                                    dtype=np.float32)
+        npt.assert_allclose(ts['SFMC'].values, ts_values_should, rtol=1e-5)
+
+        # every cell file of the transpose engine holds the same data
+        transpose_path = tempfile.mkdtemp()
+        main([inpath, transpose_path, '2018-10-01', '2018-10-01', 'SFMC',
+              '--max_open_files', '100'])
+        cell_files = sorted(os.path.basename(f) for f in
+                            glob.glob(os.path.join(ts_path, '*.nc'))
+                            if not f.endswith('grid.nc'))
+        assert cell_files == sorted(
+            os.path.basename(f) for f in
+            glob.glob(os.path.join(transpose_path, '*.nc'))
+            if not f.endswith('grid.nc'))
+        for cell_file in cell_files:
+            cells = []
+            for path in [ts_path, transpose_path]:
+                with Dataset(os.path.join(path, cell_file)) as ds:
+                    order = np.argsort(ds.variables['location_id'][:])
+                    cells.append({
+                        name: ds.variables[name][:][order]
+                        for name in ['location_id', 'lon', 'lat', 'SFMC']})
+                    cells[-1]['time'] = num2date(
+                        ds.variables['time'][:], ds.variables['time'].units)
+            for name in ['location_id', 'lon', 'lat', 'time']:
+                npt.assert_array_equal(cells[0][name], cells[1][name])
+            npt.assert_array_equal(cells[0]['SFMC'].filled(np.nan),
+                                   cells[1]['SFMC'].filled(np.nan))
+
+    def test_read_window(self):
+        """
+        Only the time window between start and end is read, every n-th time
+        step with a stride, by both time series readers.
+        """
+        inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'merra-test-data', 'M2T1NXLND.5.12.4')
+        start, end = datetime(2018, 10, 1, 6), datetime(2018, 10, 1, 12, 30)
+        for out_format, reader_class, ioclass_kws in [
+                ('netcdf', MerraTs, {'read_bulk': False}),
+                ('netcdf', MerraTs, {'read_bulk': True}),
+                ('binary', MerraBinaryTs, None)]:
+            ts_path = tempfile.mkdtemp()
+            args = [inpath, ts_path, '2018-10-01', '2018-10-01', 'SFMC',
+                    '--temporal_sampling', '1', '--out_format', out_format,
+                    '--bbox', '15', '45', '20', '50']
+            main(args)
+
+            if ioclass_kws is None:
+                reader = reader_class(ts_path, parameters=['SFMC'])
+            else:
+                reader = reader_class(ts_path, parameters=['SFMC'],
+                                      ioclass_kws=ioclass_kws)
+            full = reader.read(159290)
+            assert len(full) == 24
+
+            ts = reader.read(16.375, 48.125, start=start, end=end, stride=6)
+            assert list(ts.index) == [datetime(2018, 10, 1, 6, 30),
+                                      datetime(2018, 10, 1, 12, 30)]
+            npt.assert_allclose(ts['SFMC'].values, [0.219587, 0.214836],
+                                rtol=1e-5)
+            ts = reader.read(159290, start='2018-10-01T22:00')
+            npt.assert_array_equal(ts['SFMC'].values,
+                                   full['SFMC'].values[22:])
+            ts = reader.read(159290, end=datetime(2018, 10, 1, 0, 30),
+                             stride=2)
+            assert list(ts.index) == [datetime(2018, 10, 1, 0, 30)]
+            assert len(reader.read(159290, start=datetime(2019, 1, 1))) == 0
+
+    def test_read_cube(self):
+        """
+        All grid points of a region are read as (time, lat, lon) cube.
+        """
+        inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'merra-test-data', 'M2T1NXLND.5.12.4')
+        ts_path = tempfile.mkdtemp()
+        args = [inpath, ts_path, '2018-10-01', '2018-10-01', 'SFMC', 'TSURF',
+                '--bbox', '15', '45', '20', '50']
+        main(args)
+        hourly = Dataset(os.path.join(
+            inpath, '2018', '10', 'MERRA2_400.tavg1_2d_lnd_Nx.20181001.nc4'))
+        with hourly:
+            sfmc = hourly.variables['SFMC'][6::6, 270:281, 314:321].filled(
+                np.nan)
+
+        for read_bulk in [False, True]:
+            reader = MerraTs(ts_path, ioclass_kws={'read_bulk': read_bulk})
+            data, index, lat, lon = reader.read_cube(
+                (16, 45, 21, 50), start=datetime(2018, 10, 1, 6),
+                parameters=['SFMC'])
+            assert list(index) == [datetime(2018, 10, 1, h, 30)
+                                   for h in [6, 12, 18]]
+            npt.assert_allclose(lat, np.arange(45, 50.5, 0.5))
+            npt.assert_allclose(lon, np.arange(16.25, 20.1, 0.625))
+            assert data['SFMC'].shape == (3, 11, 7)
+            npt.assert_array_equal(data['SFMC'], sfmc)
+
+        cube = reader.read_cube((10, 40, 30, 60), stride=2, as_xarray=True)
+        assert sorted(cube.data_vars) == ['SFMC', 'TSURF']
+        assert cube['SFMC'].shape == (2, 11, 9)
+        assert cube['SFMC'].attrs['units'] == 'm-3 m-3'
+        npt.assert_allclose(
+            cube['SFMC'].sel(lon=16.25, lat=48).values,
+            [0.218083, 0.214836], rtol=1e-5)
+
+    def test_iter_cells(self):
+        """
+        All grid points are read cell by cell and a function is applied to
+        every cell serially and in a pool.
+        """
+        inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'merra-test-data', 'M2T1NXLND.5.12.4')
+        ts_path = tempfile.mkdtemp()
+        args = [inpath, ts_path, '2018-10-01', '2018-10-01', 'SFMC', 'TSURF',
+                '--bbox', '15', '45', '20', '50']
+        main(args)
+        ts_values_should = np.array([0.218083, 0.219587,
+                                     0.214836, 0.220690],
+                                    dtype=np.float32)
+
+        reader = MerraTs(ts_path, parameters=['SFMC'])
+        cells = list(reader.iter_cells())
+        assert [cell[0] for cell in cells] == list(reader.grid.get_cells())
+        assert sum(cell[1].size for cell in cells) == \
+            reader.grid.activegpis.size
+        for cell, gpis, lons, lats, time, data in cells:
+            assert list(data.keys()) == ['SFMC']
+            assert data['SFMC'].shape == (time.size, gpis.size)
+            assert time.size == 4
+            npt.assert_allclose(lons, reader.grid.gpi2lonlat(gpis)[0])
+            if 159290 in gpis:
+                column = np.nonzero(gpis == 159290)[0][0]
+                npt.assert_allclose(data['SFMC'][:, column],
+                                    ts_values_should, rtol=1e-5)
+                assert lats[column] == 48
+
+        cell, gpis, lons, lats, time, data = next(reader.iter_cells(
+            parameters=['TSURF'],
+            period=[datetime(2018, 10, 1, 12), datetime(2018, 10, 2)]))
+        assert list(data.keys()) == ['TSURF']
+        assert list(time) == [datetime(2018, 10, 1, 12, 30),
+                              datetime(2018, 10, 1, 18, 30)]
+
+        for n_proc in [1, 2]:
+            cells, results = reader.map_cells(cell_mean, n_proc=n_proc)
+            assert cells == list(reader.grid.get_cells())
+            gpis = np.concatenate([gpis for gpis, _ in results])
+            means = np.concatenate([means for _, means in results])
+            npt.assert_allclose(means[gpis == 159290],
+                                [ts_values_should.mean()], rtol=1e-5)
+        # the open cell file is not inherited by the workers
+        assert reader.fid is None
+        with self.assertRaises(ValueError):
+            reader.map_cells(cell_error, n_proc=2)
+
+    def test_reshuffle_layout(self):
+        """
+        Compression, chunk shape and region are applied to the output.
+        """
+        inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'merra-test-data', 'M2T1NXLND.5.12.4')
+        ts_path = tempfile.mkdtemp()
+        args = [inpath, ts_path, '2018-10-01', '2018-10-01', 'SFMC',
+                '--complevel', '1', '--no_shuffle', '--time_chunksize', '8',
+                '--location_chunksize', '10', '--cellsize_lat', '10',
+                '--cellsize_lon', '10', '--bbox', '15', '45', '20', '50']
+        main(args)
+
+        reader = MerraTs(ts_path, parameters=['SFMC'])
+        assert reader.grid.activegpis.size == 11 * 9
+        ts = reader.read(16.375, 48.125)
+        npt.assert_allclose(ts['SFMC'].values[0], 0.218083, rtol=1e-5)
+
+        cell = reader.grid.gpi2cell(159290)
+        with Dataset(os.path.join(ts_path, '%04d.nc' % cell)) as ds:
+            var = ds.variables['SFMC']
+            assert var.chunking() == [10, 8]
+            filters = var.filters()
+            assert filters['zlib'] and filters['complevel'] == 1
+            assert not filters['shuffle']
+
+    def test_reshuffle_sub_day(self):
+        """
+        Only the hours between the exact start and end time are converted.
+        """
+        inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'merra-test-data', 'M2T1NXLND.5.12.4')
+        ts_path = tempfile.mkdtemp()
+        args = [inpath, ts_path, '2018-10-01T06:00', '2018-10-01T12:30',
+                'SFMC', '--hours', '0', '6', '12', '18', '--available_only',
+                '--bbox', '15', '45', '20', '50']
+        main(args)
+
+        reader = MerraTs(ts_path, parameters=['SFMC'])
+        ts = reader.read(16.375, 48.125)
+        assert list(ts.index) == [datetime(2018, 10, 1, 6, 30),
+                                  datetime(2018, 10, 1, 12, 30)]
+        npt.assert_allclose(ts['SFMC'].values, [0.219587, 0.214836],
+                            rtol=1e-5)
+
+    def test_reshuffle_samplings(self):
+        """
+        Several samplings are written from one read pass.
+        """
+        inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'merra-test-data', 'M2T1NXLND.5.12.4')
+        ts_path = tempfile.mkdtemp()
+        metrics_file = os.path.join(tempfile.mkdtemp(), 'metrics.jsonl')
+        args = [inpath, ts_path, '2018-10-01', '2018-10-01', 'SFMC',
+                '--samplings', '6', '24:mean', '--bbox', '15', '45', '20',
+                '50', '--metrics_file', metrics_file]
+        main(args)
+
+        with open(metrics_file) as f:
+            metrics = json.loads(f.readlines()[-1])
+        assert metrics['counters']['images'] == 24
+        assert sorted(os.listdir(ts_path)) == ['24h_mean', '6h']
+
+        reader = MerraTs(os.path.join(ts_path, '6h'), parameters=['SFMC'])
+        ts = reader.read(16.375, 48.125)
+        npt.assert_allclose(ts['SFMC'].values, [0.218083, 0.219587,
+                                                0.214836, 0.220690],
+                            rtol=1e-5)
+
+        hourly = Dataset(os.path.join(
+            inpath, '2018', '10', 'MERRA2_400.tavg1_2d_lnd_Nx.20181001.nc4'))
+        with hourly:
+            sfmc = hourly.variables['SFMC'][:, 276, 314]
+            # grid point without data at all hours
+            assert hourly.variables['SFMC'][:, 270, 313].mask.all()
+        reader = MerraTs(os.path.join(ts_path, '24h_mean'),
+                         parameters=['SFMC'])
+        ts = reader.read(16.375, 48.125)
+        assert list(ts.index) == [datetime(2018, 10, 1, 12)]
+        npt.assert_allclose(ts['SFMC'].values, [sfmc.mean()], rtol=1e-5)
+        # windows without valid images are NaN like the images
+        ts = reader.read(15.625, 45.0)
+        assert np.isnan(ts['SFMC'].values).all()
+
+    def test_reshuffle_samplings_open_files(self):
+        """
+        The open cell files are shared by the writers of all samplings.
+        """
+        assert open_files_budget(1000, 3, reserved=0) <= 333
+        assert open_files_budget(2, 3) == 1
+        try:
+            import resource
+            soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft != resource.RLIM_INFINITY:
+                assert open_files_budget(soft * 2, 1) == soft - 64
+        except ImportError:
+            pass
+
+        inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'merra-test-data', 'M2T1NXLND.5.12.4')
+        ts_path = tempfile.mkdtemp()
+        main([inpath, ts_path, '2018-10-01', '2018-10-01', 'SFMC',
+              '--samplings', '1', '6', '24:max', '--bbox', '10', '40',
+              '20', '50', '--imgbuffer', '6', '--max_open_files', '2'])
+
+        assert sorted(os.listdir(ts_path)) == ['1h', '24h_max', '6h']
+        reader = MerraTs(os.path.join(ts_path, '6h'), parameters=['SFMC'])
+        ts = reader.read(16.375, 48.125)
+        npt.assert_allclose(ts['SFMC'].values, [0.218083, 0.219587,
+                                                0.214836, 0.220690],
+                            rtol=1e-5)
+        reader = MerraTs(os.path.join(ts_path, '1h'), parameters=['SFMC'])
+        hourly = reader.read(16.375, 48.125)
+        assert len(hourly) == 24
+        reader = MerraTs(os.path.join(ts_path, '24h_max'),
+                         parameters=['SFMC'])
+        ts = reader.read(16.375, 48.125)
+        npt.assert_allclose(ts['SFMC'].values,
+                            [hourly['SFMC'].max()], rtol=1e-6)
+
+    def test_reshuffle_packing(self):
+        """
+        Packed time series are unpacked by the readers.
+        """
+        inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'merra-test-data', 'M2T1NXLND.5.12.4')
+        ts_values_should = np.array([0.218083, 0.219587,
+                                     0.214836, 0.220690],
+                                    dtype=np.float32)
+
+        ts_path = tempfile.mkdtemp()
+        args = [inpath, ts_path, '2018-10-01', '2018-10-01', 'SFMC',
+                '--packing', 'SFMC:int16', '--bbox', '15', '45', '20', '50']
+        main(args)
+
+        reader = MerraTs(ts_path, parameters=['SFMC'])
+        ts = reader.read(16.375, 48.125)
+        assert ts['SFMC'].dtype == np.float32
+        npt.assert_allclose(ts['SFMC'].values, ts_values_should, atol=2e-5)
+        cell = reader.grid.gpi2cell(159290)
+        with Dataset(os.path.join(ts_path, '%04d.nc' % cell)) as ds:
+            assert ds.variables['SFMC'].dtype == np.int16
+
+        ts_path = tempfile.mkdtemp()
+        args = [inpath, ts_path, '2018-10-01', '2018-10-01', 'SFMC',
+                '--packing', 'SFMC:float16', '--out_format', 'binary',
+                '--bbox', '15', '45', '20', '50']
+        main(args)
+
+        reader = MerraBinaryTs(ts_path)
+        ts = reader.read(16.375, 48.125)
+        npt.assert_allclose(ts['SFMC'].values, ts_values_should, rtol=1e-3)
+        cell = reader.grid.gpi2cell(159290)
+        n_gpi = read_cell_header(ts_path, cell)['gpis'].size
+        fname = os.path.join(ts_path, '%04d_SFMC.bin' % cell)
+        assert os.path.getsize(fname) == n_gpi * 4 * 2
+
+    def test_reshuffle_regrid(self):
+        """
+        Time series on a regular 0.25 degree grid.
+        """
+        inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'merra-test-data', 'M2T1NXLND.5.12.4')
+        ts_path = tempfile.mkdtemp()
+        args = [inpath, ts_path, '2018-10-01', '2018-10-01', 'SFMC',
+                '--target_resolution', '0.25', '--regrid_method',
+                'conservative', '--bbox', '15', '45', '20', '50']
+        main(args)
+
+        assert len(glob.glob(os.path.join(ts_path, 'regrid_weights_*'))) == 1
+        reader = MerraTs(ts_path, parameters=['SFMC'])
+        assert reader.grid.activegpis.size == 20 * 20
+        # the target cell lies within one MERRA2 cell
+        ts = reader.read(16.375, 48.125)
+        ts_values_should = np.array([0.218083, 0.219587,
+                                     0.214836, 0.220690],
+                                    dtype=np.float32)
+        npt.assert_allclose(ts['SFMC'].values, ts_values_should, rtol=1e-5)
+
+    def test_reshuffle_target_grid_gpis(self):
+        """
+        The time series keep the gpis of a target grid that are not
+        numbered from zero.
+        """
+        inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'merra-test-data', 'M2T1NXLND.5.12.4')
+        lons, lats = np.meshgrid(np.arange(15.125, 20, 0.25),
+                                 np.arange(45.125, 50, 0.25))
+        gpis = 1000 + 3 * np.arange(lons.size)[::-1]
+        target_grid = BasicGrid(lons.flatten(), lats.flatten(), gpis=gpis)
+
+        ts_path = tempfile.mkdtemp()
+        reshuffle(inpath, ts_path, datetime(2018, 10, 1),
+                  datetime(2018, 10, 1), ['SFMC'], target_grid=target_grid)
+
+        reader = MerraTs(ts_path, parameters=['SFMC'])
+        npt.assert_array_equal(np.sort(reader.grid.activegpis),
+                               np.sort(gpis))
+        gpi = target_grid.find_nearest_gpi(16.375, 48.125)[0]
+        npt.assert_allclose(reader.grid.gpi2lonlat(gpi),
+                            target_grid.gpi2lonlat(gpi))
+        ts = reader.read(gpi)
+        npt.assert_allclose(ts['SFMC'].values, [0.218083, 0.219587,
+                                                0.214836, 0.220690],
+                            rtol=1e-5)
+
+        # the grid points are placed at their row and column of the grid
+        data, index, lat, lon = reader.read_cube((16, 47, 17, 49))
+        npt.assert_allclose(lat, np.arange(47.125, 49, 0.25))
+        npt.assert_allclose(lon, np.arange(16.125, 17, 0.25))
+        npt.assert_allclose(data['SFMC'][:, 4, 1], ts['SFMC'].values)
+        for row in range(lat.size):
+            for col in range(lon.size):
+                cell_ts = reader.read(lon[col], lat[row])
+                npt.assert_array_equal(data['SFMC'][:, row, col],
+                                       cell_ts['SFMC'].values)
+
+    def test_benchmark_layouts(self):
+        """
+        Each layout of the benchmark is written and measured.
+        """
+        inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'merra-test-data', 'M2T1NXLND.5.12.4')
+        layouts = [{'compression': 'zlib', 'complevel': 4},
+                   {'compression': None, 'time_chunksize': 4}]
+        results = benchmark_layouts(inpath, tempfile.mkdtemp(),
+                                    datetime(2018, 10, 1),
+                                    datetime(2018, 10, 1), ['SFMC'],
+                                    (15, 45, 20, 50), layouts=layouts,
+                                    n_reads=5)
+        assert [r['name'] for r in results] == ['zlib_c4_t1000',
+                                                'none_t4']
+        for result in results:
+            assert result['size'] > 0
+            assert result['read_latency'] > 0
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+import numpy as np
+import numpy.testing as npt
+from datetime import datetime
+
+from merra.reshuffle import main, reshuffle
+from merra.interface import MerraTs, MerraBinaryTs
+from merra.shards import (plan_shards, claim_shard, run_worker,
+                          merge_shards, shard_status, shards_path,
+                          owns_shard, release_shard, renew_lock)
+from merra.stats import StreamingStats
+
+
+def create_two_days():
+    """
+    Input folder with the test day stored as 2018-10-01 and 2018-10-02.
+    """
+    inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'merra-test-data', 'M2T1NXLND.5.12.4')
+    fname = os.path.join(inpath, '2018', '10',
+                         'MERRA2_400.tavg1_2d_lnd_Nx.20181001.nc4')
+    root = os.path.join(tempfile.mkdtemp(), 'M2T1NXLND.5.12.4')
+    os.makedirs(os.path.join(root, '2018', '10'))
+    for day in ['20181001', '20181002']:
+        shutil.copy(fname, os.path.join(
+            root, '2018', '10', 'MERRA2_400.tavg1_2d_lnd_Nx.{}.nc4'.format(
+                day)))
+    return root
+
+
+class Test(unittest.TestCase):
+    """
+    Tests of the distributed conversion.
+    """
+
+    def test_shards(self):
+        """
+        Two worker processes convert shards of cells and days, the merged
+        store equals a single conversion.
+        """
+        inpath = create_two_days()
+        ts_path = tempfile.mkdtemp()
+        days = [(datetime(2018, 10, 1), datetime(2018, 10, 1)),
+                (datetime(2018, 10, 2), datetime(2018, 10, 2))]
+        manifest = plan_shards(inpath, ts_path, datetime(2018, 10, 1),
+                               datetime(2018, 10, 2), ['SFMC'],
+                               cells_per_shard=2, time_ranges=days,
+                               bbox=(15, 45, 20, 50),
+                               packing={'SFMC': 'int16'}, statistics=True)
+        assert len(manifest['shards']) == 4
+        assert shard_status(ts_path)['todo'] == ['0000', '0001', '0002',
+                                                 '0003']
+
+        workers = [multiprocessing.Process(target=run_worker,
+                                           args=(ts_path,))
+                   for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            assert worker.exitcode == 0
+        assert len(shard_status(ts_path)['done']) == 4
+
+        summary = merge_shards(ts_path)
+        assert summary == {'shards': 4, 'cells': 4, 'timestamps': 8}
+        assert not os.path.exists(shards_path(ts_path))
+
+        ref_path = tempfile.mkdtemp()
+        reshuffle(inpath, ref_path, datetime(2018, 10, 1),
+                  datetime(2018, 10, 2), ['SFMC'], bbox=(15, 45, 20, 50),
+                  packing={'SFMC': 'int16'}, statistics=True)
+        reader = MerraTs(ts_path, parameters=['SFMC'])
+        ref_reader = MerraTs(ref_path, parameters=['SFMC'])
+        npt.assert_array_equal(reader.grid.activegpis,
+                               ref_reader.grid.activegpis)
+        for gpi in ref_reader.grid.activegpis[::10]:
+            ts = reader.read(gpi)
+            ref_ts = ref_reader.read(gpi)
+            assert (ts.index == ref_ts.index).all()
+            npt.assert_array_equal(ts['SFMC'].values, ref_ts['SFMC'].values)
+
+        ts_values_should = np.array([0.218083, 0.219587,
+                                     0.214836, 0.220690],
+                                    dtype=np.float32)
+        npt.assert_allclose(reader.read(16.375, 48.125)['SFMC'].values,
+                            np.tile(ts_values_should, 2), atol=2e-5)
+
+        # the statistics of the shards are merged
+        stats = StreamingStats.read(os.path.join(ts_path, 'stats.nc'))
+        ref_stats = StreamingStats.read(os.path.join(ref_path, 'stats.nc'))
+        npt.assert_array_equal(stats.gpis, ref_stats.gpis)
+        for name, values in ref_stats.results('SFMC').items():
+            npt.assert_allclose(stats.results('SFMC')[name], values,
+                                rtol=1e-6)
+
+    def test_shards_cli(self):
+        """
+        Plan, work and merge with merra_repurpose into a binary store.
+        """
+        inpath = create_two_days()
+        ts_path = tempfile.mkdtemp()
+        args = [inpath, ts_path, '2018-10-01', '2018-10-02', 'SFMC',
+                '--out_format', 'binary', '--bbox', '15', '45', '20', '50',
+                '--cells_per_shard', '3']
+        main(args + ['--shard_mode', 'plan'])
+        main(args + ['--shard_mode', 'work'])
+        main(args + ['--shard_mode', 'merge'])
+
+        reader = MerraBinaryTs(ts_path)
+        ts = reader.read(16.375, 48.125)
+        ts_values_should = np.array([0.218083, 0.219587,
+                                     0.214836, 0.220690],
+                                    dtype=np.float32)
+        npt.assert_allclose(ts['SFMC'].values, np.tile(ts_values_should, 2),
+                            rtol=1e-5)
+
+    def test_claim_shard(self):
+        """
+        Claimed shards are skipped until their lock is stale.
+        """
+        ts_path = tempfile.mkdtemp()
+        os.makedirs(shards_path(ts_path))
+        manifest = {'shards': [{'id': '0000'}, {'id': '0001'}]}
+        with open(os.path.join(shards_path(ts_path), 'manifest.json'),
+                  'w') as f:
+            json.dump(manifest, f)
+
+        shard_a = claim_shard(ts_path, worker='a')
+        assert shard_a['id'] == '0000'
+        shard_b = claim_shard(ts_path, worker='b')
+        assert shard_b['id'] == '0001'
+        assert claim_shard(ts_path, worker='c') is None
+        assert shard_status(ts_path)['claimed'] == ['0000', '0001']
+
+        # the lock of a running worker is renewed and does not become stale
+        lock_file = os.path.join(shards_path(ts_path), '0000.lock')
+        stale = time.time() - 100
+        os.utime(lock_file, (stale, stale))
+        with renew_lock(ts_path, shard_a, interval=0.05):
+            time.sleep(0.3)
+        assert os.path.getmtime(lock_file) > time.time() - 60
+        assert claim_shard(ts_path, worker='c', stale_after=60) is None
+
+        os.utime(lock_file, (stale, stale))
+        shard_c = claim_shard(ts_path, worker='c', stale_after=60)
+        assert shard_c['id'] == '0000'
+        with open(lock_file) as f:
+            assert json.load(f)['worker'] == 'c'
+        # the lock that was taken over is kept by the previous worker
+        assert owns_shard(ts_path, shard_c)
+        assert not owns_shard(ts_path, shard_a)
+        os.utime(lock_file, (stale, stale))
+        with renew_lock(ts_path, shard_a, interval=0.05):
+            time.sleep(0.3)
+        assert os.path.getmtime(lock_file) < time.time() - 60
+        release_shard(ts_path, shard_a)
+        assert os.path.exists(lock_file)
+        release_shard(ts_path, shard_c)
+        assert not os.path.exists(lock_file)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+
+from netCDF4 import Dataset
+from merra.interface import MerraTs, MerraBinaryTs
+from merra.reshuffle import main
+from merra.stats import (StreamingStats, day_of_year, merge_stats_files,
+                         open_stats)
+
+inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'merra-test-data', 'M2T1NXLND.5.12.4')
+fname = os.path.join(inpath, '2018', '10',
+                     'MERRA2_400.tavg1_2d_lnd_Nx.20181001.nc4')
+
+
+class Test(unittest.TestCase):
+    """
+    Tests of the streaming statistics.
+    """
+
+    def test_day_of_year(self):
+        """
+        Dates have the same day in leap and other years.
+        """
+        timestamps = np.array(['2018-01-01', '2018-02-28', '2018-03-01',
+                               '2020-02-29', '2020-03-01', '2019-12-31T18'],
+                              dtype='datetime64[h]')
+        npt.assert_array_equal(day_of_year(timestamps),
+                               [0, 58, 60, 59, 60, 365])
+
+    def test_streaming(self):
+        """
+        Buffers and merged parts give the statistics of the whole series.
+        """
+        rng = np.random.default_rng(42)
+        gpis = np.array([7, 3, 5])
+        timestamps = np.arange('2018-01-01', '2018-01-11',
+                               dtype='datetime64[D]')
+        data = (1000. + rng.normal(size=(3, 10))).astype(np.float32)
+        data[1, 2] = 1e15
+        data[2, 5] = np.nan
+        data[0, :] = 1e15
+
+        stats = StreamingStats(gpis, missing_value=1e15)
+        for columns in [slice(0, 3), slice(3, 4), slice(4, 10)]:
+            stats.update(timestamps[columns], {'SFMC': data[:, columns]})
+        valid = np.where(data == np.float32(1e15), np.nan,
+                         data.astype(np.float64))[1:]
+        results = stats.results('SFMC')
+        npt.assert_array_equal(results['count'], [0, 9, 9])
+        npt.assert_allclose(results['mean'][1:],
+                            np.nanmean(valid, axis=1), rtol=1e-12)
+        npt.assert_allclose(results['std'][1:],
+                            np.nanstd(valid, axis=1, ddof=1), rtol=1e-8)
+        npt.assert_allclose(results['max'][1:],
+                            np.nanmax(valid, axis=1))
+        assert np.isnan(results['mean'][0])
+        # the climatology is only allocated if requested
+        assert 'clim' not in stats.parameters['SFMC']
+
+        # two time ranges of other grid points are merged
+        first = StreamingStats(gpis[1:], climatology=True,
+                               missing_value=1e15)
+        first.update(timestamps[:5], {'SFMC': data[1:, :5]})
+        second = StreamingStats(gpis, climatology=True,
+                                missing_value=1e15)
+        second.update(timestamps[5:], {'SFMC': data[:, 5:]})
+        path = tempfile.mkdtemp()
+        filenames = [os.path.join(path, name)
+                     for name in ['first.nc', 'second.nc', 'merged.nc']]
+        first.write(filenames[0])
+        second.write(filenames[1])
+        merge_stats_files(filenames[:2], filenames[2])
+
+        merged = StreamingStats.read(filenames[2])
+        npt.assert_array_equal(merged.gpis, [3, 5, 7])
+        for row, gpi in [(1, 0), (2, 1)]:
+            merged_results = merged.results('SFMC')
+            assert merged_results['count'][gpi] == 9
+            npt.assert_allclose(merged_results['mean'][gpi],
+                                results['mean'][row], rtol=1e-7)
+            npt.assert_allclose(merged_results['std'][gpi],
+                                results['std'][row], rtol=1e-10)
+        # one value per day, the climatology is the series itself
+        acc = merged.parameters['SFMC']
+        days = np.arange(10) != 2
+        npt.assert_array_equal(acc['clim_count'][:10, 0], days)
+        npt.assert_array_equal(acc['clim'][:10, 0][days], data[1][days])
+
+    def test_reshuffle_statistics(self):
+        """
+        The statistics are written by the conversion and used for the
+        anomalies of both time series formats.
+        """
+        with Dataset(fname) as ds:
+            sfmc = ds.variables['SFMC'][::6, 276, 314]
+
+        for out_format, reader_class in [('netcdf', MerraTs),
+                                         ('binary', MerraBinaryTs)]:
+            ts_path = tempfile.mkdtemp()
+            main([inpath, ts_path, '2018-10-01', '2018-10-01', 'SFMC',
+                  '--bbox', '15', '45', '20', '50', '--statistics',
+                  '--climatology', '--out_format', out_format])
+            assert os.path.exists(os.path.join(ts_path, 'stats.nc'))
+
+            stats = open_stats(ts_path)
+            values = stats.stats(159290, 'SFMC')
+            assert values['count'] == 4
+            npt.assert_allclose(values['mean'], sfmc.mean(), rtol=1e-6)
+            npt.assert_allclose(values['std'], sfmc.std(ddof=1), rtol=1e-4)
+            doy = day_of_year(np.datetime64('2018-10-01'))
+            npt.assert_allclose(stats.climatology(159290, 'SFMC')[doy],
+                                sfmc.mean(), rtol=1e-6)
+            assert np.isnan(stats.climatology(159290, 'SFMC')[0])
+            stats.close()
+
+            reader = reader_class(ts_path, parameters=['SFMC'])
+            anomalies = reader.read_anomalies(16.375, 48.125)
+            npt.assert_allclose(anomalies['SFMC'].values,
+                                sfmc - sfmc.mean(), atol=1e-6)
+            anomalies = reader.read_anomalies(159290, climatology=False)
+            npt.assert_allclose(anomalies['SFMC'].values,
+                                sfmc - sfmc.mean(), atol=1e-6)
+            reader.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+from datetime import datetime, timedelta
+
+from netCDF4 import Dataset, num2date
+from merra.grid import create_merra_cell_grid
+from merra.transpose import CellTransposer, NcCellWriter, parse_sampling
+from pygeogrids import BasicGrid
+
+
+class Test(unittest.TestCase):
+    """
+    Tests for the transposition engine.
+    """
+
+    def test_transpose_cells(self):
+        """
+        Test if each cell slab contains the time series of its gpis.
+        """
+        merra_grid = create_merra_cell_grid()
+        grid = BasicGrid(merra_grid.activearrlon, merra_grid.activearrlat)
+        transposer = CellTransposer(grid)
+
+        # time series of each gpi is gpi + time
+        block = (np.arange(3)[:, None] +
+                 np.arange(grid.n_gpi)[None, :]).astype(np.float32)
+        transposed = transposer.transpose(block)
+        assert transposed.shape == (grid.n_gpi, 3)
+        assert transposed.flags['C_CONTIGUOUS']
+
+        n_gpi = 0
+        for cell, gpis, lons, lats, data in \
+                transposer.iter_cells({'x': transposed}):
+            assert np.all(transposer.grid.gpi2cell(gpis) == cell)
+            assert np.all(np.diff(gpis) > 0)
+            npt.assert_equal(data['x'][:, 0], gpis)
+            npt.assert_equal(data['x'][:, 2], gpis + 2)
+            n_gpi += gpis.size
+        assert n_gpi == grid.n_gpi
+
+    def test_nc_writer_batches(self):
+        """
+        Batches appended to open and reopened cell files are written one
+        after the other.
+        """
+        out_path = tempfile.mkdtemp()
+        writer = NcCellWriter(out_path, {'SFMC': {'units': 'm-3 m-3'}},
+                              zlib=False, max_open_files=1)
+        gpis = {1: np.array([10, 11]), 2: np.array([20, 21, 22])}
+        timestamps = np.array([datetime(2018, 10, 1) + timedelta(hours=h)
+                               for h in range(6)])
+        for batch in [slice(0, 2), slice(2, 3), slice(3, 6)]:
+            for cell, cell_gpis in gpis.items():
+                data = (cell_gpis[:, None] * 100. +
+                        np.arange(6)[None, batch]).astype(np.float32)
+                writer.write(cell, cell_gpis, cell_gpis * 1., cell_gpis * 1.,
+                             {'SFMC': data}, timestamps[batch], None)
+        assert list(writer._open_cells.keys()) == [1]
+        writer.close()
+
+        for cell, cell_gpis in gpis.items():
+            with Dataset(os.path.join(out_path, '%04d.nc' % cell)) as ds:
+                npt.assert_array_equal(ds.variables['location_id'][:],
+                                       cell_gpis)
+                npt.assert_array_equal(
+                    ds.variables['SFMC'][:],
+                    cell_gpis[:, None] * 100. + np.arange(6)[None, :])
+                time = ds.variables['time']
+                assert list(num2date(time[:], time.units)) == \
+                    list(timestamps)
+
+    def test_sampling(self):
+        """
+        Images are sampled or aggregated over windows, missing values are
+        left out of the aggregation.
+        """
+        timestamps = (np.datetime64('2018-10-01T00:30') +
+                      np.arange(48).astype('timedelta64[h]'))
+        block = np.tile(np.arange(48, dtype=np.float32), (2, 1))
+        block[1, :6] = np.nan
+
+        sampling = parse_sampling('6')
+        assert sampling.name == '6h'
+        assert sampling.hours == [0, 6, 12, 18]
+        out_timestamps, data = sampling.apply(timestamps, {'x': block})
+        npt.assert_array_equal(out_timestamps, timestamps[::6])
+        npt.assert_array_equal(data['x'], block[:, ::6])
+
+        sampling = parse_sampling('24:mean')
+        assert sampling.name == '24h_mean'
+        assert sampling.hours == list(range(24))
+        out_timestamps, data = sampling.apply(timestamps, {'x': block})
+        npt.assert_array_equal(out_timestamps, np.array(
+            ['2018-10-01T12:00', '2018-10-02T12:00'], dtype='datetime64[m]'))
+        npt.assert_allclose(data['x'], [[11.5, 35.5], [14.5, 35.5]])
+        npt.assert_array_equal(sampling.timestamps(timestamps),
+                               out_timestamps)
+
+        out_timestamps, data = parse_sampling('6:min').apply(
+            timestamps, {'x': block})
+        assert out_timestamps[0] == np.datetime64('2018-10-01T03:00')
+        assert np.isnan(data['x'][1, 0])
+        npt.assert_array_equal(data['x'][0], np.arange(0, 48, 6))
+
+        # images keeping the fill value of the files
+        block[1, :6] = 1e15
+        sampling = parse_sampling('6:min', missing_value=1e15)
+        out_timestamps, data = sampling.apply(timestamps, {'x': block})
+        assert data['x'][1, 0] == 1e15
+        npt.assert_array_equal(data['x'][1, 1:], np.arange(6, 48, 6))
+
+        for spec in ['5', '6:median', 'daily']:
+            with self.assertRaises(ValueError):
+                parse_sampling(spec)
+
+
+if __name__ == "__main__":
+    unittest.main()